@@ -0,0 +1,1025 @@
+"""
+Save File Bot 基准测试。
+
+startup: 测量从启动解释器到所有处理器注册完毕 (即将调用 bot.run) 的时间和常驻内存，
+         并检查 OpenCV/MoviePy 等重量级可选依赖是否在启动时被导入。
+upload:  用本地模拟的 upload.saveBigFilePart 比较 Pyrogram 默认上传方式 (单连接、4 个 worker)
+         与并发分片上传 (多连接、多 worker) 的吞吐量。模拟的每个连接有固定的带宽和往返延迟。
+e2e:     端到端吞吐量。本地模拟 main.py 用到的 Telegram 接口 (download_media、stream_media、send_video、
+         send_document、edit_text、get_messages 等) 和 HTTP/抖音/HLS/BitTorrent 源，从确认下载开始驱动完整的
+         BotHandlers 流程，输出 jobs/min、MB/s、保存耗时的 p50/p99、峰值内存和磁盘占用。
+check:   不依赖网络和外部程序的确定性检查 (HLS 播放列表的解析和改写、分片的 Range 请求、
+         用模拟的 JSON-RPC 接口检查 Aria2Client)，失败时以非零状态退出。
+
+用法:
+    python benchmark.py startup --runs 5 --max-startup-ms 3000 --max-rss-mb 150 --output startup.json
+    python benchmark.py upload --size-mb 64 --connection-mbps 40 --rtt-ms 150 --workers 8 --connections 4
+    python benchmark.py e2e concurrent --jobs 4 --size-mb 32 --output e2e.json --baseline e2e-main.json
+    python benchmark.py check
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import shutil
+import socket
+import struct
+import random
+import asyncio
+import hashlib
+import argparse
+import itertools
+import mimetypes
+import resource
+import tempfile
+import statistics
+import subprocess
+from types import SimpleNamespace
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs, quote, unquote_to_bytes
+
+import httpx
+from pyrogram import raw
+from pyrogram.enums import ChatType, MessageMediaType
+
+# 这些依赖只应在第一次提取视频元数据时才被导入
+HEAVY_MODULES = ["cv2", "moviepy", "numpy"]
+
+# 在子进程中执行: 导入 main、创建机器人并注册处理器，然后输出测量结果
+STARTUP_PROBE = """
+import sys, json, time, resource
+t0 = time.perf_counter()
+sys.path.insert(0, {repo_dir!r})
+import main
+t1 = time.perf_counter()
+main.create_bot(main.Config())
+t2 = time.perf_counter()
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{
+    "import_ms": (t1 - t0) * 1000,
+    "create_bot_ms": (t2 - t1) * 1000,
+    "peak_rss_mb": rss_kb / (1024 * 1024 if sys.platform == "darwin" else 1024),
+    "heavy_modules_loaded": [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+# 启动测量不需要真实的凭据，Client 在 bot.run() 之前不会连接网络
+DUMMY_CONFIG = {"ID": "1", "HASH": "0" * 32, "TOKEN": "1:dummy", "SAVE_TO_CHAT_ID": "-1001"}
+
+
+def run_startup_once(repo_dir: str) -> dict:
+    with tempfile.TemporaryDirectory() as work_dir:
+        with open(os.path.join(work_dir, "config.json"), "w") as f:
+            json.dump(DUMMY_CONFIG, f)
+        env = {k: v for k, v in os.environ.items() if k not in DUMMY_CONFIG}
+        code = STARTUP_PROBE.format(repo_dir=repo_dir, heavy=HEAVY_MODULES)
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], cwd=work_dir, env=env,
+                                capture_output=True, text=True, check=True)
+        total_ms = (time.perf_counter() - started) * 1000
+    measurement = json.loads(result.stdout.strip().splitlines()[-1])
+    measurement["total_ms"] = total_ms
+    return measurement
+
+
+def bench_startup(args) -> int:
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    runs = [run_startup_once(repo_dir) for _ in range(args.runs)]
+    summary = {
+        "scenario": "startup",
+        "runs": args.runs,
+        "total_ms_median": statistics.median(r["total_ms"] for r in runs),
+        "import_ms_median": statistics.median(r["import_ms"] for r in runs),
+        "create_bot_ms_median": statistics.median(r["create_bot_ms"] for r in runs),
+        "peak_rss_mb_max": max(r["peak_rss_mb"] for r in runs),
+        "heavy_modules_loaded": sorted({m for r in runs for m in r["heavy_modules_loaded"]}),
+    }
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+    failures = []
+    if summary["heavy_modules_loaded"]:
+        failures.append(f"启动时导入了重量级依赖: {', '.join(summary['heavy_modules_loaded'])}")
+    if args.max_startup_ms and summary["total_ms_median"] > args.max_startup_ms:
+        failures.append(f"启动耗时 {summary['total_ms_median']:.0f}ms 超过上限 {args.max_startup_ms}ms")
+    if args.max_rss_mb and summary["peak_rss_mb_max"] > args.max_rss_mb:
+        failures.append(f"常驻内存 {summary['peak_rss_mb_max']:.1f}MB 超过上限 {args.max_rss_mb}MB")
+    for failure in failures:
+        print(f"❌ {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+class MockSession:
+    """模拟一个媒体连接: 同一连接上的数据串行占用带宽，请求之间的往返延迟可以重叠"""
+
+    def __init__(self, bytes_per_second: float, rtt: float, fail_rate: float = 0):
+        self.bytes_per_second = bytes_per_second
+        self.rtt = rtt
+        self.fail_rate = fail_rate
+        self.requests = 0
+        self.parts = {}
+        self._wire = asyncio.Lock()
+
+    async def invoke(self, query, sleep_threshold=None):
+        self.requests += 1
+        if isinstance(query, raw.functions.upload.GetFile):
+            # 分段下载: e2e 中的文件位置就是模拟消息的媒体对象
+            media, index = query.location, query.offset // MB
+            data = content_block(media.content_id, index)[:media.file_size - index * MB]
+            async with self._wire:
+                await asyncio.sleep(len(data) / self.bytes_per_second)
+            await asyncio.sleep(self.rtt)
+            return raw.types.upload.File(type=raw.types.storage.FileUnknown(), mtime=0, bytes=data)
+        async with self._wire:
+            await asyncio.sleep(len(query.bytes) / self.bytes_per_second)
+        await asyncio.sleep(self.rtt)
+        if random.random() < self.fail_rate:
+            raise ConnectionError("模拟的分片上传失败")
+        self.parts[query.file_part] = len(query.bytes)
+        return True
+
+    async def stop(self):
+        pass
+
+
+class MockBot:
+    @staticmethod
+    def rnd_id() -> int:
+        return int.from_bytes(os.urandom(8), "big", signed=True)
+
+
+async def run_upload_once(main, size: int, workers: int, connections: int, args) -> dict:
+    sessions = []
+
+    class Uploader(main.StreamUploader):
+        async def _new_session(self):
+            session = MockSession(args.connection_mbps * 1024 * 1024 / 8, args.rtt_ms / 1000, args.fail_rate)
+            sessions.append(session)
+            return session
+
+    async def chunks():
+        block = os.urandom(1024 * 1024)
+        for offset in range(0, size, len(block)):
+            yield block[:size - offset]
+
+    uploader = Uploader(MockBot(), "bench.bin", size, workers=workers, connections=connections)
+    started = time.perf_counter()
+    input_file = await uploader.upload(chunks())
+    elapsed = time.perf_counter() - started
+    received = sum(n for s in sessions for n in s.parts.values())
+    assert received == size and input_file.parts == uploader.total_parts, "模拟服务端收到的数据不完整"
+    return {"workers": workers, "connections": connections, "seconds": elapsed, "mb_per_s": size / 2 ** 20 / elapsed}
+
+
+def bench_upload(args) -> int:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    size = args.size_mb * 1024 * 1024
+    baseline = asyncio.run(run_upload_once(main, size, 4, 1, args))
+    parallel = asyncio.run(run_upload_once(main, size, args.workers, args.connections, args))
+    summary = {
+        "scenario": "upload",
+        "size_mb": args.size_mb,
+        "connection_mbps": args.connection_mbps,
+        "rtt_ms": args.rtt_ms,
+        "baseline": baseline,
+        "parallel": parallel,
+        "speedup": parallel["mb_per_s"] / baseline["mb_per_s"],
+    }
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+# ---- e2e: 端到端吞吐量 ----
+
+MB = 1024 * 1024
+BLOCK = random.Random(0).randbytes(MB)
+SAVE_CHAT_ID = -1001
+USER_ID = 1000
+CHANNEL = "benchchannel"
+SOURCES = ("tg_media", "tg_link", "http", "douyin", "m3u8", "magnet")
+PRESETS = {
+    "concurrent": {"sources": "tg_media,tg_link,http,douyin,m3u8,magnet", "jobs": 4, "size_mb": 32, "burst": False},
+    "large": {"sources": "tg_media,http", "jobs": 1, "size_mb": 1024, "burst": False},
+    "burst": {"sources": "tg_media", "jobs": 50, "size_mb": 1, "burst": True},
+}
+
+
+def content_block(content_id: int, index: int) -> bytes:
+    """模拟文件的第 index 个 1MB 块，每个文件的内容不同，避免被内容去重跳过"""
+    return struct.pack(">QQ", content_id, index) + BLOCK[16:]
+
+
+def content_range(content_id: int, start: int, end: int):
+    """按块生成模拟文件中 [start, end) 的数据"""
+    while start < end:
+        index = start // MB
+        piece = content_block(content_id, index)[start - index * MB:min(end - index * MB, MB)]
+        yield piece
+        start += len(piece)
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def bencode(value) -> bytes:
+    if isinstance(value, int):
+        return b"i%de" % value
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b"%d:%s" % (len(value), value)
+    if isinstance(value, list):
+        return b"l" + b"".join(bencode(v) for v in value) + b"e"
+    return b"d" + b"".join(bencode(k) + bencode(value[k]) for k in sorted(value)) + b"e"
+
+
+def make_torrent(path: str, announce: str) -> tuple[bytes, str]:
+    """为单个文件生成种子，返回 (种子内容, info hash)"""
+    piece_length = 256 * 1024
+    pieces = b""
+    with open(path, "rb") as f:
+        while chunk := f.read(piece_length):
+            pieces += hashlib.sha1(chunk).digest()
+    info = {"name": os.path.basename(path), "length": os.path.getsize(path),
+            "piece length": piece_length, "pieces": pieces}
+    return bencode({"announce": announce, "info": info}), hashlib.sha1(bencode(info)).hexdigest()
+
+
+class MockMessage:
+    """模拟的 pyrogram Message，只实现 main.py 用到的属性和方法"""
+
+    def __init__(self, bot: "MockTelegram", chat_id, **fields):
+        self._bot = bot
+        self.id = next(bot.ids)
+        self.chat = SimpleNamespace(id=chat_id, type=ChatType.PRIVATE)
+        self.text = self.media = self.document = self.video = self.photo = None
+        self.media_group_id = self.reply_to_message = None
+        self.has_protected_content = False
+        self.empty = False
+        self.from_user = SimpleNamespace(id=USER_ID, mention="bench")
+        self.__dict__.update(fields)
+        self.replies = []
+        self.edits = []  # (时间, 文本)
+
+    async def edit_text(self, text, reply_markup=None, **kwargs):
+        await asyncio.sleep(self._bot.rtt)
+        self.edits.append((time.perf_counter(), text))
+        return self
+
+    async def edit_reply_markup(self, reply_markup=None):
+        await asyncio.sleep(self._bot.rtt)
+
+    async def delete(self):
+        await asyncio.sleep(self._bot.rtt)
+
+    async def reply_text(self, text, reply_markup=None, quote=None, **kwargs):
+        await asyncio.sleep(self._bot.rtt)
+        reply = MockMessage(self._bot, self.chat.id, text=text, reply_to_message=self)
+        self.replies.append(reply)
+        return reply
+
+    async def copy(self, chat_id, reply_to_message_id=None, **kwargs):
+        await asyncio.sleep(self._bot.rtt)
+        media = self.document or self.video
+        return self._bot.saved_message(media.file_name, media.file_size)
+
+
+class MockTelegram:
+    """
+    本地模拟的 Telegram，实现 main.py 用到的 Client 方法。
+    每次 stream_media/download_media/send_* 调用以及并发上传、分段下载的每个媒体会话都相当于一个独立的连接，
+    按给定的带宽传输数据；每个请求另有固定的往返延迟。
+    """
+
+    def __init__(self, mbps: float, rtt: float):
+        self.bytes_per_second = mbps * MB / 8
+        self.rtt = rtt
+        self.ids = itertools.count(1)
+        self.channel = {}  # 频道消息 ID -> 消息，供 t.me 链接使用
+        self.saved = {}  # 文件名 -> 保存完成的时间
+
+    @staticmethod
+    def rnd_id() -> int:
+        return MockBot.rnd_id()
+
+    @staticmethod
+    def guess_mime_type(file_name: str) -> str | None:
+        return mimetypes.guess_type(file_name)[0]
+
+    def saved_message(self, file_name: str, file_size: int | None) -> MockMessage:
+        self.saved.setdefault(file_name, time.perf_counter())
+        document = SimpleNamespace(file_id=f"saved-{file_name}", file_unique_id=f"saved-{file_name}",
+                                   file_name=file_name, file_size=file_size)
+        return MockMessage(self, SAVE_CHAT_ID, media=MessageMediaType.DOCUMENT, document=document)
+
+    def media_message(self, chat_id, content_id: int, file_name: str, size: int, **fields) -> MockMessage:
+        document = SimpleNamespace(file_id=f"file-{content_id}", file_unique_id=f"unique-{content_id}",
+                                   file_name=file_name, file_size=size, mime_type="application/octet-stream",
+                                   thumbs=None, content_id=content_id)
+        return MockMessage(self, chat_id, media=MessageMediaType.DOCUMENT, document=document, **fields)
+
+    async def new_session(self) -> MockSession:
+        return MockSession(self.bytes_per_second, self.rtt)
+
+    async def get_chat(self, chat_id):
+        await asyncio.sleep(self.rtt)
+        return SimpleNamespace(id=chat_id)
+
+    async def resolve_peer(self, peer_id):
+        return None
+
+    async def save_file(self, path):
+        return None
+
+    async def get_messages(self, chat_id, message_ids):
+        await asyncio.sleep(self.rtt)
+        if isinstance(message_ids, int):
+            return self.channel.get(message_ids)
+        return [self.channel.get(i) or SimpleNamespace(empty=True, media=None) for i in message_ids]
+
+    async def stream_media(self, message, limit: int = 0, offset: int = 0):
+        media = message.document or message.video
+        await asyncio.sleep(self.rtt)
+        chunks = math.ceil(media.file_size / MB)
+        for index in range(offset, min(chunks, offset + limit) if limit else chunks):
+            data = content_block(media.content_id, index)[:media.file_size - index * MB]
+            await asyncio.sleep(len(data) / self.bytes_per_second)
+            yield data
+
+    async def download_media(self, message, file_name: str, progress=None, progress_args=()):
+        media = message.document or message.video
+        path = os.path.join(file_name, media.file_name) if file_name.endswith(os.sep) else file_name
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        done = 0
+        with open(path, "wb") as f:
+            async for chunk in self.stream_media(message):
+                f.write(chunk)
+                done += len(chunk)
+                if progress:
+                    await progress(done, media.file_size, *progress_args)
+        return path
+
+    async def _upload(self, path: str, progress, progress_args) -> MockMessage:
+        size = os.path.getsize(path)
+        done = 0
+        await asyncio.sleep(self.rtt)
+        while done < size:
+            # Pyrogram 默认的上传按 512KB 分片逐个发送
+            n = min(512 * 1024, size - done)
+            await asyncio.sleep(n / self.bytes_per_second)
+            done += n
+            if progress:
+                await progress(done, size, *progress_args)
+        return self.saved_message(os.path.basename(path), size)
+
+    async def send_document(self, chat_id, document, progress=None, progress_args=(), **kwargs):
+        return await self._upload(document, progress, progress_args)
+
+    async def send_video(self, chat_id, video, progress=None, progress_args=(), **kwargs):
+        return await self._upload(video, progress, progress_args)
+
+    async def send_photo(self, chat_id, photo, progress=None, progress_args=(), **kwargs):
+        return await self._upload(photo, progress, progress_args)
+
+    async def invoke(self, query):
+        # 并发分片上传完成后通过 messages.SendMedia 发送
+        await asyncio.sleep(self.rtt)
+        file_name = next(a.file_name for a in query.media.attributes if hasattr(a, "file_name"))
+        self.saved_message(file_name, None)
+        return SimpleNamespace(users=[], chats=[], updates=[])
+
+
+class MockOrigin:
+    """
+    本地 HTTP 源: 模拟文件 (支持 Range 和保持连接)、抖音解析接口、HLS 播放列表/分片，以及 BitTorrent tracker。
+    每个连接按给定的带宽发送数据，每个请求另有固定的首字节延迟。
+    """
+
+    def __init__(self, mbps: float, latency: float, hls_dir: str):
+        self.bytes_per_second = mbps * MB / 8
+        self.latency = latency
+        self.hls_dir = hls_dir
+        self.douyin = {}  # 任务编号 -> 文件大小
+        self.peers = {}  # info hash -> {端口}
+        self.port = None
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.port}{path}"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                method, target, _ = line.decode().split(" ", 2)
+                headers = {}
+                while (header := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    key, _, value = header.decode().partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                await asyncio.sleep(self.latency)
+                await self._route(method, target, headers, writer)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _send(self, writer, status: str, headers: dict, body=b"", head: bool = False):
+        lines = [f"HTTP/1.1 {status}"] + [f"{k}: {v}" for k, v in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        if head:
+            return await writer.drain()
+        for piece in ([body] if isinstance(body, bytes) else body):
+            writer.write(piece)
+            await writer.drain()
+            await asyncio.sleep(len(piece) / self.bytes_per_second)
+
+    async def _route(self, method: str, target: str, headers: dict, writer):
+        url = urlsplit(target)
+        parts = url.path.strip("/").split("/")
+        query = parse_qs(url.query)
+        head = method == "HEAD"
+        if parts[0] == "file" and len(parts) == 3:
+            content_id, size = int(parts[1]), int(query["size"][0])
+            start, end, status = 0, size, "200 OK"
+            response_headers = {"Accept-Ranges": "bytes", "ETag": f'"{content_id}-{size}"',
+                                "Content-Type": "application/octet-stream",
+                                "Content-Disposition": f'attachment; filename="{parts[2]}"'}
+            match = re.match(r"bytes=(\d+)-(\d*)", headers.get("range", ""))
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2)) + 1 if match.group(2) else size, size)
+                status = "206 Partial Content"
+                response_headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+            response_headers["Content-Length"] = str(end - start)
+            await self._send(writer, status, response_headers, content_range(content_id, start, end), head)
+        elif parts[0] == "douyin":
+            job_id = int(re.search(r"job(\d+)", query["url"][0]).group(1))
+            size = self.douyin[job_id]
+            body = json.dumps({"video_data": {
+                "title": f"job{job_id}", "size": size,
+                "nwm_video_url": self.url(f"/file/{job_id}/job{job_id}.mp4?size={size}")
+            }}).encode()
+            await self._send(writer, "200 OK", {"Content-Type": "application/json",
+                                                "Content-Length": str(len(body))}, body, head)
+        elif parts[0] == "hls" and os.path.isfile(path := os.path.join(self.hls_dir, *parts[1:])):
+            with open(path, "rb") as f:
+                body = f.read()
+            await self._send(writer, "200 OK", {"Content-Length": str(len(body))}, body, head)
+        elif parts[0] == "announce":
+            # 原始查询串中的 info_hash 是 URL 编码的二进制
+            params = dict(pair.partition("=")[::2] for pair in url.query.split("&"))
+            peers = self.peers.setdefault(unquote_to_bytes(params["info_hash"]), set())
+            peers.add(int(params["port"]))
+            body = bencode({"interval": 5, "peers": b"".join(
+                socket.inet_aton("127.0.0.1") + struct.pack(">H", port) for port in peers
+            )})
+            await self._send(writer, "200 OK", {"Content-Length": str(len(body))}, body, head)
+        else:
+            await self._send(writer, "404 Not Found", {"Content-Length": "0"})
+
+
+def prepare_hls(hls_dir: str, job_id: int, size: int, seconds: int = 20):
+    """用 ffmpeg 生成约 size 字节的 HLS 视频流，每个任务的时长略有不同，保证内容不同"""
+    job_dir = os.path.join(hls_dir, str(job_id))
+    os.makedirs(job_dir, exist_ok=True)
+    duration = seconds + job_id * 0.04
+    bitrate = max(int(size * 8 / duration), 100_000)
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", f"testsrc=duration={duration}:size=640x360:rate=25",
+        "-c:v", "libx264", "-preset", "ultrafast", "-b:v", str(bitrate), "-minrate", str(bitrate),
+        "-maxrate", str(bitrate), "-bufsize", str(bitrate), "-x264-params", "nal-hrd=cbr", "-g", "50",
+        "-f", "hls", "-hls_time", "2", "-hls_list_size", "0",
+        "-hls_segment_filename", os.path.join(job_dir, "seg%03d.ts"), os.path.join(job_dir, "index.m3u8")
+    ], check=True)
+
+
+def start_seeder(seed_dir: str, torrents: list[str], mbps: float) -> subprocess.Popen:
+    """用 aria2c 做种，供磁力链接任务下载"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return subprocess.Popen([
+        "aria2c", f"--dir={seed_dir}", "--seed-ratio=0.0", "--check-integrity=true", "--bt-seed-unverified=true",
+        "--enable-dht=false", "--bt-enable-lpd=false", "--enable-peer-exchange=false", f"--listen-port={port}",
+        f"--max-overall-upload-limit={int(mbps * MB / 8)}", "--quiet=true", *torrents
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def unavailable_sources(sources: list[str]) -> dict:
+    """本机缺少外部程序而无法运行的来源及原因"""
+    skipped = {}
+    if "m3u8" in sources and not shutil.which("ffmpeg"):
+        skipped["m3u8"] = "未安装 ffmpeg"
+    if "magnet" in sources and not shutil.which("aria2c"):
+        skipped["magnet"] = "未安装 aria2c"
+    return skipped
+
+
+async def run_e2e(main, args, work_dir: str) -> dict:
+    sources = [s for s in args.sources.split(",") if s]
+    skipped = unavailable_sources(sources)
+    sources = [s for s in sources if s not in skipped]
+    size = int(args.size_mb * MB)
+
+    origin = MockOrigin(args.origin_mbps, args.origin_latency_ms / 1000, os.path.join(work_dir, "hls"))
+    await origin.start()
+    settings = {**DUMMY_CONFIG, "SAVE_TO_CHAT_ID": str(SAVE_CHAT_ID), "DOUYIN_API_URL": origin.url("/douyin/api"),
+                "ARIA2_RPC_PORT": str(args.aria2_port)}
+    settings.update(item.split("=", 1) for item in args.set)
+    with open(os.path.join(work_dir, "config.json"), "w") as f:
+        json.dump(settings, f)
+    config = main.Config(os.path.join(work_dir, "config.json"))
+
+    bot = MockTelegram(args.tg_mbps, args.tg_rtt_ms / 1000)
+    main.StreamUploader._new_session = lambda uploader: bot.new_session()
+    main.TelegramDownloader._new_session = lambda downloader, dc_id: bot.new_session()
+    main.TelegramDownloader._location = classmethod(lambda cls, message: (2, message.document or message.video))
+    journal = main.JobJournal()
+    file_processor = main.FileProcessor(bot, config, journal)
+    main.DouyinMessageProcessor.resolver = main.DouyinResolver(config.DOUYIN_API_URL, config.DOUYIN_CACHE_TTL)
+    handlers = main.BotHandlers(bot, config, file_processor, main.SaveIndex(), journal)
+
+    # 准备每个任务的源消息
+    jobs = []  # (任务编号, 来源, 源消息)
+    seed_dir, torrents, seeder = os.path.join(work_dir, "seed"), [], None
+    for job_id in range(1, args.jobs * len(sources) + 1):
+        kind = sources[(job_id - 1) % len(sources)]
+        name = f"job{job_id}.bin"
+        if kind == "tg_media":
+            source = bot.media_message(USER_ID, job_id, name, size)
+        elif kind == "tg_link":
+            # 受保护的内容无法在服务器端转存，会走下载再上传的流程
+            bot.channel[job_id] = bot.media_message(CHANNEL, job_id, name, size,
+                                                     has_protected_content=not args.allow_copy)
+            source = MockMessage(bot, USER_ID, text=f"https://t.me/{CHANNEL}/{job_id}")
+        elif kind == "http":
+            source = MockMessage(bot, USER_ID, text=origin.url(f"/file/{job_id}/{name}?size={size}"))
+        elif kind == "douyin":
+            origin.douyin[job_id] = size
+            source = MockMessage(bot, USER_ID, text=f"复制打开抖音 https://v.douyin.com/job{job_id}/")
+        elif kind == "m3u8":
+            prepare_hls(origin.hls_dir, job_id, size)
+            source = MockMessage(bot, USER_ID, text=origin.url(f"/hls/{job_id}/index.m3u8"))
+        else:
+            os.makedirs(seed_dir, exist_ok=True)
+            path = os.path.join(seed_dir, name)
+            with open(path, "wb") as f:
+                for piece in content_range(job_id, 0, size):
+                    f.write(piece)
+            torrent, info_hash = make_torrent(path, origin.url("/announce"))
+            torrents.append(path + ".torrent")
+            with open(torrents[-1], "wb") as f:
+                f.write(torrent)
+            source = MockMessage(bot, USER_ID, text=f"magnet:?xt=urn:btih:{info_hash}&dn={name}"
+                                                    f"&tr={quote(origin.url('/announce'), safe='')}")
+        jobs.append((job_id, kind, source))
+    if torrents:
+        seeder = start_seeder(seed_dir, torrents, args.origin_mbps)
+
+    peak_disk = 0
+
+    async def sample_disk():
+        nonlocal peak_disk
+        while True:
+            peak_disk = max(peak_disk, main.StorageManager._du(file_processor.download_dir))
+            await asyncio.sleep(0.2)
+
+    sampler = asyncio.create_task(sample_disk())
+    started = time.perf_counter()
+    confirm_latencies = []
+    if args.burst:
+        # 所有消息同时到达: 测量从收到消息到发出确认的延迟
+        async def receive(source):
+            received_at = time.perf_counter()
+            await handlers.on_new_message(None, source)
+            confirm_latencies.append(time.perf_counter() - received_at)
+
+        await asyncio.gather(*(receive(source) for _, _, source in jobs))
+        status_messages = [source.replies[-1] for _, _, source in jobs]
+    else:
+        status_messages = [MockMessage(bot, USER_ID, reply_to_message=source) for _, _, source in jobs]
+
+    async def noop(*args, **kwargs):
+        pass
+
+    confirmed_at = {}
+    for status_msg in status_messages:
+        confirmed_at[status_msg.id] = time.perf_counter()
+    await asyncio.gather(*(handlers.on_callback_query(None, SimpleNamespace(
+        from_user=SimpleNamespace(id=USER_ID), data="confirm_download", message=status_msg, answer=noop
+    )) for status_msg in status_messages))
+    await asyncio.gather(*list(handlers.active_tasks.values()), return_exceptions=True)
+    wall = time.perf_counter() - started
+    sampler.cancel()
+
+    time_to_saved, time_to_status, saved_bytes, failures = [], [], 0, []
+    for (job_id, kind, _), status_msg in zip(jobs, status_messages):
+        final_at, final_text = status_msg.edits[-1] if status_msg.edits else (None, "")
+        if not final_text.startswith("✅"):
+            failures.append({"job": job_id, "source": kind, "status": final_text.splitlines()[-1] if final_text else ""})
+            continue
+        saved_at = next((t for name, t in bot.saved.items() if re.search(rf"job{job_id}\b", name)), final_at)
+        time_to_saved.append(saved_at - confirmed_at[status_msg.id])
+        time_to_status.append(final_at - confirmed_at[status_msg.id])
+        saved_bytes += size
+
+    phases = {}
+    for (name, labels), hist in main.METRICS._histograms.items():
+        if name == "job_phase_seconds":
+            phase = dict(labels)["phase"]
+            total, count = phases.get(phase, (0, 0))
+            phases[phase] = (total + hist[-2], count + hist[-1])
+
+    if seeder:
+        seeder.terminate()
+    await main.close_http_client()
+    await origin.stop()
+    return {
+        "scenario": args.preset,
+        "sources": sources,
+        "skipped_sources": skipped,
+        "jobs": len(jobs),
+        "saved": len(time_to_saved),
+        "failed": failures,
+        "size_mb": args.size_mb,
+        "tg_mbps": args.tg_mbps,
+        "origin_mbps": args.origin_mbps,
+        "wall_seconds": wall,
+        "jobs_per_min": len(time_to_saved) / wall * 60,
+        "mb_per_s": saved_bytes / MB / wall,
+        "time_to_saved_p50_s": percentile(time_to_saved, 50),
+        "time_to_saved_p99_s": percentile(time_to_saved, 99),
+        "time_to_status_p50_s": percentile(time_to_status, 50),
+        "time_to_status_p99_s": percentile(time_to_status, 99),
+        "confirm_p50_ms": percentile(confirm_latencies, 50) * 1000 if confirm_latencies else None,
+        "confirm_p99_ms": percentile(confirm_latencies, 99) * 1000 if confirm_latencies else None,
+        "phase_mean_s": {phase: total / count for phase, (total, count) in phases.items() if count},
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (MB if sys.platform == "darwin" else 1024),
+        "peak_disk_mb": peak_disk / MB,
+    }
+
+
+def compare_with_baseline(summary: dict, baseline: dict, max_regression: float) -> list[str]:
+    """吞吐量下降或 p99 耗时上升超过 max_regression (比例) 时返回失败原因"""
+    failures = []
+    for key, higher_is_better in (("mb_per_s", True), ("jobs_per_min", True), ("time_to_saved_p99_s", False)):
+        old, new = baseline.get(key), summary.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > max_regression:
+            failures.append(f"{key} 从 {old:.2f} 变为 {new:.2f} ({change:+.0%})")
+    return failures
+
+
+def bench_e2e(args) -> int:
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo_dir)
+    for key, value in PRESETS[args.preset].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    with tempfile.TemporaryDirectory() as work_dir:
+        # main.py 的 downloads/ 和 sessions/ 都是相对路径
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            import main
+            summary = asyncio.run(run_e2e(main, args, work_dir))
+        finally:
+            os.chdir(cwd)
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+    failures = [f"任务 {f['job']} ({f['source']}) 未保存成功: {f['status']}" for f in summary["failed"]]
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures += compare_with_baseline(summary, json.load(f), args.max_regression)
+    for failure in failures:
+        print(f"❌ {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+# ---- check: 不依赖网络和外部程序的确定性检查 ----
+
+HLS_MEDIA_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:7
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:10
+#EXT-X-MAP:URI="init.mp4",BYTERANGE="720@0"
+#EXT-X-KEY:METHOD=AES-128,URI="keys/k1.bin",IV=0x0102
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:1000@720
+media.mp4
+#EXTINF:3.5,
+#EXT-X-BYTERANGE:500
+media.mp4
+#EXT-X-KEY:METHOD=NONE
+#EXT-X-DISCONTINUITY
+#EXTINF:2,
+https://cdn.example.com/other.ts
+#EXT-X-ENDLIST
+"""
+
+HLS_LOCAL_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:7
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:10
+#EXT-X-MAP:URI="res_1.mp4"
+#EXT-X-KEY:METHOD=AES-128,URI="res_0.bin",IV=0x0102
+#EXTINF:4.000000,
+seg_000000.mp4
+#EXTINF:3.500000,
+seg_000001.mp4
+#EXT-X-KEY:METHOD=NONE
+#EXT-X-DISCONTINUITY
+#EXTINF:2.000000,
+seg_000002.ts
+#EXT-X-ENDLIST
+"""
+
+
+def check_hls(main, work_dir: str):
+    base = "https://origin.example.com/v/index.m3u8"
+    segments = main.HLSDownloader.parse_media(HLS_MEDIA_PLAYLIST, base)
+    assert [(s.uri, s.duration, s.sequence, s.byterange, s.discontinuity) for s in segments] == [
+        ("https://origin.example.com/v/media.mp4", 4.0, 10, (1000, 720), False),
+        # 未写偏移的 BYTERANGE 紧接同一文件上一段的末尾
+        ("https://origin.example.com/v/media.mp4", 3.5, 11, (500, 1720), False),
+        ("https://cdn.example.com/other.ts", 2.0, 12, None, True),
+    ], segments
+    key = {"METHOD": "AES-128", "URI": "https://origin.example.com/v/keys/k1.bin", "IV": "0x0102"}
+    init = {"URI": "https://origin.example.com/v/init.mp4", "BYTERANGE": "720@0"}
+    assert [s.key for s in segments] == [key, key, None], [s.key for s in segments]
+    assert all(s.init == init for s in segments), [s.init for s in segments]
+
+    local_names = {(key["URI"], None): "res_0.bin", (init["URI"], "720@0"): "res_1.mp4"}
+    path = main.HLSDownloader(work_dir)._write_local_playlist(segments, local_names)
+    with open(path) as f:
+        assert f.read() == HLS_LOCAL_PLAYLIST, f"本地播放列表不符:\n{open(path).read()}"
+
+    # 格式错误的标签以 IOError 报告 (任务失败并提示)，不支持的特性以 UnsupportedPlaylist 交给 ffmpeg
+    for tag in ("#EXT-X-BYTERANGE:abc", "#EXT-X-BYTERANGE:0@10", "#EXT-X-KEY:METHOD=AES-128",
+                "#EXT-X-MAP:BYTERANGE=\"10\"", "#EXT-X-MEDIA-SEQUENCE:x", "#EXTINF:abc,"):
+        try:
+            main.HLSDownloader.parse_media(f"#EXTM3U\n{tag}\n#EXTINF:1,\na.ts\n#EXT-X-ENDLIST\n", base)
+        except main.UnsupportedPlaylist as e:
+            raise AssertionError(f"{tag}: 不应视为不支持的播放列表: {e}")
+        except IOError:
+            continue
+        raise AssertionError(f"{tag}: 没有报错")
+    try:
+        main.HLSDownloader.parse_media("#EXT-X-KEY:METHOD=SAMPLE-AES,URI=\"k\"\na.ts\n#EXT-X-ENDLIST", base)
+        raise AssertionError("SAMPLE-AES 应交给 ffmpeg")
+    except main.UnsupportedPlaylist:
+        pass
+
+    # 分片的 Range 请求: 206 必须返回请求的范围，忽略 Range 的 200 自行截取；
+    # 范围错位或长度不足时重试，全部重试都失败才报错
+    body = bytes(range(256)) * 8
+    requests = Counter()
+
+    def respond(request):
+        mode = request.url.params.get("mode")
+        requests[mode] += 1
+        start, end = map(int, request.headers["Range"][6:].split("-"))
+        if mode == "flaky" and requests[mode] == 1:
+            return httpx.Response(206, content=body[start:end], headers={"Content-Range": f"bytes {start}-{end}/*"})
+        if mode == "ignore":
+            return httpx.Response(200, content=body)
+        if mode == "shifted":
+            start, end = start + 1, end + 1
+        headers = {"Content-Range": f"bytes {start}-{end}/{len(body)}"} if mode != "missing" else {}
+        return httpx.Response(206, content=body[start:end + 1], headers=headers)
+
+    async def fetch_all():
+        downloader = main.HLSDownloader(work_dir)
+        downloader.RETRY_DELAY = 0
+        results = {}
+        async with httpx.AsyncClient(transport=httpx.MockTransport(respond)) as client:
+            for mode in ("exact", "ignore", "flaky", "shifted", "missing"):
+                try:
+                    results[mode] = await downloader._get(client, f"https://origin.example.com/s?mode={mode}", (100, 1000))
+                except IOError as e:
+                    results[mode] = e
+        return results
+
+    results = asyncio.run(fetch_all())
+    assert all(results[mode] == body[1000:1100] for mode in ("exact", "ignore", "flaky")), results
+    assert isinstance(results["shifted"], IOError) and isinstance(results["missing"], IOError), results
+    retries = main.HLSDownloader.MAX_RETRIES
+    assert requests == {"exact": 1, "ignore": 1, "flaky": 2, "shifted": retries, "missing": retries}, requests
+
+
+class StubAria2:
+    """
+    模拟 aria2c 的 JSON-RPC 接口 (httpx.MockTransport)，记录收到的调用。
+    磁力链接先返回一个元数据任务，完成后由 followedBy 中的新任务接手；
+    URI 中包含 "fail" 的任务在第一次查询时失败，密钥不符时像 aria2c 一样返回 400 Unauthorized。
+    """
+
+    def __init__(self, secret: str):
+        self.secret = secret
+        self.calls = []  # (方法, 去掉令牌后的参数)
+        self.polls = {}  # gid -> 已查询的次数
+        self.uris = {}  # gid -> 提交的 URI
+
+    def handle(self, request):
+        payload = json.loads(request.content)
+        params = payload["params"]
+        if params[:1] != [f"token:{self.secret}"]:
+            return httpx.Response(400, json={"jsonrpc": "2.0", "id": payload["id"],
+                                             "error": {"code": 1, "message": "Unauthorized"}})
+        method, params = payload["method"], params[1:]
+        self.calls.append((method, params))
+        if method == "aria2.addUri":
+            gid = f"{len(self.uris) + 1:016x}"
+            self.uris[gid] = params[0][0]
+            result = gid
+        elif method == "aria2.tellStatus":
+            result = self._status(params[0])
+        elif method in ("aria2.forceRemove", "aria2.removeDownloadResult", "aria2.getVersion"):
+            result = "OK" if method != "aria2.getVersion" else {"version": "stub"}
+        else:
+            return httpx.Response(200, json={"jsonrpc": "2.0", "id": payload["id"],
+                                             "error": {"code": 1, "message": f"No such method: {method}"}})
+        return httpx.Response(200, json={"jsonrpc": "2.0", "id": payload["id"], "result": result})
+
+    def _status(self, gid: str) -> dict:
+        uri = self.uris[gid]
+        poll = self.polls[gid] = self.polls.get(gid, 0) + 1
+        if "fail" in uri:
+            return {"gid": gid, "status": "error", "errorMessage": "No peers"}
+        if uri.startswith("magnet:"):
+            if poll == 1:
+                return {"gid": gid, "status": "active", "totalLength": "0", "completedLength": "0"}
+            # 元数据下载完成，真正的下载由新任务接手
+            follower = f"{len(self.uris) + 1:016x}"
+            self.uris.setdefault(follower, "torrent:" + uri)
+            return {"gid": gid, "status": "complete", "followedBy": [follower]}
+        if poll == 1:
+            return {"gid": gid, "status": "active", "totalLength": "1000", "completedLength": "400"}
+        return {"gid": gid, "status": "complete", "totalLength": "1000", "completedLength": "1000", "files": [
+            {"path": "[METADATA]abc", "selected": "true"},
+            {"path": "/dl/job/video.mkv", "selected": "true"},
+            {"path": "/dl/job/sample.txt", "selected": "false"},
+        ]}
+
+
+def check_aria2(main, work_dir: str):
+    stub = StubAria2("s3cret")
+
+    def client(secret: str):
+        aria2 = main.Aria2Client(work_dir, "http://127.0.0.1:6800/jsonrpc", secret)
+        aria2.POLL_INTERVAL = 0
+        aria2._client = httpx.AsyncClient(transport=httpx.MockTransport(stub.handle))
+        return aria2
+
+    async def run():
+        aria2 = client("s3cret")
+        progress, gids = [], []
+
+        async def on_progress(current, total, state):
+            progress.append((current, total, state))
+
+        files = await aria2.download("magnet:?xt=urn:btih:abc", work_dir, on_progress, on_gid=gids.append)
+        assert files == ["/dl/job/video.mkv"], files
+        assert gids == ["0000000000000001", "0000000000000002"], gids
+        assert progress == [(0, 0, "active"), (400, 1000, "active")], progress
+        assert stub.calls[0] == ("aria2.addUri", [["magnet:?xt=urn:btih:abc"], {"dir": work_dir, "continue": "true"}])
+        assert stub.calls[1] == ("aria2.tellStatus", ["0000000000000001", main.Aria2Client.STATUS_KEYS]), stub.calls[1]
+        # 完成后清理两个任务的结果，不需要强制删除
+        cleanup = [call for call in stub.calls if call[0] not in ("aria2.addUri", "aria2.tellStatus")]
+        assert cleanup == [("aria2.removeDownloadResult", [gid]) for gid in gids], cleanup
+
+        # 下载失败: 报告 aria2 的错误信息，并删除任务
+        stub.calls.clear()
+        try:
+            await aria2.download("http://origin.example.com/fail.bin", work_dir)
+            raise AssertionError("失败的下载没有报错")
+        except IOError as e:
+            assert "No peers" in str(e), e
+        assert [call[0] for call in stub.calls[2:]] == ["aria2.forceRemove", "aria2.removeDownloadResult"], stub.calls
+
+        # 任务被取消 (进度回调中抛出 CancelledError): 删除 aria2 中的任务后继续抛出
+        stub.calls.clear()
+
+        async def cancel(*args):
+            raise asyncio.CancelledError
+
+        try:
+            await aria2.download("http://origin.example.com/video.mkv", work_dir, cancel)
+            raise AssertionError("取消没有传递出来")
+        except asyncio.CancelledError:
+            pass
+        gid = stub.calls[1][1][0]
+        assert stub.calls[2:] == [("aria2.forceRemove", [gid]), ("aria2.removeDownloadResult", [gid])], stub.calls
+
+        # 密钥不符和未知方法以 IOError 报告
+        for aria2_call, message in ((client("wrong").call("aria2.getVersion"), "Unauthorized"),
+                                    (aria2.call("aria2.nope"), "No such method")):
+            try:
+                await aria2_call
+                raise AssertionError(f"应报错: {message}")
+            except IOError as e:
+                assert message in str(e), e
+
+    asyncio.run(run())
+
+
+CHECKS = {"hls": check_hls, "aria2": check_aria2}
+
+
+def run_checks(args) -> int:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    unknown = [name for name in args.names if name not in CHECKS]
+    if unknown:
+        print(f"未知的检查: {', '.join(unknown)}，可选: {', '.join(sorted(CHECKS))}")
+        return 2
+    failed = 0
+    for name in args.names or sorted(CHECKS):
+        with tempfile.TemporaryDirectory() as work_dir:
+            try:
+                CHECKS[name](main, work_dir)
+                print(f"✓ {name}")
+            except Exception as e:
+                failed += 1
+                print(f"✗ {name}: {type(e).__name__}: {e}")
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Save File Bot 基准测试")
+    subparsers = parser.add_subparsers(dest="scenario", required=True)
+
+    startup = subparsers.add_parser("startup", help="测量启动耗时和常驻内存")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--max-startup-ms", type=float, default=0, help="启动耗时中位数上限，0 为不检查")
+    startup.add_argument("--max-rss-mb", type=float, default=0, help="峰值常驻内存上限，0 为不检查")
+    startup.add_argument("--output", help="把结果写入 JSON 文件")
+    startup.set_defaults(func=bench_startup)
+
+    upload = subparsers.add_parser("upload", help="用模拟的分片上传接口比较上传吞吐量")
+    upload.add_argument("--size-mb", type=int, default=64)
+    upload.add_argument("--connection-mbps", type=float, default=40, help="每个模拟连接的带宽 (Mbit/s)")
+    upload.add_argument("--rtt-ms", type=float, default=150, help="每个分片请求的往返延迟")
+    upload.add_argument("--workers", type=int, default=8)
+    upload.add_argument("--connections", type=int, default=4)
+    upload.add_argument("--fail-rate", type=float, default=0, help="分片请求随机失败的比例，用来检验重试")
+    upload.add_argument("--output", help="把结果写入 JSON 文件")
+    upload.set_defaults(func=bench_upload)
+
+    e2e = subparsers.add_parser("e2e", help="用模拟的 Telegram 和 HTTP/HLS/BT 源测量端到端吞吐量")
+    e2e.add_argument("preset", choices=sorted(PRESETS), help="concurrent: 每种来源 N 个并发任务; "
+                                                          "large: 超大文件; burst: 大量消息同时到达并确认")
+    e2e.add_argument("--sources", help=f"逗号分隔的来源类型: {','.join(SOURCES)}")
+    e2e.add_argument("--jobs", type=int, help="每种来源的任务数")
+    e2e.add_argument("--size-mb", type=float, help="每个文件的大小")
+    e2e.add_argument("--burst", action="store_true", default=None, help="经 on_new_message 收到消息后再确认")
+    e2e.add_argument("--allow-copy", action="store_true", help="t.me 链接允许服务器端转存 (不传输文件)")
+    e2e.add_argument("--tg-mbps", type=float, default=80, help="模拟 Telegram 每个连接的带宽 (Mbit/s)")
+    e2e.add_argument("--tg-rtt-ms", type=float, default=50, help="模拟 Telegram 每个请求的往返延迟")
+    e2e.add_argument("--origin-mbps", type=float, default=100, help="HTTP/HLS/BT 源每个连接的带宽 (Mbit/s)")
+    e2e.add_argument("--origin-latency-ms", type=float, default=20, help="HTTP 源每个请求的首字节延迟")
+    e2e.add_argument("--aria2-port", type=int, default=16800, help="磁力链接任务使用的 aria2c RPC 端口")
+    e2e.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="覆盖机器人的配置项，可重复")
+    e2e.add_argument("--output", help="把结果写入 JSON 文件")
+    e2e.add_argument("--baseline", help="与之前的 JSON 结果比较，退化超过 --max-regression 时以非零状态退出")
+    e2e.add_argument("--max-regression", type=float, default=0.2)
+    e2e.set_defaults(func=bench_e2e)
+
+    check = subparsers.add_parser("check", help="不依赖网络和外部程序的确定性检查")
+    check.add_argument("names", nargs="*", help=f"要运行的检查 ({', '.join(sorted(CHECKS))})，默认全部")
+    check.set_defaults(func=run_checks)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
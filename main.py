@@ -1,27 +1,44 @@
 import os
+import re
+import sys
+import math
 import time
 import json
+import shutil
+import socket
+import sqlite3
+import hashlib
+import heapq
+import secrets
+import fcntl
+import mimetypes
+import itertools
 import asyncio
 import logging
+import threading
+import contextvars
 from abc import abstractmethod, ABC
-from dataclasses import dataclass
-from urllib.parse import urlparse
-from subprocess import run, CalledProcessError
-from contextlib import suppress
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode, unquote, urljoin
+from contextlib import suppress, aclosing, asynccontextmanager, nullcontext
 
 import pyrogram
 import httpx
-from pyrogram import Client, filters
+from pyrogram import Client, filters, raw
+from pyrogram.session import Session, Auth
+from pyrogram.file_id import FileId, FileType
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from pyrogram.errors import MessageNotModified, UsernameNotOccupied
-
-import cv2
-from moviepy import VideoFileClip
+from pyrogram.errors import FloodWait, MessageNotModified, UsernameNotOccupied
 
 # --- 配置 ---
 # 设置基本的日志记录
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
+# httpx 会为每个请求输出一条 INFO 日志，分段下载时过于频繁
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # 将所有用户可见的字符串放在一个地方，方便修改和国际化
 MESSAGES = {
@@ -31,29 +48,57 @@ MESSAGES = {
 
 - **直接发送文件**: 发送任何媒体文件（视频、图片、文档）。
 - **发送链接**: 支持 `https://t.me/` 的帖子链接、抖音分享链接，以及 `http/https` (包括 .m3u8) 或 `magnet:` 的直接下载链接。
+- **批量保存**: 发送相册、消息范围链接 (如 `https://t.me/频道/100-300`) 或在一条消息中发送多个 `https://t.me/` 链接，所有文件作为一个任务保存。
 
 机器人会先向你确认，再开始下载。
 """,
     "auth_failed": "❌ **鉴权失败**\n你没有权限使用此机器人。",
     "bot_not_in_chat": "❌ **设置错误**\n机器人尚未加入指定的保存频道/群组。请先将其加入并发送一条消息。",
-    "waiting_for_tasks": "⏳ **任务繁忙**\n请等待其他任务执行完毕。",
+    "waiting_for_tasks": "⏳ **任务繁忙**\n请等待其他任务执行完毕。\n\n**排队位置**: 第 {position} 位",
     "invalid_link": "🔗 **链接无效**\n原因: `{error}`",
     "unsupported_chat": "🤷‍♂️ **类型不支持**\n暂不支持此类型的聊天链接。",
     "username_not_found": "🔍 **用户不存在**\n找不到此公开频道的用户名。",
     "no_media_in_link": "🤷‍♂️ **内容不支持**\n链接指向的消息不包含可下载的媒体。",
     "downloading": "📥 **正在下载...**",
     "uploading": "📤 **正在上传...**",
+    "streaming": "🔁 **正在边下载边上传...**",
     "download_failed": "❌ **下载失败**\n错误: `{error}`",
     "upload_failed": "❌ **上传失败**\n错误: `{error}`",
     "unsupported_content": "🤷‍♂️ **内容不支持**\n此消息不包含可保存的媒体。",
     "file_not_found": "❌ **文件未找到**\n下载后，在本地未找到该文件。",
     "saved_success": "✅ **保存成功**\n文件名: `{filename}`\n大小: `{filesize}`",
+    "already_saved": "♻️ **文件已保存过**\n文件名: `{filename}`\n大小: `{filesize}`\n{link}\n你仍然想要重新保存一份吗？",
+    "already_saved_skip": "♻️ **文件已保存过**\n下载后的内容与已保存的文件相同，已跳过上传。\n{link}",
+    "copied_success": "✅ **保存成功** (服务器端转存)\n文件名: `{filename}`\n大小: `{filesize}`",
+    "resaved_success": "✅ **已重新保存** (按已保存的消息转存，无需下载)\n文件名: `{filename}`\n大小: `{filesize}`\n{link}",
     "progress_status": "{action}\n\n**进度**: {percent:.1f}% - {speed}/s\n**大小**: `{done} / {total}`",
     "confirm_download": "📋 **文件确认**\n\n**文件名**: `{filename}`\n**类型**: `{filetype}`\n**大小**: `{filesize}`\n\n你想要下载这个文件吗？",
     "task_cancelled": "🔴 **任务已取消**",
     "task_starting": "🚀 **任务即将开始...**",
+    "task_enqueued": "📥 **已加入任务队列**\n等待工作进程处理，前面还有 {ahead} 个任务。",
     "unknown_size": "未知",
-    "ffmpeg_processing": "⏳ **正在合并 M3U8 视频流...**\n这可能需要一些时间，且期间无进度更新。",
+    "aria2_metadata": "🧲 **正在获取磁力链接元数据...**",
+    "aria2_paused": "⏸ **已暂停**",
+    "saved_multiple_success": "✅ **保存成功**\n共 `{count}` 个文件，总大小: `{filesize}`",
+    "task_resumed": "🔄 **任务已恢复**\n机器人重启后继续执行此任务。{progress}",
+    "resume_progress": "\n重启前进度: `{done} / {total}`",
+    "task_interrupted": "⏸ **机器人正在重启**\n任务将在重启后自动继续。",
+    "storage_waiting": "💾 **等待磁盘空间**\n其他任务完成后将自动开始。",
+    "storage_insufficient": "磁盘空间不足: 需要 {size}，可用 {available}",
+    "saved_split_success": "✅ **保存成功** (已分为 `{count}` 个部分)\n文件名: `{filename}`\n大小: `{filesize}`",
+    "splitting": "✂️ **文件超过 {limit} 上限，正在分割...**",
+    "uploading_parts": "📤 **正在上传 {count} 个部分...**",
+    "split_notice": "\n\n⚠️ 文件超过 Telegram 的 {limit} 上限，下载后将自动分割为多个部分上传。",
+    "file_too_large": "❌ **文件过大**\n文件大小 `{filesize}` 超过了 Telegram 的 {limit} 上限。",
+    "part_caption": "{filename} ({index}/{count})",
+    "batch_resolving": "🔎 **正在获取批量任务中的消息...**",
+    "batch_empty": "🤷‍♂️ **内容不支持**\n批量任务中没有可下载的媒体。",
+    "batch_progress": "📦 **批量保存中...**\n\n**条目**: `{finished} / {total}` (成功 {saved}，跳过 {skipped}，失败 {failed})\n**下载**: `{downloaded} / {total_size}`\n**上传**: `{uploaded} / {total_size}` - {speed}/s",
+    "batch_success": "✅ **批量保存完成**\n共 `{total}` 个条目: 成功 `{saved}`，已保存过 `{skipped}`，失败 `{failed}`\n上传大小: `{filesize}`",
+    "ffmpeg_processing": "⏳ **正在分析 M3U8 视频流...**",
+    "ffmpeg_copying": "⚡ **正在合并 M3U8 视频流 (直接复制，无需重新编码)...**",
+    "ffmpeg_encoding": "⏳ **正在合并 M3U8 视频流 (重新编码)...**\n原因: {reason}",
+    "ffmpeg_progress": "{action}\n\n**进度**: {percent}\n**时长**: `{done} / {total}`\n**已输出**: `{size}` ({speed})",
     "ffmpeg_failed": "FFmpeg 错误: 请检查链接是否有效以及 FFmpeg 是否已正确安装。",
     "file_type_map": {
         "video": "视频", "photo": "图片", "document": "文档", "other": "其他",
@@ -75,28 +120,2023 @@ class Config:
         self.API_ID = int(self.get("ID"))
         self.API_HASH = self.get("HASH")
         self.BOT_TOKEN = self.get("TOKEN")
-        self.ALLOWED_USERS = [user.strip() for user in self.get("ALLOWED_USERS", "").split(",") if user.strip()]
+        self.ALLOWED_USERS = {user.strip() for user in self.get("ALLOWED_USERS", "").split(",") if user.strip()}
+        # 检查机器人是否仍在保存频道中的结果的缓存时间 (秒)，过期后在后台刷新
+        self.SAVE_CHAT_CHECK_TTL = self.get_int("SAVE_CHAT_CHECK_TTL", 300)
         self.SAVE_TO_CHAT_ID = int(self.get("SAVE_TO_CHAT_ID"))
         self.SAVE_TO_TOPIC_ID_DOCUMENT = int(self.get("SAVE_TO_TOPIC_ID_DOCUMENT", 0))
         self.SAVE_TO_TOPIC_ID_VIDEO = int(self.get("SAVE_TO_TOPIC_ID_VIDEO", 0))
         self.SAVE_TO_TOPIC_ID_PHOTO = int(self.get("SAVE_TO_TOPIC_ID_PHOTO", 0))
 
+        # 任务调度: 全局/每用户并发上限，以及下载、上传各自的槽位数
+        self.MAX_CONCURRENT_TASKS = self.get_int("MAX_CONCURRENT_TASKS", 3)
+        self.MAX_TASKS_PER_USER = self.get_int("MAX_TASKS_PER_USER", 2)
+        self.MAX_CONCURRENT_DOWNLOADS = self.get_int("MAX_CONCURRENT_DOWNLOADS", 2)
+        self.MAX_CONCURRENT_UPLOADS = self.get_int("MAX_CONCURRENT_UPLOADS", 2)
+
+        # 流式传输: 下载的数据经有界内存缓冲直接分片上传，不落盘
+        self.STREAM_TRANSFER = self.get_int("STREAM_TRANSFER", 1) > 0
+        self.STREAM_BUFFER_MB = self.get_int("STREAM_BUFFER_MB", 8)
+        # 对未限制保存的 t.me 链接直接在服务器端转存
+        self.COPY_FAST_PATH = self.get_int("COPY_FAST_PATH", 1) > 0
+        # HTTP 下载的并发连接数
+        self.HTTP_CONNECTIONS = self.get_int("HTTP_CONNECTIONS", 4)
+        # Telegram 媒体下载的并发连接数，1 为使用 Pyrogram 默认的逐块下载
+        self.TG_DOWNLOAD_CONNECTIONS = self.get_int("TG_DOWNLOAD_CONNECTIONS", 4)
+        # 等待用户确认时提前下载不超过此大小 (MB) 的 Telegram 文件，取消时丢弃；0 为关闭
+        self.DOWNLOAD_AHEAD_MAX_SIZE = self.get_int("DOWNLOAD_AHEAD_MB", 0) * 1024 * 1024
+        # 单个文件的大小上限 (MB)，超过时视频在关键帧处分割，其它文件分卷；SPLIT_OVERSIZE 为 0 时直接报错
+        self.MAX_FILE_SIZE = self.get_int("MAX_FILE_SIZE_MB", 2000) * 1024 * 1024
+        self.SPLIT_OVERSIZE = self.get_int("SPLIT_OVERSIZE", 1) > 0
+        self.PARALLEL_PART_UPLOADS = self.get_int("PARALLEL_PART_UPLOADS", 2)
+        # 批量任务 (相册、消息范围、多个链接) 的条目数上限
+        self.BATCH_MAX_ITEMS = self.get_int("BATCH_MAX_ITEMS", 1000)
+        # 下载目录的空间预算 (0 为不限制)、需要保留的最小剩余空间，以及可续传数据的保留时间
+        self.STORAGE_BUDGET = self.get_int("STORAGE_BUDGET_MB", 0) * 1024 * 1024
+        self.STORAGE_MIN_FREE = self.get_int("STORAGE_MIN_FREE_MB", 512) * 1024 * 1024
+        self.PARTIAL_TTL_HOURS = self.get_int("PARTIAL_TTL_HOURS", 24)
+        # 并发分片上传: 10MB 以上的本地文件自行分片，经多个媒体连接并发上传
+        self.PARALLEL_UPLOAD = self.get_int("PARALLEL_UPLOAD", 1) > 0
+        self.UPLOAD_WORKERS = self.get_int("UPLOAD_WORKERS", 8)
+        self.UPLOAD_CONNECTIONS = self.get_int("UPLOAD_CONNECTIONS", 2)
+        # aria2 JSON-RPC: 未配置 ARIA2_RPC_URL 时自动启动本地 aria2c 守护进程
+        self.ARIA2_RPC_URL = self.get("ARIA2_RPC_URL") or None
+        self.ARIA2_RPC_SECRET = self.get("ARIA2_RPC_SECRET") or None
+        # M3U8 下载引擎: native 为内置的并发分片下载器，ffmpeg 为交给 ffmpeg 逐个下载
+        self.M3U8_ENGINE = (self.get("M3U8_ENGINE") or "native").lower()
+        self.HLS_CONCURRENCY = self.get_int("HLS_CONCURRENCY", 8)
+        # 同时运行的 ffmpeg/ffprobe 进程数，0 为可用的 CPU 核数
+        self.MEDIA_WORKERS = self.get_int("MEDIA_WORKERS", 0)
+        # 抖音解析接口 (可替换为自建的兼容服务) 及解析结果的缓存时间 (秒)
+        self.DOUYIN_API_URL = self.get("DOUYIN_API_URL") or "https://api.douyin.wtf/api"
+        self.DOUYIN_CACHE_TTL = self.get_int("DOUYIN_CACHE_TTL", 600)
+        # 进度消息: 所有任务共享的每分钟编辑次数上限，以及单条消息的最小更新间隔 (秒)
+        self.PROGRESS_EDITS_PER_MINUTE = self.get_int("PROGRESS_EDITS_PER_MINUTE", 30)
+        self.PROGRESS_MIN_INTERVAL = self.get_int("PROGRESS_MIN_INTERVAL", 2)
+
+        # 运行角色: all 为单进程；coordinator 只接收消息和确认，任务放入共享的任务队列；worker 从队列领取并执行任务
+        self.ROLE = (self.get("ROLE") or "all").lower()
+        # 工作进程的标识，同一主机上的多个工作进程必须不同；用于会话文件名和任务领取记录
+        self.WORKER_ID = self.get("WORKER_ID") or socket.gethostname()
+        # 工作进程发送文件使用的辅助会话 (string_session_generator.py 生成的会话字符串)，留空时使用机器人本身
+        self.WORKER_SESSION_STRING = self.get("WORKER_SESSION_STRING")
+        # 自动启动的本地 aria2c 的 RPC 端口；工作进程未指定时按 WORKER_ID 在 6800-7799 中选取，
+        # 同一主机上的多个工作进程不会连到彼此的 aria2c
+        default_port = 6800
+        if self.ROLE == "worker":
+            default_port += int(hashlib.sha1(self.WORKER_ID.encode()).hexdigest(), 16) % 1000
+        self.ARIA2_RPC_PORT = self.get_int("ARIA2_RPC_PORT", default_port)
+
+        # 监控: /metrics 端口 (0 为关闭)，以及可选的事件循环采样分析 (采样间隔毫秒，0 为关闭)
+        self.METRICS_PORT = self.get_int("METRICS_PORT", 0)
+        self.METRICS_HOST = self.get("METRICS_HOST") or "127.0.0.1"
+        self.PROFILE_SAMPLE_MS = self.get_int("PROFILE_SAMPLE_MS", 0)
+        self.PROFILE_OUTPUT = self.get("PROFILE_OUTPUT") or "sessions/profile.folded"
+
         if not all([self.API_ID, self.API_HASH, self.BOT_TOKEN, self.SAVE_TO_CHAT_ID]):
             raise ValueError("ID, HASH, TOKEN, 和 SAVE_TO_CHAT_ID 是必填项。")
+        if self.ROLE not in ("all", "coordinator", "worker"):
+            raise ValueError(f"ROLE 必须是 all、coordinator 或 worker，而不是 {self.ROLE}。")
 
     def get(self, key, default=None):
         return os.environ.get(key) or self._data.get(key, default)
 
+    def get_int(self, key, default: int) -> int:
+        """读取整数配置，空字符串视为未配置"""
+        value = self.get(key)
+        return int(value) if value not in (None, "") else default
+
+
+VIDEO_SUFFIXES = ['.mp4', '.mkv', '.mov', '.flv', '.avi', '.wmv', '.webm', '.m4v']
+PHOTO_SUFFIXES = ['.jpg', '.jpeg', '.png', '.webp', '.gif']
+
+
+@dataclass
+class MediaStream:
+    """可以边下载边上传的数据源"""
+    file_name: str
+    file_size: int | None
+    chunks: AsyncIterator[bytes]
+    mime_type: str = "application/octet-stream"
+    video: dict | None = None  # duration/width/height，存在时以视频形式发送
+    thumb_file_id: str | None = None  # 源消息自带的缩略图
+    release: Callable[[], Awaitable] | None = None  # 释放数据源预先打开的连接
+    digest: str | None = None  # 上传完成后的内容哈希 (ContentHasher)
+
+    async def aclose(self):
+        """关闭数据源；尚未开始读取的生成器不会执行自己的清理代码，需要通过 release 释放"""
+        await self.chunks.aclose()
+        if self.release:
+            await self.release()
+
+
+class ContentHasher:
+    """
+    按 4MB 块计算的内容哈希: 每块的 SHA-256 按顺序拼接后再做一次 SHA-256 (与 Dropbox content_hash 的构造相同)。
+    各块互不依赖，分段并发下载时每段用自己的游标在写入磁盘的同一份数据上顺序更新，不需要再读一遍文件；
+    已完成的块摘要保存在断点续传的状态文件中，续传时只需重新读取未完成的那一块。
+    """
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, size: int | None = None, blocks: dict | None = None):
+        self.size = size
+        # 块序号 -> 十六进制摘要 (从 JSON 恢复时键是字符串)
+        self.blocks = {int(k): v for k, v in (blocks or {}).items()}
+        self.broken = False
+
+    def cursor(self, start: int = 0, offset: int | None = None, fd: int | None = None) -> "HashCursor":
+        """
+        为从 start 开始的一段数据创建游标，offset 为已写入的位置 (续传)。
+        start 必须位于块边界；offset 落在块中间时从 fd 读取该块已写入的部分。
+        """
+        offset = start if offset is None else offset
+        cursor = HashCursor(self, offset)
+        if start % self.BLOCK_SIZE:
+            self.broken = True
+        elif offset % self.BLOCK_SIZE:
+            if fd is None:
+                self.broken = True
+            else:
+                position = offset - offset % self.BLOCK_SIZE
+                while position < offset:
+                    data = os.pread(fd, min(offset - position, 1024 * 1024), position)
+                    if not data:
+                        self.broken = True
+                        break
+                    cursor._block.update(data)
+                    position += len(data)
+        return cursor
+
+    def hexdigest(self) -> str | None:
+        """所有块都已完成时返回内容哈希，否则返回 None"""
+        if self.broken or self.size is None:
+            return None
+        count = math.ceil(self.size / self.BLOCK_SIZE)
+        if any(index not in self.blocks for index in range(count)):
+            return None
+        return hashlib.sha256(b"".join(bytes.fromhex(self.blocks[i]) for i in range(count))).hexdigest()
+
+    @classmethod
+    def hash_file(cls, file_path: str) -> str:
+        """读取整个文件计算内容哈希 (这是一个阻塞方法，仅用于下载时没有计算哈希的文件)"""
+        hasher = cls(os.path.getsize(file_path))
+        cursor = hasher.cursor()
+        with open(file_path, 'rb') as f:
+            while chunk := f.read(cls.BLOCK_SIZE):
+                cursor.update(chunk)
+        cursor.finish()
+        return hasher.hexdigest()
+
+
+class HashCursor:
+    """ContentHasher 中一段连续数据的写入位置"""
+
+    def __init__(self, hasher: ContentHasher, offset: int):
+        self.hasher = hasher
+        self.offset = offset
+        self._block = hashlib.sha256()
+
+    def update(self, data: bytes):
+        size = ContentHasher.BLOCK_SIZE
+        view = memoryview(data)
+        while view:
+            index, position = divmod(self.offset, size)
+            take = min(len(view), size - position)
+            self._block.update(view[:take])
+            self.offset += take
+            view = view[take:]
+            if self.offset % size == 0 or self.offset == self.hasher.size:
+                self.hasher.blocks[index] = self._block.hexdigest()
+                self._block = hashlib.sha256()
+
+    def finish(self):
+        """数据流结束: 大小未知时以当前位置为文件大小，并完成最后一个不满的块"""
+        if self.hasher.size is None:
+            self.hasher.size = self.offset
+            if self.offset % ContentHasher.BLOCK_SIZE:
+                self.hasher.blocks[self.offset // ContentHasher.BLOCK_SIZE] = self._block.hexdigest()
+
+
+class StreamUploader:
+    """
+    把任意大小的分块数据重新切成 512KB 的分片，经有界队列交给多个 worker
+    并发调用 upload.saveBigFilePart，worker 轮流分布在多个媒体会话 (MTProto 连接) 上。
+    大小未知时 file_total_parts 先传 -1，最后一个分片等其余分片全部完成后再带上真实分片数发送。
+    经过的数据同时计算内容哈希 (digest)，大小已知时检查实际字节数是否一致。
+    """
+    PART_SIZE = 512 * 1024
+    MAX_RETRIES = 3
+    # saveBigFilePart 只适用于 10MB 以上的文件，更小的文件走普通上传流程
+    MIN_SIZE = 10 * 1024 * 1024
+
+    def __init__(self, bot: Client, file_name: str, file_size: int | None, workers: int = 4,
+                 buffer_parts: int = 16, connections: int = 1):
+        self.bot = bot
+        self.file_name = file_name
+        self.file_size = file_size
+        self.workers = max(1, workers)
+        self.connections = max(1, min(connections, self.workers))
+        self.buffer_parts = max(1, buffer_parts)
+        self.file_id = bot.rnd_id()
+        self.total_parts = math.ceil(file_size / self.PART_SIZE) if file_size else -1
+        self.uploaded = 0
+        self.hasher = ContentHasher(file_size)
+        self._error = None
+        self._sessions = []
+
+    @property
+    def digest(self) -> str | None:
+        return self.hasher.hexdigest()
+
+    async def _new_session(self) -> Session:
+        session = Session(
+            self.bot, await self.bot.storage.dc_id(), await self.bot.storage.auth_key(),
+            await self.bot.storage.test_mode(), is_media=True
+        )
+        await session.start()
+        return session
+
+    async def _save_part(self, index: int, data: bytes, total_parts: int):
+        for attempt in range(1, self.MAX_RETRIES + 1):
+            # 重试时换一个会话，避免卡在出问题的连接上
+            session = self._sessions[(index + attempt - 1) % len(self._sessions)]
+            try:
+                await session.invoke(raw.functions.upload.SaveBigFilePart(
+                    file_id=self.file_id, file_part=index, file_total_parts=total_parts, bytes=data
+                ))
+                self.uploaded += len(data)
+                return
+            except Exception as e:
+                if attempt == self.MAX_RETRIES:
+                    raise
+                logger.warning(f"分片 {index} 上传失败 (第 {attempt} 次): {e}，稍后重试")
+                await asyncio.sleep(attempt)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            index, data = await queue.get()
+            try:
+                if self._error is None:
+                    await self._save_part(index, data, self.total_parts)
+            except Exception as e:
+                self._error = e
+            finally:
+                queue.task_done()
+
+    async def upload(self, chunks: AsyncIterator[bytes], progress=None, progress_args=()) -> raw.types.InputFileBig:
+        queue = asyncio.Queue(self.buffer_parts)
+        workers = []
+        try:
+            started = await asyncio.gather(*(self._new_session() for _ in range(self.connections)),
+                                           return_exceptions=True)
+            self._sessions = [s for s in started if not isinstance(s, BaseException)]
+            if not self._sessions:
+                raise started[0]
+            if len(self._sessions) < self.connections:
+                logger.warning(f"只建立了 {len(self._sessions)}/{self.connections} 个上传连接")
+            workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+            buffer = bytearray()
+            index = 0
+            cursor = self.hasher.cursor()
+            async for chunk in chunks:
+                cursor.update(chunk)
+                buffer += chunk
+                # 只发送确定不是最后一片的数据，最后一片需要等待流结束
+                while len(buffer) > self.PART_SIZE:
+                    await queue.put((index, bytes(buffer[:self.PART_SIZE])))
+                    del buffer[:self.PART_SIZE]
+                    index += 1
+                    if self._error:
+                        raise self._error
+                    if progress:
+                        await progress(self.uploaded, self.file_size or 0, *progress_args)
+
+            if not buffer and index == 0:
+                raise ValueError("数据源为空")
+            await queue.join()
+            if self._error:
+                raise self._error
+
+            cursor.finish()
+            if self.file_size and cursor.offset != self.file_size:
+                raise IOError(f"数据大小与预期不符: 预期 {self.file_size} 字节，实际 {cursor.offset} 字节")
+            total_parts = index + 1
+            await self._save_part(index, bytes(buffer), total_parts)
+            if progress:
+                await progress(self.uploaded, self.file_size or self.uploaded, *progress_args)
+            return raw.types.InputFileBig(id=self.file_id, parts=total_parts, name=self.file_name)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            for session in self._sessions:
+                with suppress(Exception):
+                    await session.stop()
+            self._sessions = []
+
+
+async def read_file_chunks(file_path: str, chunk_size: int = 4 * 1024 * 1024) -> AsyncIterator[bytes]:
+    """在线程池中分块读取本地文件，避免阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    with open(file_path, 'rb') as f:
+        while chunk := await loop.run_in_executor(None, f.read, chunk_size):
+            yield chunk
+
+
+def unique_path(path: str) -> str:
+    """路径已存在时在文件名后追加序号"""
+    base, ext = os.path.splitext(path)
+    index = 1
+    while os.path.exists(path):
+        path = f"{base} ({index}){ext}"
+        index += 1
+    return path
+
+
+def available_cpus() -> int:
+    """当前进程可以使用的 CPU 核数 (考虑 taskset/cpuset 的限制)"""
+    with suppress(AttributeError, OSError):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+class MediaPool:
+    """
+    ffmpeg/ffprobe 子进程的专用池，槽位数默认等于可用的 CPU 核数。
+    等待的作业按优先级放行: 元数据和缩略图优先，其次是复制封装和切分，最后是重新编码；
+    多于一个槽位时复制封装和重新编码最多占用 槽位数 - 1 个，快速作业不会被长时间的重新编码堵住。
+    低优先级的子进程以更高的 nice 值运行，并记录每个作业消耗的 CPU 时间。
+    """
+    PROBE, COPY, ENCODE = 0, 1, 2
+    KINDS = {PROBE: "probe", COPY: "copy", ENCODE: "encode"}
+    NICE = {PROBE: 0, COPY: 5, ENCODE: 10}
+
+    def __init__(self, workers: int = 0):
+        self.workers = workers or available_cpus()
+        self.running = 0
+        self._waiters = []  # 最小堆: (优先级, 序号, future)
+        self._seq = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return sum(not future.done() for _, _, future in self._waiters)
+
+    def _can_run(self, priority: int) -> bool:
+        limit = self.workers if priority == self.PROBE or self.workers == 1 else self.workers - 1
+        return self.running < limit
+
+    def _wake(self):
+        while self._waiters and self._can_run(self._waiters[0][0]):
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.running += 1
+                future.set_result(None)
+
+    def _release(self):
+        self.running -= 1
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, priority: int):
+        """按优先级等待一个槽位"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        queued_at = time.monotonic()
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+        METRICS.observe("media_queue_wait_seconds", time.monotonic() - queued_at, "媒体处理池中的排队时间",
+                        kind=self.KINDS[priority])
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def spawn(self, priority: int, program: str, *args: str) -> asyncio.subprocess.Process:
+        """启动子进程，低优先级的作业降低调度优先级 (nice)"""
+        nice = self.NICE[priority]
+        preexec_fn = (lambda: os.nice(nice)) if nice and hasattr(os, "nice") else None
+        return await asyncio.create_subprocess_exec(
+            program, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, preexec_fn=preexec_fn
+        )
+
+    @staticmethod
+    def cpu_seconds(pid: int) -> float | None:
+        """从 /proc 读取子进程 (含其子进程) 已用的用户态和内核态 CPU 时间，不可用时返回 None"""
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            return None
+        # utime、stime、cutime、cstime 是第 14-17 个字段，去掉 pid 和进程名后从 11 开始
+        return sum(int(x) for x in fields[11:15]) / os.sysconf("SC_CLK_TCK")
+
+    def record_cpu(self, priority: int, seconds: float):
+        _, source = current_job.get()
+        kind = self.KINDS[priority]
+        METRICS.inc("media_cpu_seconds_total", seconds, "媒体处理子进程消耗的 CPU 时间", kind=kind, source=source)
+        METRICS.observe("media_job_cpu_seconds", seconds, "每个媒体处理作业消耗的 CPU 时间", kind=kind)
+
+
+MEDIA_POOL = MediaPool()
+
+
+async def ffprobe(target: str, input_args: list[str] = ()) -> dict:
+    """使用 ffprobe 读取文件或流的格式和所有流信息"""
+    async with MEDIA_POOL.slot(MediaPool.PROBE):
+        try:
+            process = await MEDIA_POOL.spawn(
+                MediaPool.PROBE, "ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams",
+                *input_args, target
+            )
+        except FileNotFoundError:
+            raise IOError("FFprobe 未安装。")
+        try:
+            stdout, stderr = await process.communicate()
+        except BaseException:
+            with suppress(ProcessLookupError):
+                process.kill()
+            raise
+    if process.returncode:
+        raise IOError(f"FFprobe 错误: {stderr.decode(errors='ignore').strip()[-300:]}")
+    return json.loads(stdout or b"{}")
+
+
+async def run_ffmpeg(args: list[str], on_progress=None, priority: int = MediaPool.COPY, phase: str | None = None):
+    """
+    在媒体处理池中异步运行 ffmpeg，通过 -progress 输出逐块回报进度 (键值对字典)。
+    被取消时 (包括仍在池中排队时) 立即结束 ffmpeg 子进程，不会遗留在后台。
+    phase 为计入的指标阶段 (例如 "transcode"、"split")；调用方已在其他阶段内时不传，避免重复计时。
+    """
+    async with MEDIA_POOL.slot(priority), (METRICS.span(phase) if phase else nullcontext({})) as span:
+        try:
+            process = await MEDIA_POOL.spawn(
+                priority, "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostats", "-progress", "pipe:1", "-y",
+                *args
+            )
+        except FileNotFoundError:
+            logger.error("FFmpeg 命令未找到。请确保 FFmpeg 已安装并位于系统的 PATH 中。")
+            raise IOError("FFmpeg 未安装。")
+        stderr_task = asyncio.create_task(process.stderr.read())
+        cpu = None
+        try:
+            block = {}
+            async for line in process.stdout:
+                key, _, value = line.decode(errors="ignore").strip().partition("=")
+                block[key] = value
+                if key == "progress":
+                    # 进程退出后无法再读取，每块进度 (最后一块在退出前输出) 时采样一次 CPU 时间
+                    cpu = MEDIA_POOL.cpu_seconds(process.pid) or cpu
+                    if on_progress:
+                        await on_progress(block)
+                    block = {}
+            returncode = await process.wait()
+        except BaseException:
+            with suppress(ProcessLookupError):
+                process.kill()
+            await process.wait()
+            stderr_task.cancel()
+            raise
+        finally:
+            if cpu is not None:
+                span["cpu"] = cpu
+                MEDIA_POOL.record_cpu(priority, cpu)
+        stderr = (await stderr_task).decode(errors="ignore").strip()
+        if returncode:
+            logger.error(f"FFmpeg 执行失败: {stderr}")
+            raise IOError(MESSAGES['ffmpeg_failed'])
+
+
+_http_client: httpx.AsyncClient | None = None
+
+
+def http_client() -> httpx.AsyncClient:
+    """
+    所有下载器和处理器共享的 HTTP 客户端。
+    连接在请求之间保持，同一主机的后续请求无需重新进行 TCP/TLS 握手；首次使用时在当前事件循环中创建。
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            follow_redirects=True, timeout=httpx.Timeout(30, read=60),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60)
+        )
+    return _http_client
+
+
+async def close_http_client():
+    if _http_client is not None:
+        await _http_client.aclose()
+
+
+class TTLCache:
+    """容量有限的 LRU 缓存，条目在 ttl 秒后过期"""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (过期时间, 值)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        if item[0] < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+# 下载时顺带计算的内容哈希: 文件路径 -> ContentHasher 的摘要，上传前直接使用，无需再读一遍文件
+CONTENT_DIGESTS = TTLCache(maxsize=1024, ttl=24 * 3600)
+
+
+# --- 监控 ---
+# 当前任务 (任务 ID, 来源类型)，由 BotHandlers._run_task 设置，子任务自动继承
+current_job = contextvars.ContextVar("current_job", default=(None, "none"))
+
+
+class Metrics:
+    """
+    Prometheus 文本格式的指标，以及按任务阶段记录的 span。
+    span 结束时记入 job_phase_seconds 直方图和按来源类型统计的字节数，并以 JSON 输出一条 span 日志。
+    """
+    BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self):
+        self._help = {}  # 指标名 -> (类型, 说明)
+        self._counters = {}  # (指标名, 标签) -> 值
+        self._histograms = {}  # (指标名, 标签) -> [各桶计数..., 总和, 次数]
+        self._gauges = {}  # (指标名, 标签) -> 返回当前值的函数
+        self.span_logger = logging.getLogger("spans")
+
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, help: str = "", **labels):
+        self._help.setdefault(name, ("counter", help))
+        key = (name, self._labels(labels))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, help: str = "", **labels):
+        self._help.setdefault(name, ("histogram", help))
+        key = (name, self._labels(labels))
+        hist = self._histograms.setdefault(key, [0] * (len(self.BUCKETS) + 2))
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                hist[i] += 1
+        hist[-2] += value
+        hist[-1] += 1
+
+    def gauge(self, name: str, func: Callable[[], float], help: str = "", **labels):
+        self._help.setdefault(name, ("gauge", help))
+        self._gauges[(name, self._labels(labels))] = func
+
+    def record_span(self, phase: str, duration: float, status: str = "ok", size: int = 0, cpu: float | None = None):
+        job_id, source = current_job.get()
+        self.observe("job_phase_seconds", duration, "任务各阶段的耗时", phase=phase, source=source)
+        if size:
+            self.inc("job_bytes_total", size, "各阶段传输的字节数", phase=phase, source=source)
+            self.inc("job_transfer_seconds_total", duration, "传输字节所用的时间，与字节数相除即吞吐量",
+                     phase=phase, source=source)
+        self.span_logger.info(json.dumps({
+            "job": job_id, "source": source, "phase": phase, "status": status,
+            "duration": round(duration, 3), "bytes": size,
+            "throughput": round(size / duration) if size and duration > 0 else None,
+            **({"cpu_seconds": round(cpu, 3)} if cpu is not None else {})
+        }, ensure_ascii=False))
+
+    @asynccontextmanager
+    async def span(self, phase: str):
+        """记录一个阶段的耗时；可在块内设置 span["bytes"] 和 span["cpu"] (子进程的 CPU 时间)"""
+        span = {"bytes": 0}
+        start = time.monotonic()
+        status = "ok"
+        try:
+            yield span
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            self.record_span(phase, time.monotonic() - start, status, span["bytes"], span.get("cpu"))
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help) in sorted(self._help.items()):
+            lines.append(f"# HELP {name} {help or name}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (n, labels), value in self._counters.items():
+                    if n == name:
+                        lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+            elif kind == "gauge":
+                for (n, labels), func in self._gauges.items():
+                    if n == name:
+                        try:
+                            value = float(func())
+                        except Exception:
+                            continue
+                        lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+            else:
+                for (n, labels), hist in self._histograms.items():
+                    if n != name:
+                        continue
+                    for bound, count in zip(self.BUCKETS, hist):
+                        lines.append(f"{name}_bucket{self._format_labels(labels, (('le', f'{bound:g}'),))} {count}")
+                    lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {hist[-1]}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {hist[-2]:g}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {hist[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+def record_flood_wait(where: str, seconds: float):
+    METRICS.inc("flood_wait_total", 1, "收到的 FloodWait 次数", where=where)
+    METRICS.inc("flood_wait_seconds_total", seconds, "FloodWait 要求等待的总秒数", where=where)
+
+
+class FloodWaitLogHandler(logging.Handler):
+    """Pyrogram 在 sleep_threshold 以内会自行等待 FloodWait 并只输出一条日志，从日志中统计这些等待"""
+
+    def emit(self, record: logging.LogRecord):
+        if isinstance(record.msg, str) and "Waiting for %s seconds" in record.msg and len(record.args) >= 3:
+            with suppress(TypeError, ValueError):
+                record_flood_wait(f"pyrogram:{record.args[2]}", float(record.args[1]))
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """记录排队和执行中的任务数的默认线程池，用于观察 run_in_executor 是否饱和"""
+
+    def __init__(self, max_workers: int | None = None):
+        super().__init__(max_workers=max_workers or min(32, (os.cpu_count() or 1) + 4))
+        self.queued = 0
+        self.running = 0
+        self._counter_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._counter_lock:
+            self.queued += 1
+        submitted_at = time.monotonic()
+
+        def run():
+            with self._counter_lock:
+                self.queued -= 1
+                self.running += 1
+            METRICS.observe("executor_queue_wait_seconds", time.monotonic() - submitted_at, "线程池中的排队时间")
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._counter_lock:
+                    self.running -= 1
+
+        return super().submit(run)
+
+
+class LoopProfiler:
+    """
+    可选的采样分析器: 后台线程按固定间隔记录事件循环线程的调用栈，
+    以 flamegraph 使用的折叠格式 (每行 "帧;帧;帧 次数") 输出，可以看出事件循环被哪些同步代码占用。
+    """
+
+    def __init__(self, interval: float, output: str):
+        self.interval = interval
+        self.output = output
+        self.samples = {}
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="loop-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.samples.items(), key=lambda x: -x[1]))
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        os.makedirs(os.path.dirname(self.output) or '.', exist_ok=True)
+        with open(self.output, 'w') as f:
+            f.write(self.folded())
+        logger.info(f"采样分析结果已写入 {self.output}")
+
+
+async def monitor_loop_lag(interval: float = 0.5):
+    """测量事件循环的调度延迟，长时间阻塞事件循环的同步代码会使它升高"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        METRICS.observe("event_loop_lag_seconds", loop.time() - start - interval, "事件循环的调度延迟")
+
+
+class MetricsServer:
+    """只提供 GET /metrics (以及启用采样分析时的 /profile) 的最小 HTTP 服务"""
+
+    def __init__(self, host: str, port: int, profiler: LoopProfiler | None = None):
+        self.host = host
+        self.port = port
+        self.profiler = profiler
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"指标服务已启动: http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await asyncio.wait_for(reader.readline(), 10)).decode(errors="ignore")
+            # 读完请求头，内容无需处理
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.split()
+            path = parts[1].split("?")[0] if len(parts) > 1 else ""
+            if path == "/metrics":
+                status, body = "200 OK", METRICS.render()
+            elif path == "/profile" and self.profiler:
+                status, body = "200 OK", self.profiler.folded()
+            else:
+                status, body = "404 Not Found", "not found\n"
+            data = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+
+def filename_from_response(response: httpx.Response, url: str) -> str:
+    """
+    优先从 Content-Disposition 中取文件名，其次使用 (重定向后的) URL 路径，
+    都不可用时以时间戳命名并按 Content-Type 补上扩展名
+    """
+    disposition = response.headers.get("Content-Disposition", "")
+    match = re.search(r"filename\*\s*=\s*[^']*'[^']*'([^;]+)", disposition, re.IGNORECASE)
+    if match:
+        name = unquote(match.group(1).strip().strip('"'))
+    else:
+        match = re.search(r'filename\s*=\s*"?([^";]+)"?', disposition, re.IGNORECASE)
+        name = match.group(1).strip() if match else ""
+    for candidate in (name, unquote(response.url.path or urlparse(url).path)):
+        # 去掉路径分隔符，防止写到下载目录之外；"." 和 ".." 会指向目录本身或上级目录
+        candidate = os.path.basename(candidate.replace("\\", "/")).strip()
+        if candidate not in ("", ".", ".."):
+            return candidate
+    mime_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+    return str(int(time.time())) + (mimetypes.guess_extension(mime_type) or "")
+
+
+class SourceChanged(IOError):
+    """下载过程中源文件被修改 (ETag 变化)，已下载的数据不能再使用"""
+
+
+class HttpDownloader:
+    """
+    基于 httpx 的异步 HTTP 下载器。
+    服务器支持 Range 时把文件分成若干段并发下载，按偏移量写入预分配的 .part 文件，
+    并把每段进度记录到旁边的 .json 状态文件中，失败重试或重新提交时从断点继续。
+    每段的响应都会核对 Content-Range 和 ETag，不符时只重试该段；写入的数据同时计算内容哈希 (digest)。
+    """
+    CHUNK_SIZE = 256 * 1024
+    MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+    MAX_RETRIES = 5
+
+    def __init__(self, download_dir: str, connections: int = 4, partial_dir: str | None = None):
+        self.download_dir = download_dir
+        # 未完成的数据可以放在单独的目录中，任务目录被删除后重新提交仍可续传
+        self.partial_dir = partial_dir or download_dir
+        self.connections = max(1, connections)
+        self.downloaded = 0
+        self.total = 0
+        self.digest = None
+
+    @staticmethod
+    async def probe(client: httpx.AsyncClient, url: str) -> tuple[str, str, int | None, bool, str | None]:
+        """请求第一个字节，返回 (最终 URL, 文件名, 大小, 是否支持 Range, ETag)"""
+        headers = {"Range": "bytes=0-0", "Accept-Encoding": "identity"}
+        async with client.stream("GET", url, headers=headers) as response:
+            response.raise_for_status()
+            file_name = filename_from_response(response, url)
+            etag = response.headers.get("ETag")
+            if response.status_code == 206:
+                match = re.search(r"/(\d+)$", response.headers.get("Content-Range", ""))
+                return str(response.url), file_name, int(match.group(1)) if match else None, True, etag
+            content_length = response.headers.get("Content-Length")
+            size = int(content_length) if content_length and content_length.isdigit() else None
+            return str(response.url), file_name, size, False, etag
+
+    def _load_state(self, state_path: str, size: int | None, etag: str | None) -> dict | None:
+        with suppress(FileNotFoundError, ValueError):
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+            if state.get("size") == size and state.get("etag") == etag:
+                return state
+        return None
+
+    @staticmethod
+    def _save_state(state_path: str, state: dict):
+        with open(state_path, 'w') as f:
+            json.dump(state, f)
+
+    def _plan_segments(self, size: int) -> list[list[int]]:
+        """每段为 [起始, 结束 (含), 当前位置]；段的起点对齐到哈希块边界"""
+        count = max(1, min(self.connections, size // self.MIN_SEGMENT_SIZE))
+        block = ContentHasher.BLOCK_SIZE
+        step = math.ceil(size / count / block) * block
+        return [[start, min(start + step, size) - 1, start] for start in range(0, size, step)]
+
+    @staticmethod
+    def _check_response(response: httpx.Response, etag: str | None, start: int | None = None):
+        """核对响应是否属于同一版本的文件以及是否从请求的位置开始"""
+        if etag and response.headers.get("ETag") not in (None, etag):
+            raise SourceChanged(f"文件在下载过程中被修改 (ETag {etag} -> {response.headers['ETag']})")
+        if start is not None:
+            match = re.match(r"bytes (\d+)-", response.headers.get("Content-Range", ""))
+            if not match or int(match.group(1)) != start:
+                raise IOError(f"服务器返回的范围不符: {response.headers.get('Content-Range')}")
+
+    async def _fetch_segment(self, client: httpx.AsyncClient, url: str, fd: int, segment: list[int],
+                             etag: str | None, cursor: HashCursor):
+        for attempt in range(1, self.MAX_RETRIES + 1):
+            if segment[2] > segment[1]:
+                return
+            try:
+                headers = {"Range": f"bytes={segment[2]}-{segment[1]}", "Accept-Encoding": "identity"}
+                if etag and not etag.startswith("W/"):
+                    # 文件已被修改时服务器返回完整的新文件 (200) 而不是范围
+                    headers["If-Range"] = etag
+                async with client.stream("GET", url, headers=headers) as response:
+                    self._check_response(response, etag)
+                    if response.status_code != 206:
+                        raise IOError(f"服务器未按范围返回数据 (HTTP {response.status_code})")
+                    self._check_response(response, None, segment[2])
+                    async for chunk in response.aiter_raw(self.CHUNK_SIZE):
+                        chunk = chunk[:segment[1] - segment[2] + 1]
+                        os.pwrite(fd, chunk, segment[2])
+                        cursor.update(chunk)
+                        segment[2] += len(chunk)
+                        self.downloaded += len(chunk)
+                        if segment[2] > segment[1]:
+                            return
+                raise IOError("连接提前结束")
+            except SourceChanged:
+                raise
+            except (httpx.HTTPError, IOError) as e:
+                if attempt == self.MAX_RETRIES:
+                    raise IOError(f"分段 {segment[0]}-{segment[1]} 下载失败: {e}")
+                logger.warning(f"分段 {segment[0]}-{segment[1]} 下载出错 (第 {attempt} 次): {e}，稍后从断点重试")
+                await asyncio.sleep(attempt)
+
+    async def _fetch_single(self, client: httpx.AsyncClient, url: str, part_path: str, accept_ranges: bool,
+                            etag: str | None, hasher: ContentHasher):
+        """不支持分段时单连接下载，支持 Range 的服务器仍可从已有数据处续传"""
+        # 上次运行遗留的数据没有经过哈希，续传时不计算内容哈希
+        cursor = None
+        for attempt in range(1, self.MAX_RETRIES + 1):
+            position = os.path.getsize(part_path) if accept_ranges and os.path.exists(part_path) else 0
+            headers = {"Accept-Encoding": "identity"}
+            if position:
+                headers["Range"] = f"bytes={position}-"
+                if etag and not etag.startswith("W/"):
+                    headers["If-Range"] = etag
+            self.downloaded = position
+            try:
+                async with client.stream("GET", url, headers=headers) as response:
+                    response.raise_for_status()
+                    self._check_response(response, etag)
+                    if position and response.status_code != 206:
+                        position = self.downloaded = 0
+                    elif position:
+                        self._check_response(response, None, position)
+                    if position == 0:
+                        hasher.blocks.clear()
+                        hasher.broken = False
+                        cursor = hasher.cursor()
+                    elif cursor is None or cursor.offset != position:
+                        hasher.broken = True
+                    with open(part_path, 'ab' if position else 'wb') as f:
+                        async for chunk in response.aiter_raw(self.CHUNK_SIZE):
+                            f.write(chunk)
+                            if cursor:
+                                cursor.update(chunk)
+                            self.downloaded += len(chunk)
+                if self.total and self.downloaded != self.total:
+                    raise IOError(f"数据大小与 Content-Length 不符: 预期 {self.total} 字节，实际 {self.downloaded} 字节")
+                if cursor:
+                    cursor.finish()
+                return
+            except SourceChanged:
+                raise
+            except (httpx.HTTPError, IOError) as e:
+                if attempt == self.MAX_RETRIES:
+                    raise IOError(f"下载失败: {e}")
+                logger.warning(f"下载出错 (第 {attempt} 次): {e}，稍后重试")
+                await asyncio.sleep(attempt)
+
+    async def _report(self, progress, progress_args, state_path: str, state: dict | None):
+        while True:
+            await asyncio.sleep(1)
+            if state is not None:
+                self._save_state(state_path, state)
+            if progress:
+                await progress(self.downloaded, self.total, *progress_args)
+
+    async def download(self, url: str, progress=None, progress_args=(), file_name: str | None = None,
+                       probe: tuple | None = None, on_part=None) -> str:
+        """
+        下载到 download_dir 并返回文件路径，未指定 file_name 时按响应头或 URL 命名。
+        probe 为之前 probe() 的结果，提供时不再重新探测。
+        on_part(路径) 在确定未完成数据的文件后调用，供 StorageManager 把它计入任务的预留。
+        中断 (包括取消) 时保留未完成的数据以便续传，过期数据由 StorageManager 清理。
+        """
+        client = http_client()
+        url, response_name, size, accept_ranges, etag = probe or await self.probe(client, url)
+        file_name = file_name or response_name
+        self.total = size or 0
+
+        # 未完成的数据以 URL 命名，同一链接重新提交时可以续传
+        name = f".{hashlib.sha1(url.encode()).hexdigest()[:16]}"
+        part_path = os.path.join(self.partial_dir, f"{name}.part")
+        lock_fd = self._lock(part_path + ".json")
+        if lock_fd is None:
+            # 同一链接正由其他任务下载 (重复提交或其他工作进程)，改用单独的文件，不共享断点
+            logger.info(f"{url} 的未完成数据正被其他任务使用，本任务单独下载")
+            part_path = os.path.join(self.partial_dir, f"{name}-{secrets.token_hex(4)}.part")
+            lock_fd = self._lock(part_path + ".json")
+        try:
+            if on_part:
+                on_part(part_path)
+            return await self._download_locked(client, url, file_name, part_path, size, accept_ranges, etag,
+                                               progress, progress_args)
+        finally:
+            os.close(lock_fd)
+
+    @staticmethod
+    def _lock(state_path: str) -> int | None:
+        """
+        对状态文件加排他锁 (对同一主机上的其他进程同样有效)，返回文件描述符；已被其他任务锁定时返回 None。
+        锁在整个下载期间持有，防止两个任务同时写同一个 .part 文件。
+        """
+        while True:
+            fd = os.open(state_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            # 加锁前文件可能已被上一个持有者删除 (下载完成)，锁住的是已删除的文件时重新打开
+            with suppress(FileNotFoundError):
+                if os.fstat(fd).st_ino == os.stat(state_path).st_ino:
+                    return fd
+            os.close(fd)
+
+    async def _download_locked(self, client: httpx.AsyncClient, url: str, file_name: str, part_path: str,
+                               size: int | None, accept_ranges: bool, etag: str | None, progress,
+                               progress_args) -> str:
+        state_path = part_path + ".json"
+        segmented = accept_ranges and bool(size)
+        state = None
+        hasher = ContentHasher(size)
+        if segmented:
+            state = self._load_state(state_path, size, etag) if os.path.exists(part_path) else None
+            if state is None:
+                state = {"size": size, "etag": etag, "segments": self._plan_segments(size)}
+                with open(part_path, 'wb') as f:
+                    f.truncate(size)
+            # 已完成的块摘要随进度一起保存
+            hasher = ContentHasher(size, state.get("blocks"))
+            state["blocks"] = hasher.blocks
+            self.downloaded = sum(seg[2] - seg[0] for seg in state["segments"])
+
+        reporter = asyncio.create_task(self._report(progress, progress_args, state_path, state))
+        tasks = []
+        fd = None
+        try:
+            if segmented:
+                fd = os.open(part_path, os.O_RDWR)
+                tasks = [asyncio.create_task(self._fetch_segment(
+                    client, url, fd, seg, etag, hasher.cursor(seg[0], seg[2], fd)
+                )) for seg in state["segments"]]
+                await asyncio.gather(*tasks)
+            else:
+                await self._fetch_single(client, url, part_path, accept_ranges, etag, hasher)
+        except SourceChanged:
+            # 旧版本的数据不能续传，下次从头下载
+            for path in (part_path, state_path):
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+            raise
+        except BaseException:
+            if state is not None:
+                self._save_state(state_path, state)
+            raise
+        finally:
+            for task in tasks + [reporter]:
+                task.cancel()
+            await asyncio.gather(*tasks, reporter, return_exceptions=True)
+            if fd is not None:
+                os.close(fd)
+
+        output_path = unique_path(os.path.join(self.download_dir, file_name))
+        os.replace(part_path, output_path)
+        with suppress(FileNotFoundError):
+            os.remove(state_path)
+        self.digest = hasher.hexdigest()
+        if self.digest:
+            CONTENT_DIGESTS.set(output_path, self.digest)
+        if progress:
+            await progress(self.downloaded, self.total or self.downloaded, *progress_args)
+        return output_path
+
+
+class TelegramDownloader:
+    """
+    Telegram 媒体的并发分段下载器。
+    文件按 upload.GetFile 的 1MB 块划分成若干连续的段，各段并发调用 upload.GetFile，按偏移量写入预分配的 .part 文件。
+    每次下载只为文件所在的 DC 建立一个媒体会话 (跨 DC 时只生成一次授权密钥并导入一次授权)，所有段和重试共用；
+    文件被重定向到 CDN 时改用 Pyrogram 的 stream_media (由它负责解密和校验)。
+    某一段中断或收到长度不对的块时只从该段已写入的位置重试；写入的数据同时计算内容哈希 (digest)。
+    """
+    CHUNK_SIZE = 1024 * 1024  # upload.GetFile 和 stream_media 的 offset/limit 以该块大小为单位
+    MIN_SEGMENT_CHUNKS = 16
+    MAX_RETRIES = 5
+    MEDIA_KINDS = ("audio", "document", "photo", "sticker", "animation", "video", "voice", "video_note")
+
+    def __init__(self, bot: Client, download_dir: str, connections: int = 4):
+        self.bot = bot
+        self.download_dir = download_dir
+        self.connections = max(1, connections)
+        self.downloaded = 0
+        self.total = 0
+        self.digest = None
+        self._sessions = {}  # dc_id -> 本次下载的媒体会话
+        self._session_lock = asyncio.Lock()
+        self._cdn = False  # 文件在 CDN 上，改用 stream_media
+
+    @classmethod
+    def _location(cls, message: Message) -> tuple[int, raw.base.InputFileLocation]:
+        """返回消息中媒体所在的 DC 和 upload.GetFile 使用的文件位置"""
+        media = next((m for kind in cls.MEDIA_KINDS if (m := getattr(message, kind, None)) is not None), None)
+        if media is None:
+            raise ValueError("消息中没有可下载的媒体")
+        file_id = FileId.decode(media.file_id)
+        location_type = (raw.types.InputPhotoFileLocation if file_id.file_type == FileType.PHOTO
+                         else raw.types.InputDocumentFileLocation)
+        return file_id.dc_id, location_type(
+            id=file_id.media_id, access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference, thumb_size=file_id.thumbnail_size
+        )
+
+    async def _new_session(self, dc_id: int) -> Session:
+        """建立到 dc_id 的媒体会话；不是账号所在的 DC 时先生成授权密钥并导入授权"""
+        storage = self.bot.storage
+        home = dc_id == await storage.dc_id()
+        test_mode = await storage.test_mode()
+        auth_key = await storage.auth_key() if home else await Auth(self.bot, dc_id, test_mode).create()
+        session = Session(self.bot, dc_id, auth_key, test_mode, is_media=True)
+        await session.start()
+        try:
+            if not home:
+                exported = await self.bot.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                await session.invoke(raw.functions.auth.ImportAuthorization(id=exported.id, bytes=exported.bytes))
+        except BaseException:
+            with suppress(Exception):
+                await session.stop()
+            raise
+        return session
+
+    async def _session(self, dc_id: int) -> Session:
+        async with self._session_lock:
+            if dc_id not in self._sessions:
+                self._sessions[dc_id] = await self._new_session(dc_id)
+            return self._sessions[dc_id]
+
+    async def _chunks(self, message: Message, dc_id: int, location, segment: list[int]) -> AsyncIterator[bytes]:
+        """从段的当前块开始依次返回数据块，由调用方推进 segment[2]"""
+        if not self._cdn:
+            session = await self._session(dc_id)
+            offset = segment[2]
+            while offset < segment[1]:
+                result = await session.invoke(raw.functions.upload.GetFile(
+                    location=location, offset=offset * self.CHUNK_SIZE, limit=self.CHUNK_SIZE
+                ), sleep_threshold=30)
+                if isinstance(result, raw.types.upload.FileCdnRedirect):
+                    logger.info("文件位于 CDN，改用 stream_media 下载")
+                    self._cdn = True
+                    break
+                yield result.bytes
+                offset += 1
+            else:
+                return
+        # get_file 内部出错时只记录日志并结束生成器，因此由调用方按收到的块数判断是否完整
+        async with aclosing(self.bot.stream_media(
+                message, limit=segment[1] - segment[2], offset=segment[2])) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    def _plan_segments(self, size: int) -> list[list[int]]:
+        """每段为 [起始块, 结束块 (不含), 当前块]；段的起点对齐到哈希块边界"""
+        chunks = math.ceil(size / self.CHUNK_SIZE)
+        count = max(1, min(self.connections, chunks // self.MIN_SEGMENT_CHUNKS))
+        align = ContentHasher.BLOCK_SIZE // self.CHUNK_SIZE
+        step = math.ceil(chunks / count / align) * align
+        return [[start, min(start + step, chunks), start] for start in range(0, chunks, step)]
+
+    async def _fetch_segment(self, message: Message, location: tuple, fd: int, segment: list[int], cursor: HashCursor):
+        for attempt in range(1, self.MAX_RETRIES + 1):
+            if segment[2] >= segment[1]:
+                return
+            try:
+                async with aclosing(self._chunks(message, *location, segment)) as chunks:
+                    async for chunk in chunks:
+                        # 除最后一块外每块都应是完整的 1MB
+                        expected = min(self.CHUNK_SIZE, self.total - segment[2] * self.CHUNK_SIZE)
+                        if len(chunk) != expected:
+                            raise IOError(f"第 {segment[2]} 块长度不符: 预期 {expected} 字节，实际 {len(chunk)} 字节")
+                        os.pwrite(fd, chunk, segment[2] * self.CHUNK_SIZE)
+                        cursor.update(chunk)
+                        segment[2] += 1
+                        self.downloaded += len(chunk)
+                        if segment[2] >= segment[1]:
+                            return
+                raise IOError("连接提前结束")
+            except Exception as e:
+                if attempt == self.MAX_RETRIES:
+                    raise IOError(f"分段 {segment[0]}-{segment[1]} 下载失败: {e}")
+                logger.warning(f"分段 {segment[0]}-{segment[1]} 下载出错 (第 {attempt} 次): {e}，稍后从断点重试")
+                await asyncio.sleep(attempt)
+
+    def _load_state(self, state_path: str, size: int) -> dict | None:
+        with suppress(FileNotFoundError, ValueError):
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+            if state.get("size") == size:
+                return state
+        return None
+
+    @staticmethod
+    def _save_state(state_path: str, state: dict):
+        with open(state_path, 'w') as f:
+            json.dump(state, f)
+
+    async def _report(self, progress, progress_args, state_path: str, state: dict):
+        while True:
+            await asyncio.sleep(1)
+            self._save_state(state_path, state)
+            if progress:
+                await progress(self.downloaded, self.total, *progress_args)
+
+    async def download(self, message: Message, file_name: str, file_size: int, progress=None,
+                       progress_args=()) -> str:
+        """
+        下载到 download_dir 并返回文件路径。
+        各段进度保存在 .part.json 中，中断或进程重启后同一任务可从断点继续；
+        未完成的数据位于任务目录中，任务结束时由 StorageManager 删除。
+        """
+        self.total = file_size
+        # 批量任务的每个条目使用单独的子目录
+        os.makedirs(self.download_dir, exist_ok=True)
+        part_path = os.path.join(self.download_dir, f".tg-{message.chat.id}-{message.id}.part")
+        state_path = part_path + ".json"
+        state = self._load_state(state_path, file_size) if os.path.exists(part_path) else None
+        if state is None:
+            state = {"size": file_size, "segments": self._plan_segments(file_size)}
+            with open(part_path, 'wb') as f:
+                f.truncate(file_size)
+        else:
+            logger.info(f"从断点继续下载 {file_name}")
+        segments = state["segments"]
+        # 已完成的块摘要随进度一起保存
+        hasher = ContentHasher(file_size, state.get("blocks"))
+        state["blocks"] = hasher.blocks
+        self.downloaded = min(sum(seg[2] - seg[0] for seg in segments) * self.CHUNK_SIZE, file_size)
+
+        location = self._location(message)
+        reporter = asyncio.create_task(self._report(progress, progress_args, state_path, state))
+        fd = os.open(part_path, os.O_RDWR)
+        tasks = [asyncio.create_task(self._fetch_segment(message, location, fd, seg, hasher.cursor(
+            seg[0] * self.CHUNK_SIZE, seg[2] * self.CHUNK_SIZE, fd
+        ))) for seg in segments]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            self._save_state(state_path, state)
+            raise
+        finally:
+            for task in tasks + [reporter]:
+                task.cancel()
+            await asyncio.gather(*tasks, reporter, return_exceptions=True)
+            os.close(fd)
+            for session in self._sessions.values():
+                with suppress(Exception):
+                    await session.stop()
+            self._sessions.clear()
+
+        output_path = unique_path(os.path.join(self.download_dir, file_name))
+        os.replace(part_path, output_path)
+        with suppress(FileNotFoundError):
+            os.remove(state_path)
+        self.digest = hasher.hexdigest()
+        if self.digest:
+            CONTENT_DIGESTS.set(output_path, self.digest)
+        if progress:
+            await progress(self.downloaded, self.total, *progress_args)
+        return output_path
+
+
+class Aria2Client:
+    """
+    通过 JSON-RPC 控制常驻的 aria2c 进程。
+    未指定 rpc_url 时在首次使用时启动本地 aria2c (--enable-rpc)，并随本进程退出。
+    """
+    STATUS_KEYS = ["gid", "status", "totalLength", "completedLength", "followedBy", "files", "errorMessage"]
+    POLL_INTERVAL = 1  # 查询下载状态的间隔 (秒)
+
+    def __init__(self, download_dir: str, rpc_url: str | None = None, secret: str | None = None, port: int = 6800):
+        self.download_dir = download_dir
+        self.external = rpc_url is not None
+        self.rpc_url = rpc_url or f"http://127.0.0.1:{port}/jsonrpc"
+        self.secret = secret if self.external else (secret or secrets.token_hex(16))
+        self.port = port
+        self._ids = itertools.count(1)
+        self._process = None
+        self._client = None
+        self._start_lock = asyncio.Lock()
+
+    async def _ensure_started(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=10)
+        if self.external or (self._process and self._process.returncode is None):
+            return
+        async with self._start_lock:
+            if self._process and self._process.returncode is None:
+                return
+            self._process = await asyncio.create_subprocess_exec(
+                "aria2c", "--enable-rpc", f"--rpc-listen-port={self.port}", f"--rpc-secret={self.secret}",
+                f"--dir={self.download_dir}", "--seed-time=0", "--bt-stop-timeout=300", "--follow-torrent=mem",
+                f"--stop-with-process={os.getpid()}", "--quiet=true",
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+            )
+            for _ in range(50):
+                try:
+                    await self._request("aria2.getVersion")
+                    logger.info(f"aria2c RPC 已启动 (端口 {self.port})")
+                    return
+                except httpx.HTTPError:
+                    pass
+                except IOError as e:
+                    # 端口上是另一个密钥不同的 aria2c (例如同一主机上的其他工作进程)，本进程的 aria2c 无法监听
+                    raise IOError(f"端口 {self.port} 上已有其他 aria2 RPC 服务 ({e})，"
+                                  f"请为同一主机上的每个进程设置不同的 ARIA2_RPC_PORT")
+                if self._process.returncode is not None:
+                    raise IOError(f"aria2c 已退出 (退出码 {self._process.returncode})，"
+                                  f"请检查端口 {self.port} 是否被占用 (ARIA2_RPC_PORT)")
+                await asyncio.sleep(0.2)
+            raise IOError("aria2c RPC 启动失败，请检查 aria2c 是否已安装")
+
+    async def _request(self, method: str, *params):
+        token = [f"token:{self.secret}"] if self.secret else []
+        payload = {"jsonrpc": "2.0", "id": str(next(self._ids)), "method": method, "params": token + list(params)}
+        response = await self._client.post(self.rpc_url, json=payload)
+        try:
+            data = response.json()
+        except ValueError:
+            raise IOError(f"aria2 RPC 返回了无效的响应 (HTTP {response.status_code})")
+        if data.get("error"):
+            raise IOError(f"aria2 错误: {data['error'].get('message')}")
+        return data["result"]
+
+    async def call(self, method: str, *params):
+        await self._ensure_started()
+        return await self._request(method, *params)
+
+    async def pause(self, gid: str):
+        await self.call("aria2.pause", gid)
+
+    async def unpause(self, gid: str):
+        await self.call("aria2.unpause", gid)
+
+    async def download(self, uri: str, job_dir: str, progress=None, progress_args=(), on_gid=None) -> list[str]:
+        """
+        提交下载并轮询直到完成，返回该任务实际下载的文件列表。
+        磁力链接先下载元数据，之后由 followedBy 中的新 GID 接手真正的下载。
+        """
+        # continue: 目录中已有未完成的数据时 (例如重启后恢复的任务) 从断点继续
+        gid = await self.call("aria2.addUri", [uri], {"dir": job_dir, "continue": "true"})
+        gids = [gid]
+        if on_gid:
+            on_gid(gid)
+        try:
+            while True:
+                status = await self.call("aria2.tellStatus", gid, self.STATUS_KEYS)
+                if status.get("followedBy"):
+                    gid = status["followedBy"][0]
+                    gids.append(gid)
+                    if on_gid:
+                        on_gid(gid)
+                    continue
+                state = status["status"]
+                if state == "complete":
+                    return [f["path"] for f in status.get("files", [])
+                            if f.get("selected") == "true" and f.get("path") and not f["path"].startswith("[METADATA]")]
+                if state in ("error", "removed"):
+                    raise IOError(f"aria2 下载失败: {status.get('errorMessage') or state}")
+                if progress:
+                    await progress(int(status["completedLength"]), int(status["totalLength"]), state, *progress_args)
+                await asyncio.sleep(self.POLL_INTERVAL)
+        except BaseException:
+            for g in gids:
+                with suppress(Exception):
+                    await self.call("aria2.forceRemove", g)
+            raise
+        finally:
+            for g in gids:
+                with suppress(Exception):
+                    await self.call("aria2.removeDownloadResult", g)
+
+
+class UnsupportedPlaylist(ValueError):
+    """内置 HLS 下载器无法处理的播放列表 (直播、SAMPLE-AES、独立音轨等)，应交给 ffmpeg"""
+
+
+@dataclass
+class HLSSegment:
+    uri: str
+    duration: float
+    sequence: int
+    byterange: tuple[int, int] | None = None  # (长度, 偏移)
+    key: dict | None = None  # EXT-X-KEY 属性，METHOD=NONE 时为 None
+    init: dict | None = None  # EXT-X-MAP 属性
+    discontinuity: bool = False
+
+
+class HLSDownloader:
+    """
+    内置的 HLS 下载器。
+    自行解析主播放列表和媒体播放列表，选择带宽最高的码率，用有界的 httpx 连接池并发下载分片
+    (支持 BYTERANGE 和失败重试)，再在本地目录中生成引用本地分片和密钥的播放列表。
+    AES-128 解密和按顺序拼接由最终的 ffmpeg 转封装完成，无需额外的加密依赖。
+    """
+    MAX_RETRIES = 5
+    RETRY_DELAY = 1  # 第 n 次失败后等待 n * RETRY_DELAY 秒再重试
+    # 读取本地播放列表时 ffmpeg 需要的输入参数
+    FFMPEG_INPUT_ARGS = ["-allowed_extensions", "ALL", "-protocol_whitelist", "file,crypto,data"]
+
+    def __init__(self, work_dir: str, concurrency: int = 8):
+        self.work_dir = work_dir
+        self.concurrency = max(1, concurrency)
+        self.downloaded = 0
+
+    @staticmethod
+    def parse_attributes(text: str) -> dict:
+        return {key: value.strip('"') for key, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', text)}
+
+    @staticmethod
+    def parse_byterange(value: str) -> tuple[int, int | None]:
+        """解析 "<长度>[@<偏移>]"，返回 (长度, 偏移)，未写偏移时偏移为 None"""
+        length, _, offset = value.partition("@")
+        length, offset = int(length), int(offset) if offset else None
+        if length <= 0 or (offset is not None and offset < 0):
+            raise ValueError(f"无效的 BYTERANGE {value}")
+        return length, offset
+
+    @classmethod
+    def parse_master(cls, text: str, base_url: str) -> list[dict]:
+        """返回主播放列表中的所有码率，每项包含 uri 以及 EXT-X-STREAM-INF 的属性"""
+        variants, pending = [], None
+        for line in (line.strip() for line in text.splitlines()):
+            if line.startswith("#EXT-X-STREAM-INF:"):
+                pending = cls.parse_attributes(line.split(":", 1)[1])
+            elif line and not line.startswith("#") and pending is not None:
+                pending["uri"] = urljoin(base_url, line)
+                variants.append(pending)
+                pending = None
+        return variants
+
+    @classmethod
+    def parse_media(cls, text: str, base_url: str) -> list[HLSSegment]:
+        """解析媒体播放列表；格式错误 (数值无效、缺少 URI 等) 时抛出 IOError"""
+        if "#EXT-X-ENDLIST" not in text:
+            raise UnsupportedPlaylist("直播流没有 EXT-X-ENDLIST")
+        segments = []
+        sequence, duration, byterange, key, init, discontinuity = 0, 0.0, None, None, None, False
+        next_offset = {}  # BYTERANGE 未写偏移时紧接同一文件上一段的末尾
+        for line in (line.strip() for line in text.splitlines()):
+            if not line:
+                continue
+            tag, _, value = line.partition(":")
+            try:
+                if tag == "#EXT-X-MEDIA-SEQUENCE":
+                    sequence = int(value)
+                elif tag == "#EXTINF":
+                    duration = float(value.split(",")[0] or 0)
+                elif tag == "#EXT-X-BYTERANGE":
+                    byterange = cls.parse_byterange(value)
+                elif tag == "#EXT-X-DISCONTINUITY":
+                    discontinuity = True
+                elif tag == "#EXT-X-KEY":
+                    attrs = cls.parse_attributes(value)
+                    method = attrs.get("METHOD", "NONE")
+                    if method == "NONE":
+                        key = None
+                    elif method == "AES-128":
+                        attrs["URI"] = urljoin(base_url, attrs["URI"])
+                        key = attrs
+                    else:
+                        raise UnsupportedPlaylist(f"不支持的加密方式 {method}")
+                elif tag == "#EXT-X-MAP":
+                    attrs = cls.parse_attributes(value)
+                    attrs["URI"] = urljoin(base_url, attrs["URI"])
+                    if attrs.get("BYTERANGE"):
+                        cls.parse_byterange(attrs["BYTERANGE"])
+                    init = attrs
+            except UnsupportedPlaylist:
+                raise
+            except KeyError as e:
+                raise IOError(f"HLS 播放列表格式错误 ({line}): 缺少属性 {e}") from e
+            except ValueError as e:
+                raise IOError(f"HLS 播放列表格式错误 ({line}): {e}") from e
+            if not line.startswith("#"):
+                uri = urljoin(base_url, line)
+                if byterange:
+                    length, offset = byterange
+                    offset = next_offset.get(uri, 0) if offset is None else offset
+                    next_offset[uri] = offset + length
+                    byterange = (length, offset)
+                segments.append(HLSSegment(uri, duration, sequence, byterange, key, init, discontinuity))
+                sequence += 1
+                duration, byterange, discontinuity = 0.0, None, False
+        if not segments:
+            raise UnsupportedPlaylist("播放列表中没有分片")
+        return segments
+
+    async def _get(self, client: httpx.AsyncClient, url: str, byterange: tuple[int, int] | None = None) -> bytes:
+        headers = {"Range": f"bytes={byterange[1]}-{byterange[1] + byterange[0] - 1}"} if byterange else {}
+        for attempt in range(1, self.MAX_RETRIES + 1):
+            try:
+                response = await client.get(url, headers=headers)
+                response.raise_for_status()
+                data = response.content
+                if not byterange:
+                    return data
+                length, offset = byterange
+                if response.status_code == 206:
+                    # 只接受与请求一致的范围，否则拼出的分片会错位
+                    match = re.fullmatch(r"bytes (\d+)-(\d+)/(\d+|\*)", response.headers.get("Content-Range", ""))
+                    if not match or (int(match[1]), int(match[2])) != (offset, offset + length - 1):
+                        raise IOError(f"服务器返回的范围 {response.headers.get('Content-Range')!r} "
+                                      f"与请求的 {headers['Range']} 不符")
+                else:
+                    # 服务器忽略了 Range，自行截取
+                    data = data[offset:offset + length]
+                if len(data) != length:
+                    raise IOError(f"需要 {length} 字节，实际收到 {len(data)} 字节")
+                return data
+            except (httpx.HTTPError, IOError) as e:
+                # 范围错位或长度不足多为 CDN 节点的临时问题，与网络错误一样重试
+                if attempt == self.MAX_RETRIES:
+                    raise IOError(f"分片下载失败: {url}: {e}")
+                logger.warning(f"分片下载出错 (第 {attempt} 次): {e}，稍后重试")
+                await asyncio.sleep(self.RETRY_DELAY * attempt)
+
+    @classmethod
+    async def select_variant(cls, client: httpx.AsyncClient, url: str) -> tuple[str, str]:
+        """主播放列表时选择带宽最高的码率，返回 (媒体播放列表内容, 其 URL)"""
+        response = await client.get(url)
+        response.raise_for_status()
+        text, url = response.text, str(response.url)
+        if "#EXT-X-STREAM-INF" not in text:
+            return text, url
+        variants = cls.parse_master(text, url)
+        if not variants:
+            raise UnsupportedPlaylist("主播放列表中没有码率")
+        best = max(variants, key=lambda v: int(v["BANDWIDTH"]) if v.get("BANDWIDTH", "").isdigit() else 0)
+        if best.get("AUDIO") and re.search(rf'TYPE=AUDIO[^\n]*GROUP-ID="{re.escape(best["AUDIO"])}"[^\n]*URI=', text):
+            raise UnsupportedPlaylist("音轨在独立的播放列表中")
+        response = await client.get(best["uri"])
+        response.raise_for_status()
+        return response.text, str(response.url)
+
+    async def download(self, url: str, progress=None, progress_args=(), playlist: tuple[str, str] | None = None) -> str:
+        """下载全部分片到 work_dir，返回本地播放列表的路径。playlist 为之前 select_variant() 的结果"""
+        os.makedirs(self.work_dir, exist_ok=True)
+        client = http_client()
+        text, media_url = playlist or await self.select_variant(client, url)
+        segments = self.parse_media(text, media_url)
+
+        # 密钥和初始化分片数量很少，先顺序下载并分配本地文件名
+        local_names = {}
+        for resource in [s.key for s in segments if s.key] + [s.init for s in segments if s.init]:
+            resource_id = (resource["URI"], resource.get("BYTERANGE"))
+            if resource_id in local_names:
+                continue
+            byterange = None
+            if resource.get("BYTERANGE"):
+                length, offset = self.parse_byterange(resource["BYTERANGE"])
+                byterange = (length, offset or 0)
+            name = f"res_{len(local_names)}{os.path.splitext(urlparse(resource['URI']).path)[1] or '.bin'}"
+            with open(os.path.join(self.work_dir, name), 'wb') as f:
+                f.write(await self._get(client, resource["URI"], byterange))
+            local_names[resource_id] = name
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        completed = 0
+
+        async def fetch(index: int, segment: HLSSegment):
+            nonlocal completed
+            ext = os.path.splitext(urlparse(segment.uri).path)[1] or ".ts"
+            path = os.path.join(self.work_dir, f"seg_{index:06d}{ext}")
+            if os.path.exists(path):
+                # 重启前已下载完成的分片 (分片先写入临时文件，存在即完整)
+                size = os.path.getsize(path)
+            else:
+                async with semaphore:
+                    data = await self._get(client, segment.uri, segment.byterange)
+                with open(path + ".tmp", 'wb') as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+                size = len(data)
+            self.downloaded += size
+            completed += 1
+            if progress:
+                # 按已下载分片的平均大小估算总大小
+                await progress(self.downloaded, self.downloaded * len(segments) // completed, *progress_args)
+
+        tasks = [asyncio.create_task(fetch(i, seg)) for i, seg in enumerate(segments)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        return self._write_local_playlist(segments, local_names)
+
+    def _write_local_playlist(self, segments: list[HLSSegment], local_names: dict) -> str:
+        lines = [
+            "#EXTM3U", "#EXT-X-VERSION:7",
+            f"#EXT-X-TARGETDURATION:{math.ceil(max(s.duration for s in segments))}",
+            f"#EXT-X-MEDIA-SEQUENCE:{segments[0].sequence}",
+        ]
+        current_key, current_init = None, None
+        for index, segment in enumerate(segments):
+            if segment.init is not current_init:
+                current_init = segment.init
+                name = local_names[(segment.init["URI"], segment.init.get("BYTERANGE"))]
+                lines.append(f'#EXT-X-MAP:URI="{name}"')
+            if segment.key is not current_key:
+                current_key = segment.key
+                if segment.key is None:
+                    lines.append("#EXT-X-KEY:METHOD=NONE")
+                else:
+                    name = local_names[(segment.key["URI"], segment.key.get("BYTERANGE"))]
+                    iv = f',IV={segment.key["IV"]}' if segment.key.get("IV") else ""
+                    lines.append(f'#EXT-X-KEY:METHOD=AES-128,URI="{name}"{iv}')
+            if segment.discontinuity:
+                lines.append("#EXT-X-DISCONTINUITY")
+            ext = os.path.splitext(urlparse(segment.uri).path)[1] or ".ts"
+            lines += [f"#EXTINF:{segment.duration:.6f},", f"seg_{index:06d}{ext}"]
+        lines.append("#EXT-X-ENDLIST")
+        playlist_path = os.path.join(self.work_dir, "local.m3u8")
+        with open(playlist_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        return playlist_path
+
+
+class ProgressReporter:
+    """
+    集中式进度汇报器。
+    各任务只提交最新的进度文本 (不等待网络)，由一个后台协程统一编辑状态消息:
+    - 所有编辑共用一个令牌桶，整体速率不超过 edits_per_minute
+    - 同一条消息只发送最新的状态，旧状态直接被覆盖
+    - 活动消息越多，每条消息的更新间隔越长
+    - 遇到 FloodWait 时暂停所有编辑，直到等待结束
+    - 传入 journal 时令牌桶和暂停时间记录在共享的任务日志中，拆分部署的所有进程合计不超过 edits_per_minute
+    """
+
+    ACTIVE_WINDOW = 30  # 最近这么多秒内提交过进度的消息视为活动消息
+
+    def __init__(self, edits_per_minute: int = 30, min_interval: float = 2, speed_window: float = 10,
+                 journal: "JobJournal | None" = None):
+        self.rate = max(edits_per_minute, 1) / 60
+        self.burst = max(min(edits_per_minute // 10, 5), 1)
+        self.min_interval = min_interval
+        self.speed_window = speed_window
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self.journal = journal
+        self._pending = {}  # message_id -> (status_msg, text, reply_markup)
+        self._in_flight = {}  # message_id -> 正在发送的编辑任务
+        self._last_sent = {}  # message_id -> 上次发送时间
+        self._last_seen = {}  # message_id -> 上次提交时间
+        self._samples = {}  # message_id -> deque[(时间, 已传输字节)]
+        self._final_texts = {}  # message_id -> 最近一次通过 edit 发送的文本
+        self._wakeup = asyncio.Event()
+        self._loop_task = None
+
+    def speed(self, message_id: int, current: int) -> float:
+        """记录一个传输样本，返回移动窗口内的平均速度"""
+        now = time.monotonic()
+        samples = self._samples.setdefault(message_id, deque())
+        # 字节数回退说明进入了新的阶段 (例如下载完成后开始上传)，重新计算
+        if samples and current < samples[-1][1]:
+            samples.clear()
+        samples.append((now, current))
+        while len(samples) > 2 and now - samples[0][0] > self.speed_window:
+            samples.popleft()
+        elapsed = now - samples[0][0]
+        return (current - samples[0][1]) / elapsed if elapsed > 0 else 0.0
+
+    def submit(self, status_msg: Message, text: str, reply_markup=None):
+        """提交一条进度更新，只保留每条消息的最新状态"""
+        self._pending[status_msg.id] = (status_msg, text, reply_markup)
+        self._last_seen[status_msg.id] = time.monotonic()
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    def discard(self, message_id: int):
+        """丢弃该消息尚未发送的进度"""
+        self._pending.pop(message_id, None)
+        self._samples.pop(message_id, None)
+
+    async def edit(self, status_msg: Message, text: str, reply_markup=None):
+        """
+        发送最终状态 (例如成功、失败、进入下一阶段)，与进度共用令牌桶，令牌不足时等待。
+        先丢弃尚未发送的进度并等待正在发送的编辑完成，避免旧进度覆盖最终状态。
+        遇到 FloodWait 时暂停所有编辑，等待结束后重试一次；仍然失败时只记录日志，不影响任务的后续步骤。
+        """
+        self.discard(status_msg.id)
+        in_flight = self._in_flight.get(status_msg.id)
+        if in_flight:
+            await asyncio.wait([in_flight])
+        self._final_texts[status_msg.id] = text
+        for attempt in range(2):
+            await self._acquire(reserve=self.burst)
+            try:
+                with suppress(MessageNotModified):
+                    await status_msg.edit_text(text, reply_markup=reply_markup)
+                return
+            except FloodWait as e:
+                logger.warning(f"编辑状态消息触发 FloodWait，暂停 {e.value} 秒")
+                record_flood_wait("edit_message", e.value)
+                self._pause(e.value)
+        logger.warning(f"状态消息 {status_msg.id} 多次触发 FloodWait，放弃本次更新")
+
+    async def _acquire(self, reserve: int = 0):
+        """
+        等待 FloodWait 暂停结束并取得一个令牌。
+        最终状态可以预支最多 reserve 个令牌 (进度编辑要等令牌数回到 1 以上才发送，预支的部分由它们偿还)，
+        阶段切换不会被排队的进度拖慢，整体速率仍不超过令牌桶的速率，短时突发最多多出 reserve 次。
+        """
+        while True:
+            paused = self._paused_for()
+            if paused > 0:
+                await asyncio.sleep(paused)
+                continue
+            tokens = self._available_tokens()
+            if tokens >= 1 - reserve:
+                self._take_token()
+                return
+            await asyncio.sleep((1 - reserve - tokens) / self.rate)
+
+    def current_text(self, message_id: int) -> str:
+        """最近一次通过 edit 发送的文本"""
+        return self._final_texts.get(message_id, "")
+
+    def forget(self, message_id: int):
+        """任务结束后清理该消息的所有状态"""
+        self.discard(message_id)
+        for state in (self._last_sent, self._last_seen, self._final_texts):
+            state.pop(message_id, None)
+
+    def interval(self) -> float:
+        """每条消息的最小更新间隔: 令牌桶速率平均分给所有活动消息"""
+        now = time.monotonic()
+        active = sum(1 for seen in self._last_seen.values() if now - seen < self.ACTIVE_WINDOW)
+        return max(self.min_interval, max(active, 1) / self.rate)
+
+    def _available_tokens(self) -> float:
+        if self.journal:
+            return self.journal.edit_tokens(self.rate, self.burst)
+        return min(self.burst, self._tokens + (time.monotonic() - self._refilled_at) * self.rate)
+
+    def _take_token(self):
+        if self.journal:
+            self.journal.take_edit_token(self.rate, self.burst)
+            return
+        self._tokens = self._available_tokens() - 1
+        self._refilled_at = time.monotonic()
+
+    def _paused_for(self) -> float:
+        """FloodWait 暂停的剩余秒数"""
+        if self.journal:
+            return self.journal.edits_paused_for()
+        return max(self._paused_until - time.monotonic(), 0)
+
+    def _pause(self, seconds: float):
+        if self.journal:
+            self.journal.pause_edits(seconds)
+        else:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            paused = self._paused_for()
+            if paused > 0:
+                await asyncio.sleep(paused)
+                continue
+            now = time.monotonic()
+            tokens = self._available_tokens()
+            if tokens < 1:
+                await asyncio.sleep((1 - tokens) / self.rate)
+                continue
+
+            interval = self.interval()
+            waiting = [mid for mid in self._pending if mid not in self._in_flight]
+            due = [mid for mid in waiting if now - self._last_sent.get(mid, 0) >= interval]
+            if not due:
+                # 没有到期的消息: 睡到最早到期的时刻，期间有新消息提交时提前醒来
+                timeout = min((self._last_sent.get(mid, 0) + interval - now for mid in waiting), default=interval)
+                self._wakeup.clear()
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0.05))
+                continue
+
+            # 优先更新等待最久的消息
+            message_id = min(due, key=lambda mid: self._last_sent.get(mid, 0))
+            status_msg, text, reply_markup = self._pending.pop(message_id)
+            self._take_token()
+            self._last_sent[message_id] = now
+            self._in_flight[message_id] = asyncio.create_task(self._send(status_msg, text, reply_markup))
+
+    async def _send(self, status_msg: Message, text: str, reply_markup):
+        try:
+            await status_msg.edit_text(text, reply_markup=reply_markup)
+        except MessageNotModified:
+            pass
+        except FloodWait as e:
+            logger.warning(f"编辑进度消息触发 FloodWait，暂停 {e.value} 秒")
+            record_flood_wait("edit_message", e.value)
+            self._pause(e.value)
+            # 等待结束后重新发送，除非已有更新的状态
+            self._pending.setdefault(status_msg.id, (status_msg, text, reply_markup))
+        except Exception as e:
+            logger.warning(f"更新进度时出错: {e}")
+        finally:
+            self._in_flight.pop(status_msg.id, None)
+            self._wakeup.set()
+
+
+class StorageManager:
+    """
+    管理下载目录的磁盘空间。
+    - 每个任务使用独立的临时目录 task-<id>，任务结束时整个删除
+    - 可续传的 HTTP 未完成数据放在 .partial 中，超过保留时间后清理
+    - 准入控制: 任务按预计大小预留空间，放不下时排队等待其他任务释放
+    - 启动时清理上次遗留的任务目录和文件，并记录磁盘占用的最高水位
+    - 传入 journal 时预留记录在共享的任务日志中，共享下载目录的各进程合计不超过预算
+    """
+    PARTIAL_DIR = ".partial"
+    RECHECK_INTERVAL = 30  # 排队时定期重新检查，磁盘空间也可能被其他程序释放 (其他进程释放空间时也靠它发现)
+
+    def __init__(self, root: str, budget: int = 0, min_free: int = 0, partial_ttl: float = 24 * 3600,
+                 journal: "JobJournal | None" = None, worker: str | None = None):
+        self.root = os.path.abspath(root)
+        self.partial_dir = os.path.join(self.root, self.PARTIAL_DIR)
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self.budget = budget  # 0 为不限制，只检查剩余空间
+        self.min_free = min_free
+        self.partial_ttl = partial_ttl
+        self.reservations = {}  # task_id -> 预留的字节数
+        self.attached = {}  # task_id -> 任务目录之外属于该任务的文件 (.partial 中的续传数据)
+        self.journal = journal
+        self.worker = worker
+        self.shared_reservations = {}  # 其他进程的预留，每次采样时从任务日志读取
+        self.high_water = 0
+        self.high_water_at = None
+        self._changed = asyncio.Condition()
+
+    def task_dir(self, task_id: int) -> str:
+        path = os.path.join(self.root, f"task-{task_id}")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @staticmethod
+    def _du(path: str) -> int:
+        total = 0
+        for root, _, names in os.walk(path):
+            for name in names:
+                with suppress(OSError):
+                    total += os.lstat(os.path.join(root, name)).st_blocks * 512
+        return total
+
+    def _written(self, task_id: int, attached: str | None) -> int:
+        """任务已写入的字节数: 任务目录加上它在任务目录之外的文件"""
+        written = self._du(os.path.join(self.root, f"task-{task_id}"))
+        if attached:
+            with suppress(OSError):
+                written += os.lstat(attached).st_blocks * 512
+        return written
+
+    def _snapshot(self, reservations: dict[int, tuple[int, str | None]]) -> tuple[int, int, int]:
+        """返回 (下载目录占用, 预留但尚未写入的字节数, 磁盘剩余空间)"""
+        used = self._du(self.root)
+        outstanding = sum(
+            max(size - self._written(task_id, attached), 0)
+            for task_id, (size, attached) in reservations.items()
+        )
+        return used, outstanding, shutil.disk_usage(self.root).free
+
+    def _record(self, used: int):
+        if used > self.high_water:
+            # 只在明显增长时记录日志，避免每次采样都输出
+            if used > self.high_water * 1.1:
+                logger.info(f"下载目录占用达到新高: {FileProcessor.sizeof_fmt(used)}")
+            self.high_water = used
+            self.high_water_at = time.time()
+
+    async def sample(self) -> tuple[int, int, int]:
+        if self.journal:
+            self.shared_reservations = self.journal.reservations(self.worker)
+        reservations = {**self.shared_reservations, **{
+            task_id: (size, self.attached.get(task_id)) for task_id, size in self.reservations.items()
+        }}
+        snapshot = await asyncio.get_running_loop().run_in_executor(None, self._snapshot, reservations)
+        self._record(snapshot[0])
+        return snapshot
+
+    def _available(self, used: int, outstanding: int, free: int) -> int:
+        available = free - outstanding - self.min_free
+        if self.budget:
+            available = min(available, self.budget - used - outstanding)
+        return max(available, 0)
+
+    async def reserve(self, task_id: int, size: int, on_wait=None, wait: bool = True):
+        """
+        为任务预留 size 字节 (未知时为 0)，替换该任务之前的预留；空间不足时排队等待其他任务结束。
+        没有其他任务可以释放空间或 wait 为 False 时仍放不下，则直接报错。任务结束时必须调用 release。
+        """
+        self._set(task_id, None)
+        if self.budget and size > self.budget:
+            raise IOError(MESSAGES['storage_insufficient'].format(
+                size=FileProcessor.sizeof_fmt(size), available=FileProcessor.sizeof_fmt(self.budget)
+            ))
+        waiting = False
+        async with self._changed:
+            while True:
+                used, outstanding, free = await self.sample()
+                available = self._available(used, outstanding, free)
+                if size <= available:
+                    break
+                if not (self.reservations or self.shared_reservations) or not wait:
+                    raise IOError(MESSAGES['storage_insufficient'].format(
+                        size=FileProcessor.sizeof_fmt(size), available=FileProcessor.sizeof_fmt(available)
+                    ))
+                if not waiting and on_wait:
+                    waiting = True
+                    await on_wait()
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._changed.wait(), self.RECHECK_INTERVAL)
+            # 多个进程的检查和记录之间不加锁，同时开始的任务可能短暂超出预算，由 STORAGE_MIN_FREE 兜底
+            self._set(task_id, size)
+
+    def _set(self, task_id: int, size: int | None):
+        """更新任务的预留 (None 为取消)，同时写入共享的任务日志"""
+        if size is None:
+            self.reservations.pop(task_id, None)
+        else:
+            self.reservations[task_id] = size
+        if self.journal:
+            self.journal.set_reserved(task_id, size or 0)
+
+    def attach(self, task_id: int, path: str):
+        """
+        把任务目录之外的文件 (例如 HttpDownloader 在 .partial 中的续传数据) 计入该任务的预留，
+        其中已写入的数据不再同时算作尚未写入的预留
+        """
+        self.attached[task_id] = path
+        if self.journal:
+            self.journal.set_attached(task_id, path)
+
+    async def release(self, task_id: int):
+        """取消预留、删除任务目录并唤醒等待空间的任务"""
+        path = os.path.join(self.root, f"task-{task_id}")
+        # 删除前采样，记录任务结束时的占用
+        await self.sample()
+        self._set(task_id, None)
+        self.attached.pop(task_id, None)
+        await asyncio.get_running_loop().run_in_executor(None, lambda: shutil.rmtree(path, ignore_errors=True))
+        async with self._changed:
+            self._changed.notify_all()
+
+    def sweep(self, keep: set[int] = frozenset()) -> int:
+        """
+        清理上次运行遗留的任务目录、旧版本直接放在下载目录中的文件，以及过期的未完成数据。
+        keep 中的任务目录会被保留。返回释放的字节数。
+        """
+        freed = 0
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name == self.PARTIAL_DIR:
+                for partial_name in os.listdir(path):
+                    partial_path = os.path.join(path, partial_name)
+                    if now - os.path.getmtime(partial_path) > self.partial_ttl:
+                        freed += self._du(partial_path) if os.path.isdir(partial_path) else os.path.getsize(partial_path)
+                        self._remove(partial_path)
+                continue
+            if name.startswith("task-") and name[5:].lstrip("-").isdigit() and int(name[5:]) in keep:
+                continue
+            freed += self._du(path) if os.path.isdir(path) else os.path.getsize(path)
+            self._remove(path)
+        if freed:
+            logger.info(f"已清理遗留的下载数据: {FileProcessor.sizeof_fmt(freed)}")
+        return freed
+
+    @staticmethod
+    def _remove(path: str):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
 
 class FileProcessor:
     """处理文件下载、上传和元数据提取的类"""
 
-    def __init__(self, bot: Client, config: Config):
+    def __init__(self, bot: Client, config: Config, journal: "JobJournal | None" = None):
         self.bot = bot
+        # 发送文件使用的客户端，工作进程可以改用独立的辅助会话，分摊机器人的带宽和限流额度
+        self.upload_client = bot
         self.config = config
+        self.journal = journal
         self.download_dir = './downloads'
         os.makedirs(self.download_dir, exist_ok=True)
-        self.cancellable_files = {}
+        self.storage = StorageManager(
+            self.download_dir, config.STORAGE_BUDGET, config.STORAGE_MIN_FREE, config.PARTIAL_TTL_HOURS * 3600,
+            # 拆分部署时各进程共享下载目录，预留空间和编辑额度都记录在共享的任务日志中
+            journal if config.ROLE != "all" else None, config.WORKER_ID
+        )
+        self.aria2 = Aria2Client(
+            os.path.abspath(self.download_dir), config.ARIA2_RPC_URL, config.ARIA2_RPC_SECRET, config.ARIA2_RPC_PORT
+        )
+        self.aria2_tasks = {}  # task_id -> 当前的 aria2 GID
+        self.paused_tasks = set()
+        self.allow_pause = True  # 工作进程收不到按钮回调，不显示暂停按钮
+        self.progress = ProgressReporter(
+            config.PROGRESS_EDITS_PER_MINUTE, config.PROGRESS_MIN_INTERVAL,
+            journal=journal if config.ROLE != "all" else None
+        )
 
     @staticmethod
     def sizeof_fmt(num, suffix='B'):
@@ -109,80 +2149,391 @@ class FileProcessor:
         return f"{num:.1f} P{suffix}"
 
     async def _progress_callback(self, current, total, status_msg: Message, action: str):
-        try:
-            now = time.time()
-            if not hasattr(status_msg, 'last_update_time') or (now - status_msg.last_update_time) > 2:
-                if total > 0:
-                    speed = (current - getattr(status_msg, 'last_update_bytes', 0)) / (
-                            now - getattr(status_msg, 'last_update_time', now - 1))
-                    percent = current * 100 / total
-                else:
-                    speed = 0
-                    percent = 0  # or some other indicator for unknown total
-
-                progress_text = MESSAGES['progress_status'].format(
-                    action=action,
-                    percent=percent,
-                    speed=self.sizeof_fmt(speed),
-                    done=self.sizeof_fmt(current),
-                    total=self.sizeof_fmt(total)
-                )
-                await status_msg.edit_text(
-                    progress_text,
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔴 取消任务", callback_data=f"cancel_task:{status_msg.id}")
-                    ]])
-                )
-                status_msg.last_update_time = now
-                status_msg.last_update_bytes = current
-        except MessageNotModified:
-            pass
+        """传输进度回调，只提交给 ProgressReporter，不等待消息编辑"""
+        if self.journal:
+            self.journal.progress(status_msg.id, current, total)
+        speed = self.progress.speed(status_msg.id, current)
+        percent = current * 100 / total if total and total > 0 else 0
+        self.progress.submit(status_msg, MESSAGES['progress_status'].format(
+            action=action,
+            percent=percent,
+            speed=self.sizeof_fmt(speed),
+            done=self.sizeof_fmt(current),
+            total=self.sizeof_fmt(total)
+        ), reply_markup=self.task_keyboard(status_msg.id))
+
+    async def _ffmpeg_progress_callback(self, progress: dict, duration: float | None, status_msg: Message,
+                                        action: str):
+        """把 ffmpeg -progress 的输出提交给 ProgressReporter"""
+        out_time_us = progress.get("out_time_us", "")
+        out_seconds = max(int(out_time_us), 0) / 1_000_000 if out_time_us.lstrip("-").isdigit() else 0
+        percent = f"{min(out_seconds * 100 / duration, 100):.1f}%" if duration else MESSAGES["unknown_size"]
+        total_size = progress.get("total_size", "")
+        self.progress.submit(status_msg, MESSAGES['ffmpeg_progress'].format(
+            action=action,
+            percent=percent,
+            done=time.strftime("%H:%M:%S", time.gmtime(out_seconds)),
+            total=time.strftime("%H:%M:%S", time.gmtime(duration)) if duration else MESSAGES["unknown_size"],
+            size=self.sizeof_fmt(int(total_size)) if total_size.isdigit() else MESSAGES["unknown_size"],
+            speed=progress.get("speed", "N/A").strip()
+        ), reply_markup=self.task_keyboard(status_msg.id))
+
+    async def edit_status(self, status_msg: Message, text: str, reply_markup=None):
+        """更新状态消息的最终状态，所有非进度类的编辑都应通过这里，避免被排队中的旧进度覆盖"""
+        await self.progress.edit(status_msg, text, reply_markup=reply_markup)
+
+    def task_keyboard(self, task_id: int) -> InlineKeyboardMarkup:
+        """进行中任务的按钮，aria2 任务额外提供暂停/继续"""
+        buttons = [InlineKeyboardButton("🔴 取消任务", callback_data=f"cancel_task:{task_id}")]
+        if self.allow_pause and task_id in self.aria2_tasks:
+            label = "▶️ 继续" if task_id in self.paused_tasks else "⏸ 暂停"
+            buttons.insert(0, InlineKeyboardButton(label, callback_data=f"toggle_pause:{task_id}"))
+        return InlineKeyboardMarkup([buttons])
+
+    async def toggle_pause(self, task_id: int) -> bool | None:
+        """暂停或继续 aria2 任务，返回新的暂停状态；任务不存在时返回 None"""
+        gid = self.aria2_tasks.get(task_id)
+        if not gid:
+            return None
+        if task_id in self.paused_tasks:
+            await self.aria2.unpause(gid)
+            self.paused_tasks.discard(task_id)
+            return False
+        await self.aria2.pause(gid)
+        self.paused_tasks.add(task_id)
+        return True
+
+    def topic_for(self, media_type: str) -> int:
+        """根据媒体类型返回保存到的话题 ID，0 表示不使用话题"""
+        if media_type == "video":
+            return self.config.SAVE_TO_TOPIC_ID_VIDEO
+        if media_type == "photo":
+            return self.config.SAVE_TO_TOPIC_ID_PHOTO
+        return self.config.SAVE_TO_TOPIC_ID_DOCUMENT
+
+    async def upload_file(self, file_path: str, status_msg: Message, digest: str | None = None) -> Message:
+        """上传下载好的文件，超过上限时分割；digest 为下载时的内容哈希，上传时核对"""
+        file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        try:
+            if file_size > self.config.MAX_FILE_SIZE:
+                if not self.config.SPLIT_OVERSIZE:
+                    raise IOError(MESSAGES['file_too_large'].format(
+                        filesize=self.sizeof_fmt(file_size), limit=self.sizeof_fmt(self.config.MAX_FILE_SIZE)
+                    ))
+                saved_msg, count = await self.upload_split(file_path, status_msg)
+                await self.edit_status(status_msg, MESSAGES['saved_split_success'].format(
+                    count=count, filename=file_name, filesize=self.sizeof_fmt(file_size)
+                ), reply_markup=None)
+                return saved_msg
+            saved_msg = await self.send_file(
+                file_path, self._progress_callback, (status_msg, MESSAGES['uploading']), digest=digest
+            )
+            await self.edit_status(status_msg, MESSAGES['saved_success'].format(
+                filename=file_name, filesize=self.sizeof_fmt(file_size)
+            ), reply_markup=None)
+            return saved_msg
         except Exception as e:
-            logger.warning(f"更新进度时出错: {e}")
+            if not isinstance(e, asyncio.CancelledError):
+                logger.error(f"上传失败: {e}", exc_info=True)
+                await self.edit_status(status_msg, MESSAGES['upload_failed'].format(error=str(e)), reply_markup=None)
+            raise
 
-    async def upload_file(self, file_path: str, status_msg: Message):
+    async def send_file(self, file_path: str, progress=None, progress_args=(), digest: str | None = None) -> Message:
+        """
+        按文件类型发送到对应话题，不修改状态消息；文件大小不能超过上限。
+        并发分片上传时核对上传数据的内容哈希与 digest (下载时计算) 是否一致。
+        """
         file_name = os.path.basename(file_path)
         file_size = os.path.getsize(file_path)
         suffix = os.path.splitext(file_name)[1].lower()
         thumb_path = None
         try:
-            progress_args = (status_msg, MESSAGES['uploading'])
-            if suffix in ['.mp4', '.mkv', '.mov', '.flv', '.avi', '.wmv', '.webm', '.m4v']:
-                duration, width, height, thumb_path = self._get_video_meta(file_path)
-                await self.bot.send_video(
+            if suffix in PHOTO_SUFFIXES:
+                return await self.upload_client.send_photo(
+                    self.config.SAVE_TO_CHAT_ID, photo=file_path,
+                    reply_to_message_id=self.config.SAVE_TO_TOPIC_ID_PHOTO or None
+                )
+            if self.config.PARALLEL_UPLOAD and file_size >= StreamUploader.MIN_SIZE:
+                # 大文件: 自行分片，经多个连接并发上传
+                video = None
+                if suffix in VIDEO_SUFFIXES:
+                    duration, width, height, thumb_path = await self.get_video_meta(file_path)
+                    video = {"duration": duration, "width": width, "height": height}
+                uploader = self._new_uploader(file_name, file_size)
+                input_file = await uploader.upload(read_file_chunks(file_path), progress, progress_args)
+                if digest and uploader.digest != digest:
+                    raise IOError("上传的数据与下载时的内容哈希不符，文件在磁盘上可能已损坏")
+                thumb = await self.upload_client.save_file(thumb_path) if thumb_path else None
+                saved_msg = await self._send_uploaded_document(
+                    input_file, file_name, self.bot.guess_mime_type(file_name) or "application/octet-stream",
+                    video, thumb
+                )
+                await self._check_saved_size(saved_msg, file_size)
+                return saved_msg
+            if suffix in VIDEO_SUFFIXES:
+                duration, width, height, thumb_path = await self.get_video_meta(file_path)
+                return await self.upload_client.send_video(
                     self.config.SAVE_TO_CHAT_ID, video=file_path,
                     duration=duration, width=width, height=height, thumb=thumb_path,
-                    progress=self._progress_callback, progress_args=progress_args,
+                    progress=progress, progress_args=progress_args,
                     reply_to_message_id=self.config.SAVE_TO_TOPIC_ID_VIDEO or None
                 )
-            elif suffix in ['.jpg', '.jpeg', '.png', '.webp', '.gif']:
-                await self.bot.send_photo(
-                    self.config.SAVE_TO_CHAT_ID, photo=file_path,
-                    reply_to_message_id=self.config.SAVE_TO_TOPIC_ID_PHOTO or None
+            return await self.upload_client.send_document(
+                self.config.SAVE_TO_CHAT_ID, document=file_path,
+                progress=progress, progress_args=progress_args,
+                reply_to_message_id=self.config.SAVE_TO_TOPIC_ID_DOCUMENT or None
+            )
+        finally:
+            if thumb_path and os.path.exists(thumb_path):
+                os.remove(thumb_path)
+
+    async def _split_video(self, file_path: str, parts_dir: str) -> list[str] | None:
+        """用 ffmpeg 的 segment 复用器在关键帧处直接复制切分，每段都能单独播放；无法控制在上限内时返回 None"""
+        file_size = os.path.getsize(file_path)
+        stem, ext = os.path.splitext(os.path.basename(file_path))
+        try:
+            duration = float((await ffprobe(file_path)).get("format", {}).get("duration") or 0)
+        except IOError as e:
+            logger.warning(f"无法读取视频时长，改为分卷: {e}")
+            return None
+        if not duration:
+            return None
+
+        # 码率不均匀时部分片段会偏大，超限则缩短片段时长重试
+        target = self.config.MAX_FILE_SIZE * 0.9
+        for _ in range(3):
+            for name in os.listdir(parts_dir):
+                os.remove(os.path.join(parts_dir, name))
+            segment_time = max(duration * target / file_size, 1)
+            try:
+                await run_ffmpeg([
+                    "-i", file_path, "-map", "0:v:0", "-map", "0:a?", "-c", "copy",
+                    "-f", "segment", "-segment_time", f"{segment_time:.3f}", "-reset_timestamps", "1",
+                    "-segment_start_number", "1", os.path.join(parts_dir, f"{stem}.part%03d{ext}")
+                ], phase="split")
+            except IOError as e:
+                logger.warning(f"视频分割失败，改为分卷: {e}")
+                return None
+            parts = sorted(os.path.join(parts_dir, name) for name in os.listdir(parts_dir))
+            largest = max((os.path.getsize(p) for p in parts), default=0)
+            if parts and largest <= self.config.MAX_FILE_SIZE:
+                return parts
+            target *= self.config.MAX_FILE_SIZE * 0.9 / max(largest, 1)
+        return None
+
+    def _split_raw(self, file_path: str, parts_dir: str) -> list[str]:
+        """按相同大小切成 .001、.002 ... 分卷，可用 cat 直接拼回原文件"""
+        file_size = os.path.getsize(file_path)
+        count = math.ceil(file_size / self.config.MAX_FILE_SIZE)
+        part_size = math.ceil(file_size / count)
+        name = os.path.basename(file_path)
+        parts = []
+        with open(file_path, 'rb') as src:
+            for index in range(1, count + 1):
+                part_path = os.path.join(parts_dir, f"{name}.{index:03d}")
+                with open(part_path, 'wb') as dst:
+                    remaining = part_size
+                    while remaining > 0 and (chunk := src.read(min(remaining, 8 * 1024 * 1024))):
+                        dst.write(chunk)
+                        remaining -= len(chunk)
+                parts.append(part_path)
+        return parts
+
+    async def upload_split(self, file_path: str, status_msg: Message) -> tuple[Message | None, int]:
+        """
+        分割超过上限的文件并上传。各部分并发上传，全部完成后按顺序发送:
+        第一部分发送到对应话题，其余部分回复第一部分。返回 (第一部分的消息, 部分数)。
+        """
+        file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        parts_dir = unique_path(f"{file_path}.parts")
+        os.makedirs(parts_dir)
+        try:
+            await self.edit_status(status_msg, MESSAGES['splitting'].format(
+                limit=self.sizeof_fmt(self.config.MAX_FILE_SIZE)
+            ), reply_markup=self.task_keyboard(status_msg.id))
+            parts = None
+            if os.path.splitext(file_name)[1].lower() in VIDEO_SUFFIXES:
+                parts = await self._split_video(file_path, parts_dir)
+            is_video = parts is not None
+            if not is_video:
+                for name in os.listdir(parts_dir):
+                    os.remove(os.path.join(parts_dir, name))
+                parts = await asyncio.get_running_loop().run_in_executor(
+                    None, self._split_raw, file_path, parts_dir
                 )
-            else:
-                await self.bot.send_document(
-                    self.config.SAVE_TO_CHAT_ID, document=file_path,
-                    progress=self._progress_callback, progress_args=progress_args,
-                    reply_to_message_id=self.config.SAVE_TO_TOPIC_ID_DOCUMENT or None
+
+            action = MESSAGES['uploading_parts'].format(count=len(parts))
+            uploaded = [0] * len(parts)
+            slots = asyncio.Semaphore(max(self.config.PARALLEL_PART_UPLOADS, 1))
+
+            async def on_progress(current, _, index):
+                uploaded[index] = current
+                await self._progress_callback(sum(uploaded), file_size, status_msg, action)
+
+            async def upload_part(index: int, part_path: str):
+                async with slots:
+                    video, thumb_path = None, None
+                    try:
+                        if is_video:
+                            duration, width, height, thumb_path = await self.get_video_meta(part_path)
+                            video = {"duration": duration, "width": width, "height": height}
+                        part_size = os.path.getsize(part_path)
+                        if part_size >= StreamUploader.MIN_SIZE:
+                            uploader = self._new_uploader(os.path.basename(part_path), part_size)
+                            input_file = await uploader.upload(read_file_chunks(part_path), on_progress, (index,))
+                        else:
+                            input_file = await self.upload_client.save_file(
+                                part_path, progress=on_progress, progress_args=(index,)
+                            )
+                        thumb = await self.upload_client.save_file(thumb_path) if thumb_path else None
+                        return input_file, video, thumb
+                    finally:
+                        if thumb_path and os.path.exists(thumb_path):
+                            os.remove(thumb_path)
+
+            uploads = await asyncio.gather(*(upload_part(i, p) for i, p in enumerate(parts)))
+
+            first_msg = None
+            mime_type = self.bot.guess_mime_type(file_name) if is_video else "application/octet-stream"
+            for index, (part_path, (input_file, video, thumb)) in enumerate(zip(parts, uploads)):
+                sent = await self._send_uploaded_document(
+                    input_file, os.path.basename(part_path), mime_type or "application/octet-stream", video, thumb,
+                    caption=MESSAGES['part_caption'].format(filename=file_name, index=index + 1, count=len(parts)),
+                    reply_to_msg_id=first_msg.id if first_msg else None
                 )
-            await status_msg.edit_text(MESSAGES['saved_success'].format(
-                filename=file_name, filesize=self.sizeof_fmt(file_size)
+                first_msg = first_msg or sent
+            return first_msg, len(parts)
+        finally:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+
+    def _new_uploader(self, file_name: str, file_size: int | None) -> StreamUploader:
+        buffer_parts = self.config.STREAM_BUFFER_MB * 1024 * 1024 // StreamUploader.PART_SIZE
+        return StreamUploader(
+            self.upload_client, file_name, file_size, workers=self.config.UPLOAD_WORKERS,
+            buffer_parts=buffer_parts, connections=self.config.UPLOAD_CONNECTIONS
+        )
+
+    async def upload_stream(self, stream: MediaStream, status_msg: Message) -> Message | None:
+        """边下载边上传: 数据只经过内存缓冲，完成后以普通媒体消息发送到对应话题"""
+        progress_args = (status_msg, MESSAGES['streaming'])
+        uploader = self._new_uploader(stream.file_name, stream.file_size)
+        try:
+            input_file = await uploader.upload(stream.chunks, self._progress_callback, progress_args)
+
+            thumb = None
+            if stream.thumb_file_id:
+                with suppress(Exception):
+                    thumb = await self.upload_client.save_file(
+                        await self.bot.download_media(stream.thumb_file_id, in_memory=True)
+                    )
+
+            saved_msg = await self._send_uploaded_document(
+                input_file, stream.file_name, stream.mime_type, stream.video, thumb
+            )
+            await self._check_saved_size(saved_msg, uploader.uploaded)
+            stream.digest = uploader.digest
+            await self.edit_status(status_msg, MESSAGES['saved_success'].format(
+                filename=stream.file_name, filesize=self.sizeof_fmt(stream.file_size or uploader.uploaded)
             ), reply_markup=None)
+            return saved_msg
         except Exception as e:
             if not isinstance(e, asyncio.CancelledError):
-                logger.error(f"上传失败: {e}", exc_info=True)
-                await status_msg.edit_text(MESSAGES['upload_failed'].format(error=str(e)), reply_markup=None)
+                logger.error(f"流式传输失败: {e}", exc_info=True)
+                await self.edit_status(status_msg, MESSAGES['upload_failed'].format(error=str(e)), reply_markup=None)
             raise
-        finally:
-            if thumb_path and os.path.exists(thumb_path):
-                os.remove(thumb_path)
+
+    async def _send_uploaded_document(self, input_file, file_name: str, mime_type: str, video: dict | None,
+                                      thumb=None, caption: str = "", reply_to_msg_id: int | None = None
+                                      ) -> Message | None:
+        """把已上传的分片作为视频或文件发送到对应话题，指定 reply_to_msg_id 时改为回复该消息"""
+        attributes = [raw.types.DocumentAttributeFilename(file_name=file_name)]
+        if video:
+            attributes.insert(0, raw.types.DocumentAttributeVideo(
+                duration=video.get("duration") or 0,
+                w=video.get("width") or 0,
+                h=video.get("height") or 0,
+                supports_streaming=True
+            ))
+        topic_id = self.topic_for("video" if video else "document")
+
+        r = await self.upload_client.invoke(raw.functions.messages.SendMedia(
+            peer=await self.upload_client.resolve_peer(self.config.SAVE_TO_CHAT_ID),
+            media=raw.types.InputMediaUploadedDocument(
+                file=input_file, mime_type=mime_type, attributes=attributes, thumb=thumb
+            ),
+            message=caption,
+            random_id=self.upload_client.rnd_id(),
+            reply_to_msg_id=reply_to_msg_id or topic_id or None
+        ))
+        return await self._parse_sent_message(r)
+
+    @staticmethod
+    async def _check_saved_size(saved_msg: Message | None, size: int):
+        """Telegram 记录的文件大小应与上传的字节数一致，不一致时删除这条消息"""
+        media = getattr(saved_msg, saved_msg.media.value, None) if saved_msg and saved_msg.media else None
+        saved_size = getattr(media, 'file_size', None)
+        if saved_size and saved_size != size:
+            with suppress(Exception):
+                await saved_msg.delete()
+            raise IOError(f"保存的文件大小不符: 上传了 {size} 字节，Telegram 记录为 {saved_size} 字节")
+
+    async def _parse_sent_message(self, r) -> Message | None:
+        """从 SendMedia 的返回结果中解析出发送的消息"""
+        users = {u.id: u for u in r.users}
+        chats = {c.id: c for c in r.chats}
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return await Message._parse(self.upload_client, update.message, users, chats)
+        return None
+
+    async def get_video_meta(self, file_path: str):
+        """
+        用一次 ffprobe 读取时长、尺寸和旋转角度，再用一次带缩放的 ffmpeg 跳转截取一帧作为缩略图。
+        两者都是媒体处理池中优先执行的异步子进程，不会阻塞事件循环；ffprobe 不可用时退回到 MoviePy/OpenCV。
+        """
+        async with METRICS.span("metadata"):
+            try:
+                probe = await ffprobe(file_path, ["-select_streams", "v:0"])
+            except IOError as e:
+                logger.warning(f"无法使用 FFprobe 提取元数据: {e}。尝试使用 MoviePy/OpenCV。")
+                # 同步解码同样占用 CPU，也计入媒体处理池的槽位
+                async with MEDIA_POOL.slot(MediaPool.PROBE):
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(None, self._get_video_meta, file_path)
+
+            streams = probe.get("streams") or [{}]
+            stream = streams[0]
+            duration = float(stream.get("duration") or probe.get("format", {}).get("duration") or 0)
+            width, height = int(stream.get("width") or 0), int(stream.get("height") or 0)
+            rotation = int(float(stream.get("tags", {}).get("rotate") or 0))
+            for side_data in stream.get("side_data_list", []):
+                rotation = int(float(side_data.get("rotation", rotation)))
+            if abs(rotation) % 180 == 90:
+                width, height = height, width
+
+            thumb_path = f"{os.path.splitext(file_path)[0]}.jpg"
+            # 跳过开头可能的黑屏: 取 10% 处，但不超过 30 秒；-ss 放在 -i 前面按关键帧快速跳转
+            offset = min(duration * 0.1, 30)
+            try:
+                await run_ffmpeg([
+                    "-ss", f"{offset:.2f}", "-i", file_path, "-frames:v", "1",
+                    "-vf", "scale=320:320:force_original_aspect_ratio=decrease", "-q:v", "5", thumb_path
+                ], priority=MediaPool.PROBE)
+            except IOError as e:
+                logger.warning(f"无法生成缩略图: {e}")
+            if not os.path.exists(thumb_path):
+                thumb_path = None
+            return int(duration), width, height, thumb_path
 
     @staticmethod
     def _get_video_meta(file_path: str):
+        """使用 MoviePy/OpenCV 提取元数据 (这是一个阻塞方法，仅在 ffprobe 不可用时使用)"""
         thumb_path = f"{os.path.splitext(file_path)[0]}.jpg"
         try:
-            # Use moviepy to get metadata, as it's already a dependency
+            # 重量级依赖只在真正需要时才导入
+            from moviepy import VideoFileClip
             with VideoFileClip(file_path) as clip:
                 duration = int(clip.duration)
                 width, height = clip.size
@@ -192,6 +2543,7 @@ class FileProcessor:
         except Exception as e:
             logger.warning(f"无法使用 MoviePy 提取元数据: {e}。尝试使用 OpenCV。")
             try:
+                import cv2
                 cap = cv2.VideoCapture(file_path)
                 if cap.isOpened():
                     ret, frame = cap.read()
@@ -212,30 +2564,391 @@ class FileProcessor:
                         os.remove(thumb_path)
                 return 0, 0, 0, None
 
-    def download_from_url_sync(self, url: str) -> str | None:
-        """使用 aria2c 从 URL 下载 (这是一个阻塞方法)"""
+    async def download_from_url(self, url: str, status_msg: Message, file_name: str | None = None,
+                                probe: tuple | None = None) -> str:
+        """使用 HttpDownloader 下载 HTTP(S) 链接，进度显示在状态消息中"""
+        downloader = HttpDownloader(
+            self.storage.task_dir(status_msg.id), self.config.HTTP_CONNECTIONS, self.storage.partial_dir
+        )
+        return await downloader.download(
+            url, progress=self._progress_callback, progress_args=(status_msg, MESSAGES['downloading']),
+            file_name=file_name, probe=probe, on_part=lambda path: self.storage.attach(status_msg.id, path)
+        )
+
+    async def download_magnet(self, uri: str, status_msg: Message) -> str:
+        """通过 aria2 RPC 下载磁力链接到任务目录下的 aria2 子目录，返回该目录"""
+        task_id = status_msg.id
+        job_dir = os.path.join(self.storage.task_dir(task_id), "aria2")
+        os.makedirs(job_dir, exist_ok=True)
+
+        async def progress(current, total, state, status_msg, action):
+            if state == "paused":
+                action = MESSAGES['aria2_paused']
+            elif not total:
+                action = MESSAGES['aria2_metadata']
+            await self._progress_callback(current, total, status_msg, action)
+
+        def on_gid(gid):
+            self.aria2_tasks[task_id] = gid
+
+        # 中断时保留已下载的数据 (重启后可续传)，任务目录由 StorageManager 统一删除
         try:
-            if url.startswith("magnet:?"):
-                cmd = ["aria2c", url, "--dir", self.download_dir, "--summary-interval=0", "--bt-stop-timeout=300"]
-                run(cmd, check=True, capture_output=True, text=True)
-                # 这部分逻辑比较脆弱，aria2下载后最好能明确知道文件名
-                files = sorted([os.path.join(self.download_dir, f) for f in os.listdir(self.download_dir)],
-                               key=os.path.getmtime, reverse=True)
-                return files[0] if files else None
-            else:
-                parsed_path = urlparse(url).path
-                filename = os.path.basename(parsed_path) or str(int(time.time()))
-                output_path = os.path.join(self.download_dir, filename)
-                cmd = ["aria2c", url, "--dir", self.download_dir, "-o", filename, "--summary-interval=0"]
-                run(cmd, check=True, capture_output=True, text=True)
-                return output_path
-        except CalledProcessError as e:
-            error_output = e.stderr or e.stdout
-            logger.error(f"Aria2c 执行失败: {error_output}")
-            raise IOError(f"Aria2c 错误: 检查日志获取更多信息")
-        except Exception as e:
-            logger.error(f"未知下载错误: {e}")
-            raise IOError(f"未知下载错误: {e}")
+            files = await self.aria2.download(
+                uri, job_dir, progress=progress, progress_args=(status_msg, MESSAGES['downloading']), on_gid=on_gid
+            )
+        finally:
+            self.aria2_tasks.pop(task_id, None)
+            self.paused_tasks.discard(task_id)
+        if not files:
+            raise IOError("aria2 下载完成，但没有得到任何文件")
+        return job_dir
+
+
+def normalize_url(text: str) -> str | None:
+    """从文本中提取第一个链接并规范化，用作去重的键"""
+    match = re.search(r"(https?://|magnet:\?)\S+", text or "")
+    if not match:
+        return None
+    url = match.group(0)
+    if url.startswith("magnet:"):
+        btih = re.search(r"xt=urn:btih:([0-9a-zA-Z]+)", url)
+        return f"magnet:{btih.group(1).lower()}" if btih else url
+    parsed = urlparse(url)
+    netloc = parsed.netloc.lower()
+    # 去掉统计参数；t.me 帖子链接的查询参数 (如 ?single) 不影响内容
+    query = [] if netloc == "t.me" else sorted(
+        (k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if not k.lower().startswith("utm_")
+    )
+    return urlunparse((parsed.scheme.lower(), netloc, parsed.path.rstrip("/") or "/", "", urlencode(query), ""))
+
+
+@dataclass
+class SavedEntry:
+    """去重索引中的一条记录，指向保存频道中已存在的消息"""
+    chat_id: int
+    message_id: int
+    file_id: str | None
+    file_name: str | None
+    file_size: int | None
+    digest: str | None = None  # 保存时的内容哈希 (ContentHasher)
+
+    @property
+    def link(self) -> str | None:
+        chat = str(self.chat_id)
+        if chat.startswith("-100"):
+            return f"https://t.me/c/{chat[4:]}/{self.message_id}"
+        return None
+
+
+class SaveIndex:
+    """
+    已保存文件的去重索引 (SQLite)。
+    键的形式为 `tg:<file_unique_id>`、`url:<规范化链接>` 或 `content:<内容哈希>`，
+    都指向保存频道中已经存在的那条消息；已知内容哈希时一并记录在该消息的条目中。
+    """
+
+    def __init__(self, path: str = 'sessions/index.db'):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # 前端和工作进程共用同一个索引
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS saved (
+                key TEXT PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                file_id TEXT,
+                file_name TEXT,
+                file_size INTEGER,
+                saved_at REAL NOT NULL
+            )
+        """)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(saved)")}
+        if "digest" not in columns:
+            self._db.execute("ALTER TABLE saved ADD COLUMN digest TEXT")
+        self._db.commit()
+
+    @staticmethod
+    def keys_for_message(msg: Message | None) -> list[str]:
+        """返回一条媒体消息自身的去重键"""
+        if not msg or not msg.media:
+            return []
+        media = getattr(msg, msg.media.value, None)
+        unique_id = getattr(media, 'file_unique_id', None)
+        return [f"tg:{unique_id}"] if unique_id else []
+
+    def lookup(self, keys: list[str]) -> SavedEntry | None:
+        for key in keys:
+            row = self._db.execute(
+                "SELECT chat_id, message_id, file_id, file_name, file_size, digest FROM saved WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                return SavedEntry(*row)
+        return None
+
+    def record(self, keys: list[str], saved_msg: Message | None, digest: str | None = None):
+        """把所有键都指向刚保存的消息，消息自身的 file_unique_id 和已知的内容哈希也一并记录"""
+        if not saved_msg:
+            return
+        media = getattr(saved_msg, saved_msg.media.value, None) if saved_msg.media else None
+        entry = SavedEntry(
+            saved_msg.chat.id, saved_msg.id,
+            getattr(media, 'file_id', None), getattr(media, 'file_name', None), getattr(media, 'file_size', None),
+            digest
+        )
+        if digest:
+            keys = keys + [f"content:{digest}"]
+        self.alias(keys + self.keys_for_message(saved_msg), entry)
+
+    def alias(self, keys: list[str], entry: SavedEntry):
+        """把键指向一条已有的记录"""
+        self._db.executemany(
+            "INSERT OR REPLACE INTO saved (key, chat_id, message_id, file_id, file_name, file_size, saved_at, digest) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(key, entry.chat_id, entry.message_id, entry.file_id, entry.file_name, entry.file_size, time.time(),
+              entry.digest) for key in dict.fromkeys(keys)]
+        )
+        self._db.commit()
+
+    def forget(self, entry: SavedEntry):
+        """删除指向该消息的所有键 (保存的消息已被删除)"""
+        self._db.execute("DELETE FROM saved WHERE chat_id = ? AND message_id = ?", (entry.chat_id, entry.message_id))
+        self._db.commit()
+
+
+@dataclass
+class JournalEntry:
+    task_id: int  # 即状态消息的 ID
+    chat_id: int  # 状态消息所在的聊天
+    user_id: int
+    source_chat_id: int
+    source_message_id: int
+    phase: str
+    offset: int
+    total: int
+    file_path: str | None
+
+
+class JobJournal:
+    """
+    持久化的任务日志 (SQLite)。
+    记录每个未完成任务的来源、阶段 (queued/downloading/uploading)、已传输字节数和状态消息，
+    进程重启后据此恢复任务。任务结束 (成功、失败或取消) 后删除记录。
+    拆分为前端和工作进程时它也是共享的任务队列: 工作进程领取任务并定期续约，租约过期的任务由其他工作进程接手。
+    """
+    PROGRESS_INTERVAL = 5  # 进度写入的最小间隔 (秒)
+
+    def __init__(self, path: str = 'sessions/jobs.db'):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # 多个进程共用时: WAL 模式下读写互不阻塞，写锁冲突时等待而不是立即报错
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                task_id INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                source_chat_id INTEGER NOT NULL,
+                source_message_id INTEGER NOT NULL,
+                phase TEXT NOT NULL,
+                offset INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                file_path TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                reserved INTEGER NOT NULL DEFAULT 0,
+                attached TEXT
+            )
+        """)
+        # 拆分部署时所有进程共用机器人的编辑额度: 令牌桶和 FloodWait 暂停时间 (只有一行)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS edit_budget (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                tokens REAL NOT NULL,
+                refilled_at REAL NOT NULL,
+                paused_until REAL NOT NULL DEFAULT 0
+            )
+        """)
+        # 旧版本的任务日志没有任务队列和空间预留使用的列
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for column, definition in (("worker", "TEXT"), ("lease_until", "REAL"),
+                                   ("cancel_requested", "INTEGER NOT NULL DEFAULT 0"),
+                                   ("reserved", "INTEGER NOT NULL DEFAULT 0"), ("attached", "TEXT")):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        self._db.commit()
+        self._progress_written = {}  # task_id -> 上次写入进度的时间
+
+    def start(self, status_msg: Message, user_id: int, worker: str | None = None):
+        """记录新任务；worker 为空时任务进入共享队列等待工作进程领取，否则由该进程自己执行 (没有租约)"""
+        source = status_msg.reply_to_message
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO jobs (task_id, chat_id, user_id, source_chat_id, source_message_id, phase, "
+            "created_at, updated_at, worker) VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?)",
+            (status_msg.id, status_msg.chat.id, user_id, source.chat.id, source.id, now, now, worker)
+        )
+        self._db.commit()
+
+    def exists(self, task_id: int) -> bool:
+        return self._db.execute("SELECT 1 FROM jobs WHERE task_id = ?", (task_id,)).fetchone() is not None
+
+    def queue_position(self, task_id: int) -> int:
+        """排在该任务之前、尚未被领取的任务数"""
+        return self._db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE worker IS NULL AND created_at < "
+            "(SELECT created_at FROM jobs WHERE task_id = ?)", (task_id,)
+        ).fetchone()[0]
+
+    def queued_count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM jobs WHERE worker IS NULL").fetchone()[0]
+
+    def claim(self, worker: str, lease: float, max_per_user: int) -> JournalEntry | None:
+        """
+        为工作进程领取一个任务: 尚未被领取的，或租约已过期 (原工作进程已退出) 的任务。
+        优先领取执行中任务最少的用户的任务，每个用户在所有工作进程上同时执行的任务数不超过 max_per_user。
+        """
+        now = time.time()
+        running = ("(SELECT COUNT(*) FROM jobs AS r WHERE r.user_id = j.user_id AND r.worker IS NOT NULL "
+                   "AND (r.lease_until IS NULL OR r.lease_until >= :now))")
+        with self._db:
+            # 立即取得写锁，避免两个工作进程领取同一个任务
+            self._db.execute("BEGIN IMMEDIATE")
+            row = self._db.execute(
+                "SELECT task_id, chat_id, user_id, source_chat_id, source_message_id, phase, offset, total, file_path "
+                f"FROM jobs AS j WHERE (worker IS NULL OR lease_until < :now) AND {running} < :max_per_user "
+                f"ORDER BY {running}, created_at LIMIT 1",
+                {"now": now, "max_per_user": max_per_user}
+            ).fetchone()
+            if row:
+                self._db.execute("UPDATE jobs SET worker = ?, lease_until = ? WHERE task_id = ?",
+                                 (worker, now + lease, row[0]))
+        return JournalEntry(*row) if row else None
+
+    def renew(self, worker: str, lease: float):
+        """延长该工作进程所有任务的租约"""
+        self._db.execute("UPDATE jobs SET lease_until = ? WHERE worker = ?", (time.time() + lease, worker))
+        self._db.commit()
+
+    def release(self, worker: str):
+        """工作进程停止时交还它的任务，其他工作进程可以立即从断点继续"""
+        self._db.execute("UPDATE jobs SET worker = NULL, lease_until = NULL WHERE worker = ?", (worker,))
+        self._db.commit()
+
+    def unclaim(self, task_id: int):
+        """交还单个任务，之后可以再次被领取"""
+        self._db.execute("UPDATE jobs SET worker = NULL, lease_until = NULL WHERE task_id = ?", (task_id,))
+        self._db.commit()
+
+    def cancel(self, task_id: int) -> str | None:
+        """
+        取消队列中的任务: 尚未被领取的直接删除并返回 "deleted"；
+        已被领取的记下取消请求，由工作进程执行，返回 "requested"；任务不存在时返回 None。
+        """
+        with self._db:
+            if self._db.execute("DELETE FROM jobs WHERE task_id = ? AND worker IS NULL", (task_id,)).rowcount:
+                return "deleted"
+            if self._db.execute("UPDATE jobs SET cancel_requested = 1 WHERE task_id = ?", (task_id,)).rowcount:
+                return "requested"
+        return None
+
+    def take_cancel_requests(self, worker: str) -> list[int]:
+        """取出发给该工作进程的取消请求"""
+        with self._db:
+            rows = self._db.execute(
+                "SELECT task_id FROM jobs WHERE worker = ? AND cancel_requested = 1", (worker,)
+            ).fetchall()
+            self._db.executemany("UPDATE jobs SET cancel_requested = 0 WHERE task_id = ?", rows)
+        return [row[0] for row in rows]
+
+    def set_phase(self, task_id: int, phase: str, file_path: str | None = None):
+        self._db.execute(
+            "UPDATE jobs SET phase = ?, offset = 0, total = 0, file_path = COALESCE(?, file_path), updated_at = ? "
+            "WHERE task_id = ?",
+            (phase, file_path, time.time(), task_id)
+        )
+        self._db.commit()
+        self._progress_written.pop(task_id, None)
+
+    def progress(self, task_id: int, offset: int, total: int):
+        """记录当前阶段的进度，频繁调用时按 PROGRESS_INTERVAL 节流"""
+        now = time.monotonic()
+        if now - self._progress_written.get(task_id, 0) < self.PROGRESS_INTERVAL:
+            return
+        self._progress_written[task_id] = now
+        self._db.execute(
+            "UPDATE jobs SET offset = ?, total = ?, updated_at = ? WHERE task_id = ?",
+            (offset, total or 0, time.time(), task_id)
+        )
+        self._db.commit()
+
+    def set_reserved(self, task_id: int, size: int):
+        """记录任务预留的磁盘空间，供共享下载目录的其他进程计入"""
+        self._db.execute("UPDATE jobs SET reserved = ? WHERE task_id = ?", (size, task_id))
+        self._db.commit()
+
+    def set_attached(self, task_id: int, path: str | None):
+        """记录任务在任务目录之外写入的文件 (.partial 中的续传数据)"""
+        self._db.execute("UPDATE jobs SET attached = ? WHERE task_id = ?", (path, task_id))
+        self._db.commit()
+
+    def reservations(self, worker: str) -> dict[int, tuple[int, str | None]]:
+        """
+        其他进程正在执行的任务预留的磁盘空间 (task_id -> (字节数, 任务目录之外的文件))，
+        租约已过期的任务不计入
+        """
+        rows = self._db.execute(
+            "SELECT task_id, reserved, attached FROM jobs WHERE reserved > 0 AND worker IS NOT NULL "
+            "AND worker != ? AND (lease_until IS NULL OR lease_until >= ?)", (worker, time.time())
+        ).fetchall()
+        return {task_id: (size, attached) for task_id, size, attached in rows}
+
+    def _edit_budget(self, rate: float, burst: int) -> tuple[float, float]:
+        """返回共享令牌桶当前的 (可用令牌数, 暂停截止时间)"""
+        row = self._db.execute("SELECT tokens, refilled_at, paused_until FROM edit_budget").fetchone()
+        if not row:
+            return float(burst), 0.0
+        tokens, refilled_at, paused_until = row
+        return min(burst, tokens + (time.time() - refilled_at) * rate), paused_until
+
+    def edit_tokens(self, rate: float, burst: int) -> float:
+        return self._edit_budget(rate, burst)[0]
+
+    def take_edit_token(self, rate: float, burst: int):
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            tokens, paused_until = self._edit_budget(rate, burst)
+            self._db.execute("INSERT OR REPLACE INTO edit_budget VALUES (0, ?, ?, ?)",
+                             (tokens - 1, time.time(), paused_until))
+
+    def edits_paused_for(self) -> float:
+        """所有进程暂停编辑的剩余秒数"""
+        row = self._db.execute("SELECT paused_until FROM edit_budget").fetchone()
+        return max(row[0] - time.time(), 0) if row else 0
+
+    def pause_edits(self, seconds: float):
+        now = time.time()
+        with self._db:
+            self._db.execute(
+                "INSERT INTO edit_budget VALUES (0, 0, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET paused_until = MAX(paused_until, excluded.paused_until)",
+                (now, now + seconds)
+            )
+
+    def finish(self, task_id: int):
+        self._db.execute("DELETE FROM jobs WHERE task_id = ?", (task_id,))
+        self._db.commit()
+        self._progress_written.pop(task_id, None)
+
+    def unfinished(self) -> list[JournalEntry]:
+        rows = self._db.execute(
+            "SELECT task_id, chat_id, user_id, source_chat_id, source_message_id, phase, offset, total, file_path "
+            "FROM jobs ORDER BY created_at"
+        ).fetchall()
+        return [JournalEntry(*row) for row in rows]
 
 
 @dataclass
@@ -250,6 +2963,11 @@ class MessageProcessorResult:
 class BaseMessageProcessor(ABC):
     """处理消息的基类，现在包含下载逻辑"""
 
+    is_batch = False  # 批量任务包含多个条目，由 BotHandlers._run_batch 处理
+    can_download_ahead = False  # 是否实现了 download_ahead
+    source = "none"  # 指标中的来源类型
+    PREFETCH_MAX_AGE = 300  # 预取的结果 (可能包含有时效的跳转地址) 超过此时间后不再使用
+
     def __init__(self, msg: Message, bot: Client):
         self._msg = msg
         self._bot = bot
@@ -264,25 +2982,59 @@ class BaseMessageProcessor(ABC):
         """执行下载并返回文件路径"""
         pass
 
+    async def open_stream(self) -> MediaStream | None:
+        """返回可边下载边上传的数据源，不支持时返回 None，改走先下载再上传的流程"""
+        return None
+
+    def expected_size(self) -> int | None:
+        """无需下载即可得到的文件大小，用于预留磁盘空间，未知时返回 None"""
+        return None
+
+    def dedup_keys(self) -> list[str]:
+        """返回无需网络请求即可得到的去重键，用于在开始前查询去重索引"""
+        url = normalize_url(self._msg.text)
+        return [f"url:{url}"] if url else []
+
+    async def save_by_copy(self, file_processor: FileProcessor, status_msg: Message) -> Message | None:
+        """尝试在服务器端直接转存 (不传输文件内容)，成功时返回保存后的消息"""
+        return None
+
+    async def prefetch(self) -> MessageProcessorResult | None:
+        """等待用户确认时在后台获取更准确的文件信息，结果保存在处理器中供下载使用；详情有变化时返回新的详情"""
+        return None
+
+    async def download_ahead(self, file_processor: FileProcessor, task_id: int) -> str | None:
+        """用户确认前静默下载到任务目录 (不更新状态消息)，返回文件路径；不支持时返回 None"""
+        return None
+
+    def _prefetched(self, entry: tuple | None):
+        """entry 为 (获取时间, 结果)，返回未过期的结果"""
+        if entry and time.monotonic() - entry[0] < self.PREFETCH_MAX_AGE:
+            return entry[1]
+        return None
+
 
 class NoneMessageProcessor(BaseMessageProcessor):
     async def get_file_detail(self) -> MessageProcessorResult:
         return MessageProcessorResult()
 
     async def download(self, file_processor: FileProcessor, status_msg: Message) -> str | None:
-        await status_msg.edit_text(MESSAGES['unsupported_content'], reply_markup=None)
+        await file_processor.edit_status(status_msg, MESSAGES['unsupported_content'], reply_markup=None)
         return None
 
 
 class TGMediaMessageProcessor(BaseMessageProcessor):
-    def _get_message_type(self) -> str:
+    can_download_ahead = True
+    source = "tg_media"
+
+    def get_message_type(self) -> str:
         if self._msg.video: return "video"
         if self._msg.photo: return "photo"
         if self._msg.document: return "document"
         return "other"
 
     async def get_file_detail(self) -> MessageProcessorResult:
-        file_type_key = self._get_message_type()
+        file_type_key = self.get_message_type()
         file_type_str = MESSAGES["file_type_map"].get(file_type_key, "未知")
         media = getattr(self._msg, file_type_key, None)
         if not media:
@@ -293,58 +3045,298 @@ class TGMediaMessageProcessor(BaseMessageProcessor):
             file_type=file_type_str
         )
 
+    def dedup_keys(self) -> list[str]:
+        return SaveIndex.keys_for_message(self._msg)
+
+    def expected_size(self) -> int | None:
+        media = getattr(self._msg, self.get_message_type(), None)
+        return getattr(media, 'file_size', None)
+
+    async def open_stream(self) -> MediaStream | None:
+        file_type_key = self.get_message_type()
+        if file_type_key not in ("video", "document"):
+            return None
+        media = getattr(self._msg, file_type_key)
+        if not media.file_size or media.file_size <= StreamUploader.MIN_SIZE:
+            return None
+
+        video = None
+        file_name = self._file_name(file_type_key, media)
+        if file_type_key == "video":
+            video = {"duration": media.duration, "width": media.width, "height": media.height}
+        else:
+            # 以文档形式发送的视频在上传时会被转成视频消息，需要本地文件提取元数据
+            if os.path.splitext(file_name)[1].lower() in VIDEO_SUFFIXES:
+                return None
+
+        return MediaStream(
+            file_name=file_name,
+            file_size=media.file_size,
+            chunks=self._bot.stream_media(self._msg),
+            mime_type=media.mime_type or "application/octet-stream",
+            video=video,
+            thumb_file_id=media.thumbs[0].file_id if media.thumbs else None
+        )
+
+    def _file_name(self, file_type_key: str, media) -> str:
+        if file_type_key == "video":
+            return media.file_name or f"video_{self._msg.id}.mp4"
+        return media.file_name or f"document_{self._msg.id}"
+
+    async def download_to(self, target_dir: str, connections: int, progress=None, progress_args=()) -> str | None:
+        """把媒体下载到 target_dir，返回文件路径"""
+        file_type_key = self.get_message_type()
+        media = getattr(self._msg, file_type_key, None)
+        min_size = TelegramDownloader.MIN_SEGMENT_CHUNKS * TelegramDownloader.CHUNK_SIZE * 2
+        if file_type_key in ("video", "document") and connections > 1 and (media.file_size or 0) >= min_size:
+            # 大文件: 多个分段在同一个媒体会话上并发下载不同的范围
+            downloader = TelegramDownloader(self._bot, target_dir, connections)
+            return await downloader.download(
+                self._msg, self._file_name(file_type_key, media), media.file_size, progress, progress_args
+            )
+        return await self._bot.download_media(
+            self._msg, file_name=target_dir + os.sep, progress=progress, progress_args=progress_args
+        )
+
+    async def download_ahead(self, file_processor: FileProcessor, task_id: int) -> str | None:
+        if self.get_message_type() == "other":
+            return None
+        # 与 download 使用同一目录，未完成的分段下载在确认后可以继续
+        return await self.download_to(
+            file_processor.storage.task_dir(task_id), file_processor.config.TG_DOWNLOAD_CONNECTIONS
+        )
+
     async def download(self, file_processor: FileProcessor, status_msg: Message) -> str | None:
         try:
-            progress_args = (status_msg, MESSAGES['downloading'])
-            return await self._bot.download_media(
-                self._msg,
-                progress=file_processor._progress_callback,
-                progress_args=progress_args
+            return await self.download_to(
+                file_processor.storage.task_dir(status_msg.id), file_processor.config.TG_DOWNLOAD_CONNECTIONS,
+                file_processor._progress_callback, (status_msg, MESSAGES['downloading'])
             )
         except Exception as e:
             if not isinstance(e, asyncio.CancelledError):
                 logger.error(f"从消息下载失败: {e}", exc_info=True)
-                await status_msg.edit_text(MESSAGES['download_failed'].format(error=e), reply_markup=None)
+                await file_processor.edit_status(
+                    status_msg, MESSAGES['download_failed'].format(error=e), reply_markup=None
+                )
             raise
 
 
 class TGLinkMessageProcessor(BaseMessageProcessor):
+    can_download_ahead = True
+    source = "tg_link"
+
+    def __init__(self, msg: Message, bot: Client):
+        super().__init__(msg, bot)
+        self._fetched_msg = None  # 缓存链接指向的消息，避免重复请求
+
     async def get_file_detail(self) -> MessageProcessorResult:
         return MessageProcessorResult(
             file_name="来自 Telegram 链接的文件",
             file_type="链接"
         )
 
-    async def download(self, file_processor: FileProcessor, status_msg: Message) -> str | None:
+    def _parse_link(self) -> tuple[str, int]:
+        """解析链接，返回 (用户名, 消息 ID)"""
         url = self._msg.text.strip()
+        datas = url.split("/")
+        if len(datas) < 5 or not datas[4].split("?")[0].isdigit(): raise ValueError("链接格式不完整。")
+        if "/c/" in url: raise ValueError("暂不支持私人聊天 (c/) 链接。")
+        if "/b/" in url: raise ValueError("暂不支持机器人 (b/) 链接。")
+        return datas[3], int(datas[4].split("?")[0])
+
+    async def _fetch_message(self) -> Message | None:
+        if self._fetched_msg is None:
+            username, msg_id = self._parse_link()
+            self._fetched_msg = await self._bot.get_messages(username, msg_id)
+        return self._fetched_msg
+
+    async def prefetch(self) -> MessageProcessorResult | None:
+        fetched_msg = await self._fetch_message()
+        if not fetched_msg or not fetched_msg.media:
+            return None
+        return await TGMediaMessageProcessor(fetched_msg, self._bot).get_file_detail()
+
+    async def download_ahead(self, file_processor: FileProcessor, task_id: int) -> str | None:
+        fetched_msg = await self._fetch_message()
+        if not fetched_msg or not fetched_msg.media:
+            return None
+        if file_processor.config.COPY_FAST_PATH and not fetched_msg.has_protected_content:
+            # 确认后会在服务器端直接转存，无需下载
+            return None
+        return await TGMediaMessageProcessor(fetched_msg, self._bot).download_ahead(file_processor, task_id)
+
+    def dedup_keys(self) -> list[str]:
+        # 链接指向的消息已获取过时，它的 file_unique_id 也可用于去重
+        return super().dedup_keys() + SaveIndex.keys_for_message(self._fetched_msg)
+
+    def expected_size(self) -> int | None:
+        if self._fetched_msg is None or not self._fetched_msg.media:
+            return None
+        return TGMediaMessageProcessor(self._fetched_msg, self._bot).expected_size()
+
+    async def save_by_copy(self, file_processor: FileProcessor, status_msg: Message) -> Message | None:
+        try:
+            fetched_msg = await self._fetch_message()
+        except Exception:
+            # 具体错误交给 download 流程向用户报告
+            return None
+        if not fetched_msg or not fetched_msg.media or fetched_msg.has_protected_content:
+            return None
+
+        media_processor = TGMediaMessageProcessor(fetched_msg, self._bot)
         try:
-            datas = url.split("/")
-            if len(datas) < 5 or not datas[4].isdigit(): raise ValueError("链接格式不完整。")
-            if "/c/" in url: raise ValueError("暂不支持私人聊天 (c/) 链接。")
-            if "/b/" in url: raise ValueError("暂不支持机器人 (b/) 链接。")
+            # copy 对媒体消息会按 file_id 重新发送，不产生任何文件传输
+            saved_msg = await fetched_msg.copy(
+                file_processor.config.SAVE_TO_CHAT_ID,
+                reply_to_message_id=file_processor.topic_for(media_processor.get_message_type()) or None
+            )
+        except Exception as e:
+            logger.warning(f"服务器端转存失败，改为下载后重新上传: {e}")
+            return None
+
+        detail = await media_processor.get_file_detail()
+        await file_processor.edit_status(status_msg, MESSAGES['copied_success'].format(
+            filename=detail.file_name, filesize=file_processor.sizeof_fmt(detail.file_size)
+        ), reply_markup=None)
+        return saved_msg
 
-            username = datas[3]
-            msg_id = int(datas[4].split("?")[0])
+    async def open_stream(self) -> MediaStream | None:
+        try:
+            fetched_msg = await self._fetch_message()
+        except Exception:
+            return None
+        if not fetched_msg or not fetched_msg.media:
+            return None
+        return await TGMediaMessageProcessor(fetched_msg, self._bot).open_stream()
 
-            fetched_msg = await self._bot.get_messages(username, msg_id)
+    async def download(self, file_processor: FileProcessor, status_msg: Message) -> str | None:
+        try:
+            fetched_msg = await self._fetch_message()
             if not fetched_msg or not fetched_msg.media:
-                await status_msg.edit_text(MESSAGES["no_media_in_link"], reply_markup=None)
+                await file_processor.edit_status(status_msg, MESSAGES["no_media_in_link"], reply_markup=None)
                 return None
 
             # 使用 TGMediaMessageProcessor 的下载逻辑
             return await TGMediaMessageProcessor(fetched_msg, self._bot).download(file_processor, status_msg)
 
         except UsernameNotOccupied:
-            await status_msg.edit_text(MESSAGES['username_not_found'], reply_markup=None)
+            await file_processor.edit_status(status_msg, MESSAGES['username_not_found'], reply_markup=None)
         except (ValueError, IndexError) as e:
-            await status_msg.edit_text(MESSAGES['invalid_link'].format(error=str(e)), reply_markup=None)
+            await file_processor.edit_status(
+                status_msg, MESSAGES['invalid_link'].format(error=str(e)), reply_markup=None
+            )
         except Exception as e:
             logger.error(f"获取 Telegram 消息时出错: {e}", exc_info=True)
-            await status_msg.edit_text(MESSAGES['download_failed'].format(error=str(e)), reply_markup=None)
+            await file_processor.edit_status(
+                status_msg, MESSAGES['download_failed'].format(error=str(e)), reply_markup=None
+            )
         return None
 
 
+class TGBatchMessageProcessor(BaseMessageProcessor):
+    """
+    批量任务: 相册、消息 ID 范围 (https://t.me/<用户名>/100-300) 或一条消息中的多个 t.me 链接。
+    所有条目作为一个任务执行，共用一条状态消息。
+    """
+    is_batch = True
+    source = "tg_batch"
+    LINK_PATTERN = re.compile(r"https?://t\.me/([A-Za-z0-9_]{4,})/(\d+)(?:\s*-\s*(\d+))?")
+    FETCH_CHUNK = 200  # get_messages 单次最多请求 200 个 ID
+
+    @classmethod
+    def is_batch_text(cls, text: str) -> bool:
+        links = cls.LINK_PATTERN.findall(text)
+        return len(links) > 1 or any(end for _, _, end in links)
+
+    def _targets(self, max_items: int) -> dict[str, list[int]]:
+        """解析消息中的链接，返回 {用户名: [消息 ID]}，总数不超过 max_items"""
+        targets, count = {}, 0
+        for username, start, end in self.LINK_PATTERN.findall(self._msg.text or ""):
+            start = int(start)
+            end = max(int(end), start) if end else start
+            ids = targets.setdefault(username, [])
+            for msg_id in range(start, min(end, start + max_items - count - 1) + 1):
+                if msg_id not in ids:
+                    ids.append(msg_id)
+                    count += 1
+            if count >= max_items:
+                break
+        return targets
+
+    async def get_file_detail(self) -> MessageProcessorResult:
+        if self._msg.media_group_id:
+            return MessageProcessorResult(file_name="相册中的所有文件", file_type="相册")
+        count = sum(max(int(end or start), int(start)) - int(start) + 1
+                    for _, start, end in self.LINK_PATTERN.findall(self._msg.text or ""))
+        return MessageProcessorResult(file_name=f"{count} 条消息", file_type="批量")
+
+    def dedup_keys(self) -> list[str]:
+        # 每个条目单独查询去重索引
+        return []
+
+    async def resolve_messages(self, max_items: int) -> list[Message]:
+        """批量获取所有条目，展开其中的相册，只保留包含媒体的消息"""
+        if self._msg.media_group_id:
+            return (await self._bot.get_media_group(self._msg.chat.id, self._msg.id))[:max_items]
+
+        messages, seen, groups = [], set(), set()
+        for username, ids in self._targets(max_items).items():
+            for i in range(0, len(ids), self.FETCH_CHUNK):
+                fetched = await self._bot.get_messages(username, ids[i:i + self.FETCH_CHUNK])
+                for msg in fetched:
+                    if not msg or msg.empty or not msg.media:
+                        continue
+                    group = [msg]
+                    if msg.media_group_id and msg.media_group_id not in groups:
+                        # 链接只指向相册中的一条消息时，取出整个相册
+                        groups.add(msg.media_group_id)
+                        group = await self._bot.get_media_group(msg.chat.id, msg.id)
+                    for item in group:
+                        if (item.chat.id, item.id) not in seen:
+                            seen.add((item.chat.id, item.id))
+                            messages.append(item)
+        return messages[:max_items]
+
+    async def download(self, file_processor: FileProcessor, status_msg: Message) -> str | None:
+        """
+        依次下载所有条目到任务目录下的 batch 子目录并返回该目录，由通用流程逐个上传其中的文件。
+        BotHandlers._run_batch 使用流水线化的路径 (跳过已保存的条目、转存可转发的条目)，不经过这里。
+        """
+        messages = await self.resolve_messages(file_processor.config.BATCH_MAX_ITEMS)
+        if not messages:
+            return None
+        batch_dir = os.path.join(file_processor.storage.task_dir(status_msg.id), "batch")
+        for index, msg in enumerate(messages):
+            item = TGMediaMessageProcessor(msg, self._bot)
+            if item.get_message_type() == "other":
+                continue
+            # 子目录按序号补零命名，上传时按路径排序即为原来的顺序
+            await item.download_to(
+                os.path.join(batch_dir, f"{index:04d}"), file_processor.config.TG_DOWNLOAD_CONNECTIONS,
+                file_processor._progress_callback, (status_msg, MESSAGES['downloading'])
+            )
+        return batch_dir if os.path.isdir(batch_dir) else None
+
+
 class AriaMessageProcessor(BaseMessageProcessor):
+    source = "aria"
+
+    def __init__(self, msg: Message, bot: Client):
+        super().__init__(msg, bot)
+        self._probe = None  # (探测时间, HttpDownloader.probe 的结果)
+
+    async def prefetch(self) -> MessageProcessorResult | None:
+        url = self._msg.text.strip()
+        if not url.startswith(("http://", "https://")):
+            return None
+        probe = await HttpDownloader.probe(http_client(), url)
+        self._probe = (time.monotonic(), probe)
+        return MessageProcessorResult(file_name=probe[1], file_size=probe[2], file_type="链接")
+
+    def expected_size(self) -> int | None:
+        probe = self._prefetched(self._probe)
+        return probe[2] if probe else None
+
     async def get_file_detail(self) -> MessageProcessorResult:
         text = self._msg.text.strip()
         return MessageProcessorResult(
@@ -352,66 +3344,174 @@ class AriaMessageProcessor(BaseMessageProcessor):
             file_type="链接"
         )
 
+    async def open_stream(self) -> MediaStream | None:
+        url = self._msg.text.strip()
+        if not url.startswith(("http://", "https://")):
+            return None
+        # 视频和图片需要本地文件来提取元数据，仍然走先下载再上传的流程
+        if os.path.splitext(urlparse(url).path)[1].lower() in VIDEO_SUFFIXES + PHOTO_SUFFIXES:
+            return None
+
+        client = http_client()
+        try:
+            # 禁用压缩，保证 Content-Length 与实际字节数一致
+            request = client.build_request("GET", url, headers={"Accept-Encoding": "identity"})
+            response = await client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            logger.warning(f"无法以流式方式打开 {url}: {e}")
+            return None
+        try:
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning(f"无法以流式方式打开 {url}: {e}")
+            await response.aclose()
+            return None
+
+        file_name = filename_from_response(response, url)
+        content_length = response.headers.get("Content-Length")
+        file_size = int(content_length) if content_length and content_length.isdigit() else None
+        is_media = os.path.splitext(file_name)[1].lower() in VIDEO_SUFFIXES + PHOTO_SUFFIXES
+        if is_media or (file_size is not None and file_size <= StreamUploader.MIN_SIZE):
+            await response.aclose()
+            return None
+
+        async def release():
+            # 只关闭响应，连接回到共享的连接池
+            await response.aclose()
+
+        async def chunks():
+            try:
+                async for chunk in response.aiter_raw(1024 * 1024):
+                    yield chunk
+            finally:
+                await release()
+
+        mime_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+        return MediaStream(
+            file_name=file_name,
+            file_size=file_size,
+            chunks=chunks(),
+            mime_type=mime_type or "application/octet-stream",
+            release=release
+        )
+
     async def download(self, file_processor: FileProcessor, status_msg: Message) -> str | None:
         url = self._msg.text.strip()
-        await status_msg.edit_text("⏳ **下载任务已提交给 Aria2c...**\n这可能需要一些时间，且期间无进度更新。")
-        loop = asyncio.get_event_loop()
+        if url.startswith(("http://", "https://")):
+            try:
+                return await file_processor.download_from_url(url, status_msg, probe=self._prefetched(self._probe))
+            except (httpx.HTTPError, IOError) as e:
+                logger.error(f"HTTP 下载失败: {e}")
+                await file_processor.edit_status(
+                    status_msg, MESSAGES['download_failed'].format(error=str(e)), reply_markup=None
+                )
+                return None
+
+        await file_processor.edit_status(
+            status_msg, MESSAGES['aria2_metadata'], reply_markup=file_processor.task_keyboard(status_msg.id)
+        )
         try:
-            # 在 executor 中运行阻塞的下载方法
-            file_path = await loop.run_in_executor(None, file_processor.download_from_url_sync, url)
-            return file_path
-        except IOError as e:
-            await status_msg.edit_text(MESSAGES['download_failed'].format(error=str(e)), reply_markup=None)
+            return await file_processor.download_magnet(url, status_msg)
+        except (httpx.HTTPError, IOError) as e:
+            logger.error(f"磁力链接下载失败: {e}")
+            await file_processor.edit_status(
+                status_msg, MESSAGES['download_failed'].format(error=str(e)), reply_markup=None
+            )
             return None
 
 
 class M3U8MessageProcessor(BaseMessageProcessor):
     """处理 M3U8 视频流的处理器"""
+    source = "m3u8"
 
-    def _download_with_ffmpeg_sync(self, url: str, download_dir: str) -> str:
-        """
-        使用 FFmpeg 下载并合并 M3U8 流 (这是一个阻塞方法)。
-        此版本使用重新编码，以确保最大的兼容性。
-        需要系统上安装了 FFmpeg。
-        """
-        try:
-            filename = os.path.basename(urlparse(url).path).split('.m3u8')[0] or str(int(time.time()))
-            output_filename = f"{filename}.mp4"
-            output_path = os.path.join(download_dir, output_filename)
+    COPY_VIDEO_CODECS = ("h264", "hevc")
+    COPY_AUDIO_CODECS = ("aac", "mp3")
+
+    def __init__(self, msg: Message, bot: Client):
+        super().__init__(msg, bot)
+        self._playlist = None  # (获取时间, HLSDownloader.select_variant 的结果)
+
+    @staticmethod
+    def _non_square_pixels(stream: dict) -> bool:
+        return stream.get("sample_aspect_ratio") not in (None, "1:1", "0:1", "N/A")
+
+    @classmethod
+    def _copy_blockers(cls, probe: dict) -> dict[str, str]:
+        """判断各类流能否直接复制，返回需要重新编码的流类型 ("video"/"audio") 及原因，全部可以复制时为空"""
+        blockers = {}
+        for stream in probe.get("streams", []):
+            codec_type, codec = stream.get("codec_type"), stream.get("codec_name")
+            if codec_type == "video":
+                if codec not in cls.COPY_VIDEO_CODECS:
+                    blockers.setdefault("video", f"视频编码 {codec} 无法直接封装为 MP4")
+                # 非方形像素在部分播放器上会显示变形，需要重新编码修正宽高比
+                elif cls._non_square_pixels(stream):
+                    blockers.setdefault("video", f"像素宽高比为 {stream['sample_aspect_ratio']}")
+            elif codec_type == "audio" and codec not in cls.COPY_AUDIO_CODECS:
+                blockers.setdefault("audio", f"音频编码 {codec} 无法直接封装为 MP4")
+        return blockers
 
-            # -c:v libx264: 指定视频编码器为 libx264 (H.264)，这会重新编码视频以修复宽高比问题。
+    @classmethod
+    def _build_ffmpeg_args(cls, url: str, output_path: str, probe: dict, reencode=(),
+                           input_args: list[str] = ()) -> list[str]:
+        """reencode 为需要重新编码的流类型，其余的流直接复制"""
+        streams = probe.get("streams", [])
+        codecs = {s.get("codec_type"): s.get("codec_name") for s in streams}
+        args = [*input_args, "-i", url]
+        if "video" in reencode:
+            # -c:v libx264: 重新编码为 H.264。
             # -preset veryfast: 编码速度预设。越快的文件越大，cpu占用越低。'veryfast' 是速度和质量的一个很好平衡点。
             # -crf 23: 控制视频质量。数字越小，质量越高，文件越大。23 是一个公认的良好默认值。
-            # -c:a copy: 保持音频流为直接复制，以节省时间。
-            # -bsf:a aac_adtstoasc: 依然需要，用于修复 AAC 音频在 MP4 容器中的兼容性。
-            cmd = [
-                "ffmpeg",
-                "-i", url,
-                "-c:v", "libx264",
-                "-preset", "veryfast",
-                "-crf", "23",
-                "-c:a", "copy",
-                "-bsf:a", "aac_adtstoasc",
-                output_path
-            ]
-
-            # 使用 subprocess.run 执行命令
-            run(cmd, check=True, capture_output=True, text=True, encoding='utf-8')
+            args += ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23"]
+            video = next((s for s in streams if s.get("codec_type") == "video"), {})
+            if cls._non_square_pixels(video):
+                # 按像素宽高比缩放宽度得到方形像素 (H.264 要求宽高为偶数)
+                args += ["-vf", "scale=trunc(iw*sar/2)*2:trunc(ih/2)*2,setsar=1"]
+        else:
+            args += ["-c:v", "copy"]
+            if codecs.get("video") == "hevc":
+                args += ["-tag:v", "hvc1"]  # 让 Apple 设备和 Telegram 客户端识别 HEVC
+        # 音频只有 AAC/MP3 能直接复制到 MP4 中，其它编码转为 AAC
+        if "audio" in reencode or codecs.get("audio", "aac") not in cls.COPY_AUDIO_CODECS:
+            args += ["-c:a", "aac"]
+        else:
+            args += ["-c:a", "copy"]
+            # -bsf:a aac_adtstoasc: 修复 AAC 音频在 MP4 容器中的兼容性。
+            if codecs.get("audio") == "aac":
+                args += ["-bsf:a", "aac_adtstoasc"]
+        # 把 moov 放到文件开头，Telegram 客户端可以边下边播
+        return args + ["-movflags", "+faststart", output_path]
 
-            if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-                raise IOError("FFmpeg 执行完毕，但未生成有效的输出文件。")
+    async def _remux(self, url: str, output_path: str, file_processor: FileProcessor, status_msg: Message,
+                     input_args: list[str] = ()) -> str:
+        """先探测流信息，能直接复制就复制，否则 (或复制失败时) 只重新编码不能复制的流"""
+        probe = await ffprobe(url, input_args)
+        duration = float(probe.get("format", {}).get("duration") or 0) or None
+        blockers = self._copy_blockers(probe)
 
-            return output_path
-        except CalledProcessError as e:
-            error_output = e.stderr or e.stdout
-            logger.error(f"FFmpeg 执行失败: {error_output}")
-            raise IOError(MESSAGES['ffmpeg_failed'])
-        except FileNotFoundError:
-            logger.error("FFmpeg 命令未找到。请确保 FFmpeg 已安装并位于系统的 PATH 中。")
-            raise IOError("FFmpeg 未安装。")
-        except Exception as e:
-            logger.error(f"未知的 FFmpeg 下载错误: {e}")
-            raise IOError(f"未知下载错误: {e}")
+        async def run(reencode, action: str):
+            async def on_progress(progress):
+                await file_processor._ffmpeg_progress_callback(progress, duration, status_msg, action)
+
+            await run_ffmpeg(self._build_ffmpeg_args(url, output_path, probe, reencode, input_args), on_progress,
+                             priority=MediaPool.ENCODE if "video" in reencode else MediaPool.COPY, phase="transcode")
+
+        if not blockers:
+            logger.info(f"M3U8 直接复制流: {url}")
+            try:
+                await run((), MESSAGES['ffmpeg_copying'])
+                return "copy"
+            except IOError:
+                blockers = {"video": "直接复制失败"}
+        reason = "，".join(blockers.values())
+        logger.info(f"M3U8 重新编码 ({reason}): {url}")
+        await run(blockers, MESSAGES['ffmpeg_encoding'].format(reason=reason))
+        return "encode"
+
+    async def prefetch(self) -> MessageProcessorResult | None:
+        # 只获取播放列表，文件大小要下载完才能知道
+        self._playlist = (time.monotonic(), await HLSDownloader.select_variant(http_client(), self._msg.text.strip()))
+        return None
 
     async def get_file_detail(self) -> MessageProcessorResult:
         text = self._msg.text.strip()
@@ -424,22 +3524,85 @@ class M3U8MessageProcessor(BaseMessageProcessor):
 
     async def download(self, file_processor: FileProcessor, status_msg: Message) -> str | None:
         url = self._msg.text.strip()
-        await status_msg.edit_text(MESSAGES['ffmpeg_processing'], reply_markup=None)
-        loop = asyncio.get_event_loop()
-        try:
-            file_path = await loop.run_in_executor(
-                None,
-                self._download_with_ffmpeg_sync,
-                url,
-                file_processor.download_dir
+        await file_processor.edit_status(
+            status_msg, MESSAGES['ffmpeg_processing'], reply_markup=file_processor.task_keyboard(status_msg.id)
+        )
+        filename = os.path.basename(urlparse(url).path).split('.m3u8')[0] or str(int(time.time()))
+        task_dir = file_processor.storage.task_dir(status_msg.id)
+        output_path = unique_path(os.path.join(task_dir, f"{filename}.mp4"))
+        work_dir = os.path.join(task_dir, "hls")
+        try:
+            source, input_args = url, []
+            if file_processor.config.M3U8_ENGINE == "native":
+                try:
+                    downloader = HLSDownloader(work_dir, file_processor.config.HLS_CONCURRENCY)
+                    source = await downloader.download(
+                        url, file_processor._progress_callback, (status_msg, MESSAGES['downloading']),
+                        playlist=self._prefetched(self._playlist)
+                    )
+                    input_args = HLSDownloader.FFMPEG_INPUT_ARGS
+                except UnsupportedPlaylist as e:
+                    logger.info(f"内置 HLS 下载器无法处理 ({e})，改用 ffmpeg 下载: {url}")
+            mode = await self._remux(source, output_path, file_processor, status_msg, input_args)
+            if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+                raise IOError("FFmpeg 执行完毕，但未生成有效的输出文件。")
+            logger.info(f"M3U8 合并完成 ({'直接复制' if mode == 'copy' else '重新编码'}): {output_path}")
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return output_path
+        except BaseException as e:
+            with suppress(FileNotFoundError):
+                os.remove(output_path)
+            # 被中断时保留已下载的分片 (重启后可续传)，任务目录由 StorageManager 统一删除
+            if not isinstance(e, (IOError, httpx.HTTPError)):
+                raise
+            shutil.rmtree(work_dir, ignore_errors=True)
+            await file_processor.edit_status(
+                status_msg, MESSAGES['download_failed'].format(error=str(e)), reply_markup=None
             )
-            return file_path
-        except IOError as e:
-            await status_msg.edit_text(MESSAGES['download_failed'].format(error=str(e)), reply_markup=None)
             return None
 
 
+class DouyinResolver:
+    """
+    把抖音分享链接解析为无水印视频的详情。
+    请求经共享的 HTTP 客户端发出，成功的结果按分享链接缓存，同一链接在 ttl 秒内不会重复请求解析接口。
+    """
+
+    def __init__(self, api_url: str = "https://api.douyin.wtf/api", cache_ttl: float = 600, cache_size: int = 256):
+        self.api_url = api_url
+        self._cache = TTLCache(cache_size, cache_ttl)
+
+    @staticmethod
+    def cache_key(text: str) -> str:
+        # 分享文本中除链接外的标题、口令等内容不影响解析结果
+        match = re.search(r"https?://\S+", text)
+        return match.group(0) if match else text.strip()
+
+    async def resolve(self, text: str) -> MessageProcessorResult:
+        key = self.cache_key(text)
+        details = self._cache.get(key)
+        if details:
+            return details
+        res = await http_client().get(self.api_url, params={"url": text.strip()}, timeout=20)
+        res.raise_for_status()
+        data = res.json()
+        if not data or not data.get('video_data'):
+            raise ValueError("API 返回数据格式无效")
+        video_data = data['video_data']
+        details = MessageProcessorResult(
+            file_name=(video_data.get('title') or '抖音视频').replace('/', '_') + '.mp4',
+            file_size=video_data.get('size'),
+            file_type="抖音视频",
+            link=video_data.get('nwm_video_url')  # 无水印链接
+        )
+        self._cache.set(key, details)
+        return details
+
+
 class DouyinMessageProcessor(BaseMessageProcessor):
+    source = "douyin"
+    resolver = DouyinResolver()  # create_bot 会按配置替换
+
     def __init__(self, msg: Message, bot: Client):
         super().__init__(msg, bot)
         self._details = None  # 缓存获取到的详情
@@ -447,52 +3610,47 @@ class DouyinMessageProcessor(BaseMessageProcessor):
     async def get_file_detail(self) -> MessageProcessorResult:
         if self._details:
             return self._details
+        try:
+            self._details = await self.resolver.resolve(self._msg.text)
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error(f"请求抖音 API 失败: {e}")
+            self._details = MessageProcessorResult(file_name="抖音链接解析失败", file_type="抖音")
+        return self._details
 
-        text = self._msg.text.strip()
-        # 使用异步 httpx
-        async with httpx.AsyncClient() as client:
-            try:
-                res = await client.get("https://api.douyin.wtf/api?url=" + text, timeout=20)
-                res.raise_for_status()
-                data = res.json()
-                if data and data.get('video_data'):
-                    video_data = data['video_data']
-                    self._details = MessageProcessorResult(
-                        file_name=video_data.get('title', '抖音视频') + '.mp4',
-                        file_size=video_data.get('size'),
-                        file_type="抖音视频",
-                        link=video_data.get('nwm_video_url')  # 无水印链接
-                    )
-                    return self._details
-                else:
-                    raise ValueError("API 返回数据格式无效")
-            except (httpx.RequestError, ValueError, json.JSONDecodeError) as e:
-                logger.error(f"请求抖音 API 失败: {e}")
-                self._details = MessageProcessorResult(file_name="抖音链接解析失败", file_type="抖音")
-                return self._details
+    def expected_size(self) -> int | None:
+        return self._details.file_size if self._details else None
 
     async def download(self, file_processor: FileProcessor, status_msg: Message) -> str | None:
         details = await self.get_file_detail()
         if not details or not details.link:
-            await status_msg.edit_text(MESSAGES['download_failed'].format(error="无法解析抖音下载链接。"),
+            await file_processor.edit_status(status_msg, MESSAGES['download_failed'].format(error="无法解析抖音下载链接。"),
                                        reply_markup=None)
             return None
 
-        # 复用 AriaMessageProcessor 的下载逻辑
-        # 创建一个临时的 Message 对象来传递 URL
-        temp_msg = Message(text=details.link, id=self._msg.id, chat=self._msg.chat)
-        return await AriaMessageProcessor(temp_msg, self._bot).download(file_processor, status_msg)
+        # 直接从无水印链接下载 (分段并发、可续传)，进度显示在状态消息中
+        try:
+            return await file_processor.download_from_url(details.link, status_msg, file_name=details.file_name)
+        except (httpx.HTTPError, IOError) as e:
+            logger.error(f"抖音视频下载失败: {e}")
+            await file_processor.edit_status(
+                status_msg, MESSAGES['download_failed'].format(error=str(e)), reply_markup=None
+            )
+            return None
 
 
 class MessageProcessorFactory:
     @staticmethod
     def create_processor(msg: Message, bot: Client) -> BaseMessageProcessor:
         if msg.media:
+            if msg.media_group_id:
+                return TGBatchMessageProcessor(msg, bot)
             return TGMediaMessageProcessor(msg, bot)
         elif msg.text:
             text = msg.text.strip()
             # 简单的路由
-            if "douyin.com" in text or "iesdouyin.com" in text:
+            if TGBatchMessageProcessor.is_batch_text(text):
+                return TGBatchMessageProcessor(msg, bot)
+            elif "douyin.com" in text or "iesdouyin.com" in text:
                 return DouyinMessageProcessor(msg, bot)
             elif ".m3u8" in text.lower():  # --- 新增 M3U8 路由 ---
                 return M3U8MessageProcessor(msg, bot)
@@ -504,22 +3662,284 @@ class MessageProcessorFactory:
         return NoneMessageProcessor(msg, bot)
 
 
+class JobScheduler:
+    """
+    有界任务调度器。
+    限制全局与每个用户同时运行的任务数，在有任务排队的用户之间轮转放行，
+    并为下载和上传阶段分别提供独立的槽位池。
+    """
+
+    def __init__(self, max_jobs: int, max_jobs_per_user: int, max_downloads: int, max_uploads: int):
+        self.max_jobs = max(1, max_jobs)
+        self.max_jobs_per_user = max(1, max_jobs_per_user)
+        self._slots = {
+            "download": asyncio.Semaphore(max(1, max_downloads)),
+            "upload": asyncio.Semaphore(max(1, max_uploads)),
+        }
+        self._queues: dict[str, deque] = {}  # 用户 -> 等待中的 (job_id, future)
+        self._round_robin = deque()  # 有任务排队的用户，按轮转顺序排列
+        self._running: dict[str, int] = {}
+        self._running_total = 0
+        self._on_queue_changed = None
+
+    def set_queue_listener(self, callback):
+        """注册排队位置变化时的回调: callback(job_id, position)"""
+        self._on_queue_changed = callback
+
+    def slot(self, kind: str) -> asyncio.Semaphore:
+        """获取 'download' 或 'upload' 槽位池，使用 `async with` 占用"""
+        return self._slots[kind]
+
+    @asynccontextmanager
+    async def job(self, user_id, job_id):
+        """在整个任务期间占用一个全局槽位和一个用户槽位"""
+        user = str(user_id)
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user, deque()).append((job_id, future))
+        if user not in self._round_robin:
+            self._round_robin.append(user)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 放行与取消同时发生，归还已分配的槽位
+                self._release(user)
+            else:
+                self._remove_waiter(user, job_id)
+            raise
+        try:
+            yield
+        finally:
+            self._release(user)
+
+    def _release(self, user: str):
+        self._running[user] -= 1
+        self._running_total -= 1
+        if not self._running[user]:
+            del self._running[user]
+        self._dispatch()
+
+    def _remove_waiter(self, user: str, job_id):
+        queue = self._queues.get(user)
+        if queue:
+            for item in list(queue):
+                if item[0] == job_id:
+                    queue.remove(item)
+            if not queue:
+                del self._queues[user]
+                with suppress(ValueError):
+                    self._round_robin.remove(user)
+        self._notify_positions()
+
+    def _dispatch(self):
+        """按用户轮转放行排队中的任务，直到没有空闲槽位"""
+        while self._running_total < self.max_jobs:
+            for _ in range(len(self._round_robin)):
+                user = self._round_robin[0]
+                self._round_robin.rotate(-1)
+                if self._running.get(user, 0) < self.max_jobs_per_user:
+                    break
+            else:
+                break
+
+            queue = self._queues[user]
+            _, future = queue.popleft()
+            if not queue:
+                del self._queues[user]
+                self._round_robin.remove(user)
+            if future.done():
+                continue
+            self._running[user] = self._running.get(user, 0) + 1
+            self._running_total += 1
+            future.set_result(None)
+        self._notify_positions()
+
+    def queue_positions(self) -> dict:
+        """按轮转顺序估算每个排队任务的位置 (从 1 开始)"""
+        positions = {}
+        pending = [list(self._queues[user]) for user in self._round_robin]
+        position = 0
+        while any(pending):
+            for items in pending:
+                if items:
+                    position += 1
+                    positions[items.pop(0)[0]] = position
+        return positions
+
+    def _notify_positions(self):
+        if not self._on_queue_changed:
+            return
+        for job_id, position in self.queue_positions().items():
+            self._on_queue_changed(job_id, position)
+
+
+class Authorizer:
+    """
+    用户鉴权与保存频道的可用性检查。
+    用户白名单为集合查找；保存频道的检查结果缓存 ttl 秒 (失败的结果只缓存 FAILURE_TTL 秒)，
+    过期后先返回旧结果，同时在后台刷新，消息处理不必等待 get_chat。
+    """
+    FAILURE_TTL = 30
+
+    def __init__(self, bot: Client, allowed_users: set[str], save_chat_id: int, ttl: float = 300):
+        self.bot = bot
+        self.allowed_users = allowed_users
+        self.save_chat_id = save_chat_id
+        self.ttl = ttl
+        self._chat_ok = None  # None 表示尚未检查过
+        self._expires_at = 0.0
+        self._refreshing = None
+        self.counters = {"user_checks": 0, "user_denied": 0, "chat_hits": 0, "chat_misses": 0, "chat_refreshes": 0}
+
+    def is_allowed(self, user_id: int) -> bool:
+        self.counters["user_checks"] += 1
+        if self.allowed_users and str(user_id) not in self.allowed_users:
+            self.counters["user_denied"] += 1
+            return False
+        return True
+
+    async def refresh(self) -> bool:
+        """立即检查保存频道，FloodWait 等临时错误时保留上次的结果"""
+        self.counters["chat_refreshes"] += 1
+        try:
+            await self.bot.get_chat(self.save_chat_id)
+            self._chat_ok = True
+        except FloodWait as e:
+            logger.warning(f"检查保存频道时触发 FloodWait，{e.value} 秒内沿用上次的结果")
+            record_flood_wait("get_chat", e.value)
+            if self._chat_ok is None:
+                # 尚无结果时不阻止用户，频道确实不可用时会在保存时报错
+                self._chat_ok = True
+            self._expires_at = time.monotonic() + e.value
+            return self._chat_ok
+        except Exception as e:
+            logger.warning(f"机器人无法访问保存频道: {e}")
+            self._chat_ok = False
+        self._expires_at = time.monotonic() + (self.ttl if self._chat_ok else self.FAILURE_TTL)
+        return self._chat_ok
+
+    async def save_chat_ok(self) -> bool:
+        if self._chat_ok is None:
+            # 第一次检查只能等待结果
+            self.counters["chat_misses"] += 1
+            return await self.refresh()
+        self.counters["chat_hits"] += 1
+        if time.monotonic() >= self._expires_at and not self._refreshing:
+            self._refreshing = asyncio.create_task(self.refresh())
+            self._refreshing.add_done_callback(lambda _: setattr(self, "_refreshing", None))
+        return self._chat_ok
+
+    def metrics(self) -> dict:
+        lookups = self.counters["chat_hits"] + self.counters["chat_misses"]
+        return {
+            **self.counters,
+            "chat_hit_rate": self.counters["chat_hits"] / lookups if lookups else 0.0,
+            "chat_ok": self._chat_ok,
+        }
+
+
+@dataclass
+class BatchProgress:
+    """批量任务的汇总进度，所有条目共用一条状态消息"""
+    total: int
+    total_size: int
+    saved: int = 0
+    skipped: int = 0
+    failed: int = 0
+    uploaded_size: int = 0  # 成功上传的条目的总大小
+    downloaded: dict = field(default_factory=dict)  # 条目序号 -> 已下载字节数
+    uploaded: dict = field(default_factory=dict)  # 条目序号 -> 已上传字节数
+
+    @property
+    def finished(self) -> int:
+        return self.saved + self.skipped + self.failed
+
+    def complete(self, index: int, size: int):
+        """条目结束 (成功、跳过或失败)，之后按完整大小计入进度"""
+        self.downloaded[index] = self.uploaded[index] = size
+
+    def text(self, speed: float) -> str:
+        return MESSAGES['batch_progress'].format(
+            finished=self.finished, total=self.total,
+            saved=self.saved, skipped=self.skipped, failed=self.failed,
+            downloaded=FileProcessor.sizeof_fmt(sum(self.downloaded.values())),
+            uploaded=FileProcessor.sizeof_fmt(sum(self.uploaded.values())),
+            total_size=FileProcessor.sizeof_fmt(self.total_size),
+            speed=FileProcessor.sizeof_fmt(speed)
+        )
+
+
+@dataclass
+class PendingConfirmation:
+    """等待用户确认的下载请求: 保留处理器以及后台的预取和提前下载，确认后由任务继续使用"""
+    processor: BaseMessageProcessor
+    detail: MessageProcessorResult
+    created_at: float = field(default_factory=time.monotonic)
+    prefetch: asyncio.Task | None = None  # 获取文件信息并更新确认消息
+    download: asyncio.Task | None = None  # 提前下载，结果为文件路径 (不支持或失败时为 None)
+
+
 class BotHandlers:
     """处理所有 Pyrogram 事件回调的类"""
+    BATCH_QUEUE_SIZE = 2  # 批量任务中已下载、等待上传的条目数上限
+    MEDIA_GROUP_TTL = 60  # 相册中的消息会分别到达，在此时间内只为第一条消息请求确认
+    CONFIRMATION_TTL = 3600  # 超过此时间仍未确认的请求不再保留预取的信息和提前下载的数据
+    DOWNLOAD_AHEAD_LIMIT = 2  # 同时进行的提前下载数
+    # 文件已保存过时的确认按钮: 按记录的消息重新转存，而不是重新下载
+    RESAVE_KEYBOARD = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ 重新保存", callback_data="resave"),
+        InlineKeyboardButton("❌ 取消", callback_data="cancel_op")
+    ]])
+    WORKER_LEASE = 60  # 工作进程的任务租约 (秒)，进程退出后超过此时间任务由其他工作进程接手
+    WORKER_POLL_INTERVAL = 2  # 工作进程检查新任务和取消请求的间隔 (秒)
+    RESUME_RETRIES = 5  # 恢复任务时获取状态消息失败的重试次数
 
-    def __init__(self, bot: Client, config: Config, processor: FileProcessor):
+    def __init__(self, bot: Client, config: Config, processor: FileProcessor, save_index: SaveIndex,
+                 journal: JobJournal):
         self.bot = bot
         self.config = config
         self.file_processor = processor
+        self.save_index = save_index
+        self.journal = journal
+        self.auth = Authorizer(bot, config.ALLOWED_USERS, config.SAVE_TO_CHAT_ID, config.SAVE_CHAT_CHECK_TTL)
+        self._shutting_down = False
         self.active_tasks = {}
+        self._status_messages = {}  # task_id -> 状态消息
+        self._queue_positions = {}  # task_id -> 最近一次显示的排队位置，仅排队中的任务才有
+        self._seen_media_groups = {}  # media_group_id -> 首次收到的时间
+        self._confirmations = {}  # 确认消息 ID -> PendingConfirmation
+        self._download_ahead_slots = asyncio.Semaphore(self.DOWNLOAD_AHEAD_LIMIT)
+        self.scheduler = JobScheduler(
+            config.MAX_CONCURRENT_TASKS, config.MAX_TASKS_PER_USER,
+            config.MAX_CONCURRENT_DOWNLOADS, config.MAX_CONCURRENT_UPLOADS
+        )
+        self.scheduler.set_queue_listener(self._on_queue_position)
+
+    def _on_queue_position(self, task_id: int, position: int):
+        """排队位置变化时更新状态消息，位置未变则跳过"""
+        if task_id not in self._queue_positions or self._queue_positions[task_id] == position:
+            return
+        self._queue_positions[task_id] = position
+        status_msg = self._status_messages.get(task_id)
+        if status_msg:
+            self.file_processor.progress.submit(
+                status_msg,
+                MESSAGES['waiting_for_tasks'].format(position=position),
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("🔴 取消任务", callback_data=f"cancel_task:{task_id}")
+                ]])
+            )
+
+    @staticmethod
+    def _saved_link_text(entry: SavedEntry) -> str:
+        return f"[查看已保存的消息]({entry.link})\n" if entry.link else ""
 
     async def _is_authorized(self, message: Message) -> bool:
-        if self.config.ALLOWED_USERS and str(message.from_user.id) not in self.config.ALLOWED_USERS:
+        if not self.auth.is_allowed(message.from_user.id):
             await message.reply_text(MESSAGES['auth_failed'])
             return False
-        try:
-            await self.bot.get_chat(self.config.SAVE_TO_CHAT_ID)
-        except Exception:
+        if not await self.auth.save_chat_ok():
             await message.reply_text(MESSAGES['bot_not_in_chat'])
             return False
         return True
@@ -540,127 +3960,802 @@ class BotHandlers:
             if message.chat.type == pyrogram.enums.ChatType.PRIVATE:
                 await message.reply_text(MESSAGES['usage'], quote=True)
             return
+        if message.media_group_id:
+            now = time.monotonic()
+            for group_id, seen_at in list(self._seen_media_groups.items()):
+                if now - seen_at > self.MEDIA_GROUP_TTL:
+                    del self._seen_media_groups[group_id]
+            if message.media_group_id in self._seen_media_groups:
+                return
+            self._seen_media_groups[message.media_group_id] = now
 
-        file_detail = await message_processor.get_file_detail()
-
-        confirm_text = MESSAGES['confirm_download'].format(
-            filename=file_detail.file_name,
-            filetype=file_detail.file_type,
-            filesize=self.file_processor.sizeof_fmt(file_detail.file_size)
-        )
         keyboard = InlineKeyboardMarkup([[
             InlineKeyboardButton("✅ 下载", callback_data="confirm_download"),
             InlineKeyboardButton("❌ 取消", callback_data="cancel_op")
         ]])
-        await message.reply_text(confirm_text, reply_markup=keyboard, quote=True)
+
+        # 先查去重索引，已保存过的文件直接给出链接
+        entry = self.save_index.lookup(message_processor.dedup_keys())
+        if entry:
+            await message.reply_text(MESSAGES['already_saved'].format(
+                filename=entry.file_name or "N/A",
+                filesize=self.file_processor.sizeof_fmt(entry.file_size),
+                link=self._saved_link_text(entry)
+            ), reply_markup=self.RESAVE_KEYBOARD, quote=True)
+            return
+
+        file_detail = await message_processor.get_file_detail()
+        confirm_text, confirmable = self._confirm_text(file_detail)
+        if not confirmable:
+            await message.reply_text(confirm_text, quote=True)
+            return
+        status_msg = await message.reply_text(confirm_text, reply_markup=keyboard, quote=True)
+
+        # 等待用户点击期间在后台获取文件信息，确认后任务直接使用这个处理器
+        await self._expire_confirmations()
+        pending = PendingConfirmation(message_processor, file_detail)
+        self._confirmations[status_msg.id] = pending
+        pending.prefetch = asyncio.create_task(self._prefetch(status_msg, pending, keyboard))
+
+    def _confirm_text(self, detail: MessageProcessorResult) -> tuple[str, bool]:
+        """返回 (确认消息的内容, 是否可以下载)，文件超过上限且不允许分割时返回错误信息"""
+        confirm_text = MESSAGES['confirm_download'].format(
+            filename=detail.file_name,
+            filetype=detail.file_type,
+            filesize=self.file_processor.sizeof_fmt(detail.file_size)
+        )
+        # 已知大小时提前检查是否超过上限，避免下载完才失败
+        if detail.file_size and detail.file_size > self.config.MAX_FILE_SIZE:
+            limit = self.file_processor.sizeof_fmt(self.config.MAX_FILE_SIZE)
+            if not self.config.SPLIT_OVERSIZE:
+                return MESSAGES['file_too_large'].format(
+                    filesize=self.file_processor.sizeof_fmt(detail.file_size), limit=limit
+                ), False
+            confirm_text += MESSAGES['split_notice'].format(limit=limit)
+        return confirm_text, True
+
+    async def _prefetch(self, status_msg: Message, pending: PendingConfirmation, keyboard: InlineKeyboardMarkup):
+        """获取更准确的文件信息并更新确认消息，然后视配置开始提前下载"""
+        task_id = status_msg.id
+        processor = pending.processor
+        current_job.set((task_id, processor.source))
+        try:
+            async with METRICS.span("prefetch"):
+                detail = await processor.prefetch()
+        except Exception as e:
+            # 具体错误在确认后的下载流程中报告
+            logger.info(f"预取任务 {task_id} 的文件信息失败: {e}")
+            return
+
+        if detail and detail != pending.detail:
+            pending.detail = detail
+            # 链接指向的文件可能已经保存过
+            entry = self.save_index.lookup(processor.dedup_keys())
+            if entry:
+                text, confirmable = MESSAGES['already_saved'].format(
+                    filename=entry.file_name or "N/A",
+                    filesize=self.file_processor.sizeof_fmt(entry.file_size),
+                    link=self._saved_link_text(entry)
+                ), True
+            else:
+                text, confirmable = self._confirm_text(detail)
+                if not confirmable:
+                    self._confirmations.pop(task_id, None)
+            markup = (self.RESAVE_KEYBOARD if entry else keyboard) if confirmable else None
+            with suppress(Exception):
+                await self.file_processor.edit_status(status_msg, text, reply_markup=markup)
+            if entry or not confirmable:
+                return
+
+        size = processor.expected_size()
+        limit = min(self.config.DOWNLOAD_AHEAD_MAX_SIZE, self.config.MAX_FILE_SIZE)
+        # 只在有空闲的下载槽位时提前下载，不与已确认的任务争抢带宽
+        # 拆分部署时任务在工作进程中执行，前端不提前下载
+        if (self.config.ROLE == "all" and processor.can_download_ahead and size and size <= limit
+                and not self._download_ahead_slots.locked() and not self.scheduler.slot("download").locked()):
+            pending.download = asyncio.create_task(self._download_ahead(task_id, processor, size))
+
+    async def _download_ahead(self, task_id: int, processor: BaseMessageProcessor, size: int) -> str | None:
+        async with self._download_ahead_slots:
+            storage = self.file_processor.storage
+            try:
+                # 空间不足时放弃，不排队等待
+                await storage.reserve(task_id, size, wait=False)
+            except IOError:
+                return None
+            try:
+                async with METRICS.span("download_ahead") as span:
+                    file_path = await processor.download_ahead(self.file_processor, task_id)
+                    if file_path:
+                        span["bytes"] = os.path.getsize(file_path)
+            except Exception as e:
+                logger.info(f"任务 {task_id} 提前下载失败: {e}")
+                return None
+            if not file_path:
+                await storage.release(task_id)
+            return file_path
+
+    @staticmethod
+    async def _finish_download_ahead(task: asyncio.Task) -> str | None:
+        """提前下载已完成时返回文件路径；仍在进行的取消，未完成的分段由正常的下载流程继续"""
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return None
+        if task.cancelled():
+            return None
+        file_path = task.result()
+        return file_path if file_path and os.path.exists(file_path) else None
+
+    async def _resave(self, query: CallbackQuery, status_msg: Message) -> bool:
+        """
+        在服务器端把去重索引中记录的消息再转存一份，不下载文件。已处理 (成功或暂时失败) 时返回 True；
+        记录的消息已被删除时删除这条失效的记录并返回 False，由调用方按普通任务重新下载 (内容哈希也不会再命中它)。
+        """
+        pending = self._confirmations.get(status_msg.id)
+        source = status_msg.reply_to_message
+        if pending:
+            processor = pending.processor
+        elif source:
+            processor = MessageProcessorFactory.create_processor(source, self.bot)
+        else:
+            return False
+        entry = self.save_index.lookup(processor.dedup_keys())
+        if not entry:
+            return False
+        try:
+            saved = await self.bot.get_messages(entry.chat_id, entry.message_id)
+            if not saved or saved.empty or not saved.media:
+                logger.info(f"已保存的消息 {entry.chat_id}/{entry.message_id} 已不存在，重新下载")
+                self.save_index.forget(entry)
+                return False
+            saved_msg = await saved.copy(self.config.SAVE_TO_CHAT_ID)
+        except Exception as e:
+            logger.warning(f"转存已保存的消息失败: {e}")
+            await query.answer("重新保存失败，请稍后再试。", show_alert=True)
+            return True
+        await query.answer("正在重新保存...")
+        await self._discard_confirmation(status_msg.id)
+        self.save_index.record(processor.dedup_keys(), saved_msg, entry.digest)
+        await self.file_processor.edit_status(status_msg, MESSAGES['resaved_success'].format(
+            filename=entry.file_name or "N/A",
+            filesize=self.file_processor.sizeof_fmt(entry.file_size),
+            link=self._saved_link_text(self.save_index.lookup(processor.dedup_keys()))
+        ), reply_markup=None)
+        return True
+
+    async def _discard_confirmation(self, task_id: int):
+        """丢弃未确认的请求: 停止预取和提前下载，删除已下载的数据"""
+        pending = self._confirmations.pop(task_id, None)
+        if not pending:
+            return
+        tasks = [task for task in (pending.prefetch, pending.download) if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if pending.download:
+            await self.file_processor.storage.release(task_id)
+        self.file_processor.progress.forget(task_id)
+
+    async def _expire_confirmations(self):
+        now = time.monotonic()
+        for task_id, pending in list(self._confirmations.items()):
+            if now - pending.created_at > self.CONFIRMATION_TTL:
+                await self._discard_confirmation(task_id)
 
     async def on_callback_query(self, _, query: CallbackQuery):
         user_id = query.from_user.id
-        if self.config.ALLOWED_USERS and str(user_id) not in self.config.ALLOWED_USERS:
+        # 按钮只出现在已通过完整检查的消息上，这里只检查用户
+        if not self.auth.is_allowed(user_id):
             await query.answer("你没有权限执行此操作。", show_alert=True)
             return
 
         data = query.data
         status_msg = query.message
 
-        if data == "confirm_download":
-            if status_msg.id in self.active_tasks:
+        if data in ("confirm_download", "resave"):
+            if status_msg.id in self.active_tasks or self.journal.exists(status_msg.id):
                 await query.answer("此任务已在进行中，请勿重复点击。", show_alert=True)
                 return
+            # 已保存过的文件按记录的消息转存，只有该消息已不存在时才重新下载
+            if data == "resave" and await self._resave(query, status_msg):
+                return
             await query.answer("请求已确认，任务即将开始...")
-            await status_msg.edit_text(MESSAGES['task_starting'], reply_markup=None)
-            task = asyncio.create_task(self._run_task(status_msg))
+            if self.config.ROLE == "coordinator":
+                # 任务放入共享队列，由工作进程重新创建处理器并执行
+                await self._discard_confirmation(status_msg.id)
+                self.journal.start(status_msg, user_id)
+                await self.file_processor.edit_status(
+                    status_msg, MESSAGES['task_enqueued'].format(ahead=self.journal.queue_position(status_msg.id)),
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton("🔴 取消任务", callback_data=f"cancel_task:{status_msg.id}")
+                    ]])
+                )
+                self.file_processor.progress.forget(status_msg.id)
+                return
+            pending = self._confirmations.pop(status_msg.id, None)
+            if pending and pending.prefetch:
+                # 确认后不再更新确认消息，已开始的提前下载交给任务
+                pending.prefetch.cancel()
+            await self.file_processor.edit_status(status_msg, MESSAGES['task_starting'], reply_markup=None)
+            self.journal.start(status_msg, user_id, worker=self.config.WORKER_ID)
+            task = asyncio.create_task(self._run_task(status_msg, user_id, pending=pending))
             self.active_tasks[status_msg.id] = task
 
         elif data == "cancel_op":
             await query.answer("操作已取消。")
+            await self._discard_confirmation(status_msg.id)
             await status_msg.delete()
 
+        elif data.startswith("toggle_pause:"):
+            task_id = int(data.split(":", 1)[1])
+            paused = await self.file_processor.toggle_pause(task_id)
+            if paused is None:
+                await query.answer("任务不支持暂停或已完成。", show_alert=True)
+            else:
+                await query.answer("任务已暂停。" if paused else "任务已继续。")
+                with suppress(MessageNotModified):
+                    await status_msg.edit_reply_markup(self.file_processor.task_keyboard(task_id))
+
         elif data.startswith("cancel_task:"):
             task_id = int(data.split(":", 1)[1])
             if task_id in self.active_tasks:
                 self.active_tasks[task_id].cancel()
                 await query.answer("正在取消任务...", show_alert=False)
+            elif self.config.ROLE == "coordinator" and (result := self.journal.cancel(task_id)):
+                # 队列中的任务直接删除，执行中的任务由对应的工作进程取消
+                await query.answer("正在取消任务..." if result == "requested" else "任务已取消。")
+                if result == "deleted":
+                    await self.file_processor.edit_status(status_msg, MESSAGES['task_cancelled'], reply_markup=None)
+                    self.file_processor.progress.forget(task_id)
             else:
                 await query.answer("任务已完成或不存在。", show_alert=True)
 
-    async def _run_task(self, status_msg: Message):
+    async def resume_jobs(self):
+        """启动后恢复任务日志中未完成的任务，并更新它们原来的状态消息"""
+        for entry in self.journal.unfinished():
+            await self._start_from_journal(entry)
+
+    async def _start_from_journal(self, entry: JournalEntry):
+        """
+        获取任务日志中记录的状态消息并执行任务，已有进度的任务从断点继续。
+        获取失败 (网络错误、FloodWait 等) 时任务日志保留，在后台按退避间隔重试。
+        """
+        try:
+            status_msg = await self.bot.get_messages(entry.chat_id, entry.task_id)
+        except Exception as e:
+            logger.warning(f"暂时无法获取任务 {entry.task_id} 的状态消息: {e}，稍后重试")
+            self.active_tasks[entry.task_id] = asyncio.create_task(self._resume_later(entry, e))
+            return
+        await self._launch_from_journal(entry, status_msg)
+
+    async def _resume_later(self, entry: JournalEntry, error: Exception):
+        """重试获取状态消息，期间占用任务槽位并可以被取消；多次失败后交还任务，留待之后恢复"""
+        task_id = entry.task_id
+        try:
+            for attempt in range(1, self.RESUME_RETRIES + 1):
+                await asyncio.sleep(error.value if isinstance(error, FloodWait) else min(5 * 2 ** attempt, 300))
+                try:
+                    status_msg = await self.bot.get_messages(entry.chat_id, task_id)
+                except Exception as e:
+                    logger.warning(f"获取任务 {task_id} 的状态消息失败 (第 {attempt} 次): {e}")
+                    error = e
+                    continue
+                await self._launch_from_journal(entry, status_msg)
+                return
+            logger.error(f"多次重试后仍无法获取任务 {task_id} 的状态消息，任务保留在任务日志中")
+            if self.config.ROLE == "worker":
+                self.journal.unclaim(task_id)
+        except asyncio.CancelledError:
+            if not self._shutting_down:
+                # 用户取消了任务
+                self.journal.finish(task_id)
+                await self.file_processor.storage.release(task_id)
+            raise
+        finally:
+            if self.active_tasks.get(task_id) is asyncio.current_task():
+                del self.active_tasks[task_id]
+
+    async def _launch_from_journal(self, entry: JournalEntry, status_msg: Message | None):
+        """执行任务日志中的任务；状态消息或原始消息已被删除时才放弃该任务"""
+        if not status_msg or status_msg.empty or not status_msg.reply_to_message:
+            logger.warning(f"无法恢复任务 {entry.task_id}: 找不到状态消息或原始消息")
+            self.journal.finish(entry.task_id)
+            await self.file_processor.storage.release(entry.task_id)
+            return
+
+        logger.info(f"开始任务 {entry.task_id} (阶段: {entry.phase})")
+        if entry.phase == "queued" and not entry.offset:
+            text = MESSAGES['task_starting']
+        else:
+            progress = ""
+            if entry.offset:
+                progress = MESSAGES['resume_progress'].format(
+                    done=self.file_processor.sizeof_fmt(entry.offset),
+                    total=self.file_processor.sizeof_fmt(entry.total) if entry.total else MESSAGES['unknown_size']
+                )
+            text = MESSAGES['task_resumed'].format(progress=progress)
+        with suppress(Exception):
+            await self.file_processor.edit_status(
+                status_msg, text,
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("🔴 取消任务", callback_data=f"cancel_task:{entry.task_id}")
+                ]])
+            )
+        self.active_tasks[entry.task_id] = asyncio.create_task(
+            self._run_task(status_msg, entry.user_id, resume=entry)
+        )
+
+    async def run_worker(self):
+        """
+        工作进程: 从共享的任务队列领取任务并执行，同时执行的任务数不超过 MAX_CONCURRENT_TASKS。
+        定期为执行中的任务续约 (本进程退出后租约过期，任务由其他工作进程接手)，并处理前端转来的取消请求。
+        """
+        worker = self.config.WORKER_ID
+        logger.info(f"工作进程 {worker} 开始领取任务")
+        while True:
+            self.journal.renew(worker, self.WORKER_LEASE)
+            for task_id in self.journal.take_cancel_requests(worker):
+                if task_id in self.active_tasks:
+                    self.active_tasks[task_id].cancel()
+            while len(self.active_tasks) < self.config.MAX_CONCURRENT_TASKS:
+                entry = self.journal.claim(worker, self.WORKER_LEASE, self.config.MAX_TASKS_PER_USER)
+                if not entry:
+                    break
+                await self._start_from_journal(entry)
+            await asyncio.sleep(self.WORKER_POLL_INTERVAL)
+
+    async def shutdown(self):
+        """停止前中断所有任务，任务日志和已下载的数据保留到下次启动"""
+        self._shutting_down = True
+        tasks = list(self.active_tasks.values())
+        # 未确认的请求的提前下载数据在下次启动时清理
+        for pending in self._confirmations.values():
+            tasks += [task for task in (pending.prefetch, pending.download) if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _upload_directory(self, dir_path: str, processor: BaseMessageProcessor, status_msg: Message):
+        """按路径顺序逐个上传目录中的文件，最后汇总结果"""
+        file_paths = sorted(
+            os.path.join(root, name) for root, _, names in os.walk(dir_path) for name in names
+        )
+        total_size = 0
+        for index, path in enumerate(file_paths):
+            saved_msg = await self.file_processor.upload_file(path, status_msg)
+            total_size += os.path.getsize(path)
+            # 整个下载源只对应第一个保存的文件
+            self.save_index.record(processor.dedup_keys() if index == 0 else [], saved_msg)
+        if len(file_paths) > 1:
+            await self.file_processor.edit_status(status_msg, MESSAGES['saved_multiple_success'].format(
+                count=len(file_paths), filesize=self.file_processor.sizeof_fmt(total_size)
+            ), reply_markup=None)
+
+    async def _run_batch(self, processor: TGBatchMessageProcessor, status_msg: Message):
+        """
+        逐个保存批量任务中的条目: 已保存过的跳过，可转发的在服务器端转存，其余的下载后上传。
+        下载与上传流水线执行，最多 BATCH_QUEUE_SIZE 个条目在本地等待上传。单个条目失败不影响其他条目。
+        """
+        task_id = status_msg.id
+        file_processor = self.file_processor
+        await file_processor.edit_status(
+            status_msg, MESSAGES['batch_resolving'], reply_markup=file_processor.task_keyboard(task_id)
+        )
+        messages = await processor.resolve_messages(self.config.BATCH_MAX_ITEMS)
+        if not messages:
+            await file_processor.edit_status(status_msg, MESSAGES['batch_empty'], reply_markup=None)
+            return
+
+        items = [TGMediaMessageProcessor(msg, self.bot) for msg in messages]
+        sizes = [item.expected_size() or 0 for item in items]
+        progress = BatchProgress(total=len(items), total_size=sum(sizes))
+        # 队列中和正在传输的条目同时占用磁盘，按最大的几个条目预留空间
+        await file_processor.storage.reserve(
+            task_id, sum(sorted(sizes, reverse=True)[:self.BATCH_QUEUE_SIZE + 2]),
+            on_wait=lambda: file_processor.edit_status(
+                status_msg, MESSAGES['storage_waiting'], reply_markup=file_processor.task_keyboard(task_id)
+            )
+        )
+
+        def report():
+            done = sum(progress.downloaded.values()) + sum(progress.uploaded.values())
+            file_processor.progress.submit(
+                status_msg, progress.text(file_processor.progress.speed(task_id, done)),
+                reply_markup=file_processor.task_keyboard(task_id)
+            )
+
+        async def on_download(current, total, index):
+            progress.downloaded[index] = current
+            report()
+
+        async def on_upload(current, total, index):
+            progress.uploaded[index] = current
+            report()
+
+        def fail(item: TGMediaMessageProcessor, index: int, size: int, error):
+            logger.warning(f"批量任务 {task_id} 中的消息 {item._msg.id} 保存失败: {error}")
+            progress.failed += 1
+            progress.complete(index, size)
+            report()
+
+        queue = asyncio.Queue(maxsize=self.BATCH_QUEUE_SIZE)
+
+        async def produce():
+            try:
+                for index, (item, size) in enumerate(zip(items, sizes)):
+                    msg = item._msg
+                    if self.save_index.lookup(item.dedup_keys()):
+                        progress.skipped += 1
+                        progress.complete(index, size)
+                        report()
+                        continue
+                    if self.config.COPY_FAST_PATH and not msg.has_protected_content:
+                        try:
+                            saved_msg = await msg.copy(
+                                self.config.SAVE_TO_CHAT_ID,
+                                reply_to_message_id=file_processor.topic_for(item.get_message_type()) or None
+                            )
+                            self.save_index.record(item.dedup_keys(), saved_msg)
+                            progress.saved += 1
+                            progress.complete(index, size)
+                            report()
+                            continue
+                        except Exception as e:
+                            logger.warning(f"服务器端转存失败，改为下载后重新上传: {e}")
+                    if size > self.config.MAX_FILE_SIZE:
+                        # 批量任务不分割文件，超过上限的条目直接跳过
+                        fail(item, index, size, MESSAGES['file_too_large'].format(
+                            filesize=file_processor.sizeof_fmt(size),
+                            limit=file_processor.sizeof_fmt(self.config.MAX_FILE_SIZE)
+                        ))
+                        continue
+                    item_dir = os.path.join(file_processor.storage.task_dir(task_id), str(index))
+                    try:
+                        async with self.scheduler.slot("download"), METRICS.span("download") as span:
+                            file_path = await item.download_to(
+                                item_dir, self.config.TG_DOWNLOAD_CONNECTIONS, on_download, (index,)
+                            )
+                            span["bytes"] = size
+                        if not file_path or not os.path.exists(file_path):
+                            raise FileNotFoundError(MESSAGES['file_not_found'])
+                    except Exception as e:
+                        shutil.rmtree(item_dir, ignore_errors=True)
+                        fail(item, index, size, e)
+                        continue
+                    await queue.put((index, item, size, item_dir, file_path))
+            except Exception:
+                # 已下载的条目仍会上传，之后再报告错误
+                await queue.put(None)
+                raise
+            await queue.put(None)
+
+        async def consume():
+            while (entry := await queue.get()) is not None:
+                index, item, size, item_dir, file_path = entry
+                try:
+                    async with self.scheduler.slot("upload"), METRICS.span("upload") as span:
+                        digest = CONTENT_DIGESTS.get(file_path)
+                        saved_msg = await file_processor.send_file(file_path, on_upload, (index,), digest=digest)
+                        span["bytes"] = os.path.getsize(file_path)
+                    self.save_index.record(item.dedup_keys(), saved_msg, digest)
+                    progress.saved += 1
+                    progress.uploaded_size += os.path.getsize(file_path)
+                    progress.complete(index, size)
+                    report()
+                except Exception as e:
+                    fail(item, index, size, e)
+                finally:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, lambda: shutil.rmtree(item_dir, ignore_errors=True)
+                    )
+
+        producer = asyncio.create_task(produce())
+        try:
+            await consume()
+            await producer
+        finally:
+            producer.cancel()
+        await file_processor.edit_status(status_msg, MESSAGES['batch_success'].format(
+            total=progress.total, saved=progress.saved, skipped=progress.skipped, failed=progress.failed,
+            filesize=file_processor.sizeof_fmt(progress.uploaded_size)
+        ), reply_markup=None)
+
+    async def _run_task(self, status_msg: Message, user_id: int, resume: JournalEntry | None = None,
+                        pending: PendingConfirmation | None = None):
         source_message = status_msg.reply_to_message
         if not source_message:
-            await status_msg.edit_text("❌ **错误**\n无法找到原始消息，任务无法执行。")
+            await self.file_processor.edit_status(status_msg, "❌ **错误**\n无法找到原始消息，任务无法执行。")
+            self.journal.finish(status_msg.id)
             return
         task_id = status_msg.id
         file_path = None
 
-        # 创建对应的处理器来处理下载逻辑
-        processor = MessageProcessorFactory.create_processor(source_message, self.bot)
+        # 沿用确认前创建的处理器 (保留已获取的信息)，恢复的任务重新创建
+        if pending:
+            processor, download_ahead = pending.processor, pending.download
+        else:
+            processor, download_ahead = MessageProcessorFactory.create_processor(source_message, self.bot), None
+        # 之后的 span 都记在这个任务和来源类型下
+        current_job.set((task_id, processor.source))
+        started_at = time.monotonic()
+        status = "ok"
 
+        self._status_messages[task_id] = status_msg
+        self._queue_positions[task_id] = None
         try:
-            # 步骤 1: 下载
-            # 处理器的 download 方法负责所有特定于源的逻辑
-            file_path = await processor.download(self.file_processor, status_msg)
+            # 步骤 0: 排队，等待调度器放行
+            async with self.scheduler.job(user_id, task_id):
+                METRICS.record_span("queue", time.monotonic() - started_at)
+                self._queue_positions.pop(task_id, None)
+                # 任务已开始执行，尚未发送的排队位置不再需要
+                self.file_processor.progress.discard(task_id)
 
-            if not file_path or not os.path.exists(file_path):
-                if not status_msg.text.startswith(MESSAGES['download_failed'].split('\n')[0]):
-                    await status_msg.edit_text(MESSAGES['file_not_found'], reply_markup=None)
-                return
+                if processor.is_batch:
+                    self.journal.set_phase(task_id, "downloading")
+                    await self._run_batch(processor, status_msg)
+                    return
 
-            self.file_processor.cancellable_files[task_id] = file_path
+                # 快速路径: 内容已在 Telegram 上且允许转发时，直接在服务器端转存
+                if self.config.COPY_FAST_PATH:
+                    async with METRICS.span("copy"):
+                        saved_msg = await processor.save_by_copy(self.file_processor, status_msg)
+                    if saved_msg:
+                        self.save_index.record(processor.dedup_keys(), saved_msg)
+                        return
+
+                # 步骤 1: 下载 (重启前已下载完成的任务直接上传)
+                if resume and resume.phase == "uploading" and resume.file_path and os.path.exists(resume.file_path):
+                    file_path = resume.file_path
+                elif download_ahead and (ahead_path := await self._finish_download_ahead(download_ahead)):
+                    # 确认前已下载完成
+                    file_path = ahead_path
+                else:
+                    self.journal.set_phase(task_id, "downloading")
+                    async with self.scheduler.slot("download"):
+                        # 已提前下载了一部分时不走流式传输，下载从断点继续
+                        stream = (await processor.open_stream()
+                                  if self.config.STREAM_TRANSFER and not download_ahead else None)
+                        if stream and stream.file_size and stream.file_size > self.config.MAX_FILE_SIZE:
+                            # 超过上限的文件需要先落盘再分割
+                            await stream.aclose()
+                            stream = None
+                        if stream:
+                            # 流式传输: 下载与上传同时进行，同时占用两类槽位；中断后只能从头开始
+                            self.journal.set_phase(task_id, "streaming")
+                            try:
+                                async with self.scheduler.slot("upload"), METRICS.span("stream") as span:
+                                    saved_msg = await self.file_processor.upload_stream(stream, status_msg)
+                                    span["bytes"] = stream.file_size or 0
+                            finally:
+                                # 关闭数据源 (例如 HTTP 连接)
+                                with suppress(Exception):
+                                    await stream.aclose()
+                            self.save_index.record(processor.dedup_keys(), saved_msg, stream.digest)
+                            return
+
+                        # 按预计大小预留磁盘空间，超过上限的文件分割时还需要同样大小的空间
+                        size = processor.expected_size() or 0
+                        if size > self.config.MAX_FILE_SIZE:
+                            size *= 2
+                        await self.file_processor.storage.reserve(task_id, size, on_wait=lambda: (
+                            self.file_processor.edit_status(
+                                status_msg, MESSAGES['storage_waiting'],
+                                reply_markup=self.file_processor.task_keyboard(task_id)
+                            )
+                        ))
+                        async with METRICS.span("download") as span:
+                            file_path = await processor.download(self.file_processor, status_msg)
+                            if file_path and os.path.exists(file_path):
+                                span["bytes"] = (StorageManager._du(file_path) if os.path.isdir(file_path)
+                                                 else os.path.getsize(file_path))
+
+                if not file_path or not os.path.exists(file_path):
+                    if not self.file_processor.progress.current_text(task_id).startswith(
+                            MESSAGES['download_failed'].split('\n')[0]):
+                        await self.file_processor.edit_status(status_msg, MESSAGES['file_not_found'], reply_markup=None)
+                    status = "failed"
+                    return
+
+                self.journal.set_phase(task_id, "uploading", file_path)
+
+                # 多文件下载 (例如种子) 逐个上传
+                if os.path.isdir(file_path):
+                    async with self.scheduler.slot("upload"), METRICS.span("upload") as span:
+                        await self._upload_directory(file_path, processor, status_msg)
+                        span["bytes"] = StorageManager._du(file_path)
+                    return
+
+                # 下载得到的内容可能已经保存过 (例如同一文件的不同链接)，此时跳过上传。
+                # 分段下载时已经顺带算好了内容哈希，其它来源 (aria2、ffmpeg 等) 才需要再读一遍文件
+                digest = CONTENT_DIGESTS.get(file_path)
+                if not digest:
+                    loop = asyncio.get_running_loop()
+                    async with METRICS.span("hash"):
+                        digest = await loop.run_in_executor(None, ContentHasher.hash_file, file_path)
+                entry = self.save_index.lookup([f"content:{digest}"])
+                if entry:
+                    self.save_index.alias(processor.dedup_keys(), entry)
+                    await self.file_processor.edit_status(
+                        status_msg, MESSAGES['already_saved_skip'].format(link=self._saved_link_text(entry)),
+                        reply_markup=None
+                    )
+                    return
 
-            # 步骤 2: 上传
-            await self.file_processor.upload_file(file_path, status_msg)
+                # 步骤 2: 上传
+                async with self.scheduler.slot("upload"), METRICS.span("upload") as span:
+                    saved_msg = await self.file_processor.upload_file(file_path, status_msg, digest)
+                    span["bytes"] = os.path.getsize(file_path)
+                self.save_index.record(processor.dedup_keys(), saved_msg, digest)
 
         except asyncio.CancelledError:
-            await status_msg.edit_text(MESSAGES['task_cancelled'], reply_markup=None)
-            logger.info(f"任务 {task_id} 已被用户取消。")
+            status = "interrupted" if self._shutting_down else "cancelled"
+            if self._shutting_down:
+                # 机器人正在停止: 保留任务日志和已下载的数据，重启后继续
+                with suppress(Exception):
+                    await self.file_processor.edit_status(status_msg, MESSAGES['task_interrupted'], reply_markup=None)
+                logger.info(f"任务 {task_id} 因机器人停止而中断，将在重启后继续。")
+            else:
+                await self.file_processor.edit_status(status_msg, MESSAGES['task_cancelled'], reply_markup=None)
+                logger.info(f"任务 {task_id} 已被用户取消。")
         except Exception as e:
+            status = "failed"
             if not isinstance(e, asyncio.CancelledError):
                 logger.error(f"任务 {task_id} 执行出错: {e}", exc_info=True)
-                # 避免重复发送失败消息
-                if hasattr(status_msg, 'text') and status_msg.text:
-                    current_text = status_msg.text
-                    if MESSAGES['download_failed'].split('\n')[0] not in current_text:
-                        await status_msg.edit_text(MESSAGES['download_failed'].format(error=str(e)), reply_markup=None)
+                # 避免重复发送失败消息 (处理器或上传步骤可能已经显示了具体的错误)
+                current_text = self.file_processor.progress.current_text(task_id)
+                if not any(current_text.startswith(MESSAGES[key].split('\n')[0])
+                           for key in ('download_failed', 'upload_failed')):
+                    await self.file_processor.edit_status(
+                        status_msg, MESSAGES['download_failed'].format(error=str(e)), reply_markup=None
+                    )
         finally:
-            # 步骤 3: 清理
-            if task_id in self.file_processor.cancellable_files:
-                path_to_clean = self.file_processor.cancellable_files.pop(task_id)
-                with suppress(FileNotFoundError, IsADirectoryError):
-                    if os.path.isdir(path_to_clean):
-                        import shutil
-                        shutil.rmtree(path_to_clean)
-                    else:
-                        os.remove(path_to_clean)
-                    logger.info(f"已清理临时文件/目录: {path_to_clean}")
+            METRICS.record_span("total", time.monotonic() - started_at, status)
+            METRICS.inc("jobs_total", 1, "结束的任务数", source=processor.source, status=status)
+            # 步骤 3: 清理任务目录中的所有数据 (包括未完成的下载)
+            if not self._shutting_down:
+                self.journal.finish(task_id)
+                await self.file_processor.storage.release(task_id)
 
+            self._status_messages.pop(task_id, None)
+            self._queue_positions.pop(task_id, None)
+            self.file_processor.progress.forget(task_id)
             if task_id in self.active_tasks:
                 del self.active_tasks[task_id]
 
 
-def main():
+async def warm_up_peer(client: Client, chat_id: int):
     """
-    主函数，用于设置和运行机器人。
-    请注意: 新增的 M3U8 下载功能需要您的系统上安装了 FFmpeg。
+    用户会话只有见过的对话才能解析，会话字符串又不保存对话列表，
+    启动时找到保存频道，否则发送文件时会因无法解析频道而失败。
     """
-    try:
-        config = Config()
-    except (FileNotFoundError, ValueError) as e:
-        logger.critical(f"配置错误: {e}")
+    with suppress(Exception):
+        await client.get_chat(chat_id)
         return
+    async for dialog in client.get_dialogs():
+        if dialog.chat.id == chat_id:
+            return
+    logger.warning(f"辅助会话不在保存频道 {chat_id} 中，发送文件将会失败")
+
 
-    bot = Client('sessions/bot', api_id=config.API_ID, api_hash=config.API_HASH, bot_token=config.BOT_TOKEN)
+def create_bot(config: Config) -> tuple[Client, BotHandlers]:
+    """创建客户端并注册所有处理器，不进行任何网络连接 (启动基准测试也使用此函数)"""
+    # Pyrogram 默认同一时间只允许一个传输，这里放宽到调度器的槽位数；每个 Telegram 下载可能占用多个连接
+    # 工作进程使用同一个机器人的独立会话，不接收更新 (消息和按钮回调都由前端处理)
+    is_worker = config.ROLE == "worker"
+    bot = Client(
+        f'sessions/worker-{config.WORKER_ID}' if is_worker else 'sessions/bot',
+        api_id=config.API_ID, api_hash=config.API_HASH, bot_token=config.BOT_TOKEN, no_updates=is_worker,
+        max_concurrent_transmissions=max(
+            config.MAX_CONCURRENT_DOWNLOADS * max(config.TG_DOWNLOAD_CONNECTIONS, 1), config.MAX_CONCURRENT_UPLOADS
+        )
+    )
+
+    journal = JobJournal()
+    DouyinMessageProcessor.resolver = DouyinResolver(config.DOUYIN_API_URL, config.DOUYIN_CACHE_TTL)
+    file_processor = FileProcessor(bot, config, journal)
+    handlers = BotHandlers(bot, config, file_processor, SaveIndex(), journal)
 
-    file_processor = FileProcessor(bot, config)
-    handlers = BotHandlers(bot, config, file_processor)
+    # 只在调用时读取当前状态的指标
+    METRICS.gauge("active_jobs", lambda: len(handlers.active_tasks), "进行中 (含排队) 的任务数")
+    METRICS.gauge("queued_jobs", lambda: len(handlers._queue_positions), "排队中的任务数")
+    METRICS.gauge("storage_reserved_bytes", lambda: sum(file_processor.storage.reservations.values()),
+                  "为进行中的任务预留的磁盘空间")
+    METRICS.gauge("progress_pending_edits", lambda: len(file_processor.progress._pending), "等待发送的进度编辑数")
+    METRICS.gauge("auth_chat_cache_hit_rate", lambda: handlers.auth.metrics()["chat_hit_rate"],
+                  "保存频道检查的缓存命中率")
+    METRICS.gauge("shared_queue_jobs", journal.queued_count, "共享任务队列中等待工作进程领取的任务数")
+    logging.getLogger("pyrogram.session.session").addHandler(FloodWaitLogHandler())
+
+    if is_worker:
+        file_processor.allow_pause = False
+        if config.WORKER_SESSION_STRING:
+            file_processor.upload_client = Client(
+                f'sessions/helper-{config.WORKER_ID}', api_id=config.API_ID, api_hash=config.API_HASH,
+                session_string=config.WORKER_SESSION_STRING, no_updates=True,
+                max_concurrent_transmissions=max(config.MAX_CONCURRENT_UPLOADS, 1)
+            )
+        return bot, handlers
 
     # 注册处理器
     bot.add_handler(pyrogram.handlers.MessageHandler(handlers.on_start, filters.command(["start"]) & filters.private))
     bot.add_handler(pyrogram.handlers.MessageHandler(handlers.on_new_message, (
             filters.media | filters.text) & filters.private & ~filters.command(["start"])))
     bot.add_handler(pyrogram.handlers.CallbackQueryHandler(handlers.on_callback_query))
+    return bot, handlers
+
+
+async def run(bot: Client, handlers: BotHandlers):
+    """启动机器人，恢复未完成的任务，收到停止信号后中断任务再断开连接"""
+    config = handlers.config
+    # 替换默认线程池以统计其饱和程度
+    executor = InstrumentedExecutor()
+    asyncio.get_running_loop().set_default_executor(executor)
+    METRICS.gauge("executor_max_workers", lambda: executor._max_workers, "默认线程池的线程数")
+    METRICS.gauge("executor_running", lambda: executor.running, "线程池中正在执行的任务数")
+    METRICS.gauge("executor_queued", lambda: executor.queued, "线程池中排队的任务数")
+    MEDIA_POOL.workers = config.MEDIA_WORKERS or available_cpus()
+    METRICS.gauge("media_pool_workers", lambda: MEDIA_POOL.workers, "媒体处理池的槽位数")
+    METRICS.gauge("media_pool_running", lambda: MEDIA_POOL.running, "媒体处理池中正在运行的作业数")
+    METRICS.gauge("media_pool_queued", lambda: MEDIA_POOL.queued, "媒体处理池中排队的作业数")
+    lag_monitor = asyncio.create_task(monitor_loop_lag())
+    profiler = None
+    if config.PROFILE_SAMPLE_MS > 0:
+        profiler = LoopProfiler(config.PROFILE_SAMPLE_MS / 1000, config.PROFILE_OUTPUT)
+        profiler.start()
+    metrics_server = None
+    if config.METRICS_PORT:
+        metrics_server = MetricsServer(config.METRICS_HOST, config.METRICS_PORT, profiler)
+        await metrics_server.start()
+
+    await bot.start()
+    helper = handlers.file_processor.upload_client
+    if helper is not bot:
+        await helper.start()
+        await warm_up_peer(helper, config.SAVE_TO_CHAT_ID)
+    await handlers.auth.refresh()
+    worker_loop = None
+    if config.ROLE == "worker":
+        worker_loop = asyncio.create_task(handlers.run_worker())
+    elif config.ROLE == "all":
+        # 拆分部署时未完成的任务留在共享队列中，由工作进程接手
+        await handlers.resume_jobs()
+    await pyrogram.idle()
+    if worker_loop:
+        worker_loop.cancel()
+    await handlers.shutdown()
+    if config.ROLE == "worker":
+        handlers.journal.release(config.WORKER_ID)
+    logger.info(f"鉴权缓存统计: {handlers.auth.metrics()}")
+
+    lag_monitor.cancel()
+    if metrics_server:
+        await metrics_server.stop()
+    if profiler:
+        profiler.stop()
+    await close_http_client()
+    if helper is not bot:
+        await helper.stop()
+    await bot.stop()
+
+
+def main():
+    """
+    主函数，用于设置和运行机器人。
+    请注意: 新增的 M3U8 下载功能需要您的系统上安装了 FFmpeg。
+    """
+    try:
+        config = Config()
+    except (FileNotFoundError, ValueError) as e:
+        logger.critical(f"配置错误: {e}")
+        return
 
+    bot, handlers = create_bot(config)
+    # 上次运行遗留的任务目录和过期的未完成数据，任务日志中待恢复的任务除外；前端不下载文件，不需要清理
+    if config.ROLE != "coordinator":
+        handlers.file_processor.storage.sweep(keep={entry.task_id for entry in handlers.journal.unfinished()})
     logger.info("机器人正在启动...")
-    bot.run()
+    bot.run(run(bot, handlers))
     logger.info("机器人已停止。")
 
 